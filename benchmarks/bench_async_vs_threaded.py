@@ -0,0 +1,97 @@
+"""
+对比 Flask + 线程池入口与 aiohttp 异步入口的吞吐量。
+两种模式都连接本地上游替身，每个对话使用独立 open_id，统计从投递事件到收到首条回复的耗时。
+
+    python benchmarks/bench_async_vs_threaded.py --conversations 200 --concurrency 100 --llm-latency 0.8
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+
+import aiohttp
+
+from harness import (
+    BENCH_DIR, free_port, wait_http, isolated_env, start_process, stop_process,
+    make_text_event, fetch_json, summarize
+)
+from stub_upstreams import upstream_env
+
+MODES = {
+    "threaded": ["feishu_cuncun_pro.py"],
+    "async": ["feishu_cuncun_async.py"],
+}
+
+async def fire_events(app_url, conversations, concurrency, run_id):
+    sem = asyncio.Semaphore(concurrency)
+    sent_at, ack = {}, []
+
+    async def one(session, i):
+        open_id = f"ou_{run_id}_{i}"
+        async with sem:
+            started = time.time()
+            async with session.post(app_url, json=make_text_event(open_id, "今天好累，陪我聊聊天吧")) as r:
+                await r.read()
+            ack.append(time.time() - started)
+            sent_at[open_id] = started
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(one(session, i) for i in range(conversations)))
+    return sent_at, ack
+
+def wait_replies(stub_url, sent_at, timeout):
+    deadline = time.time() + timeout
+    while True:
+        messages = fetch_json(f"{stub_url}/_stats")["messages"]
+        done = {oid: min(t for t, _ in messages[oid]) for oid in sent_at if oid in messages}
+        if len(done) == len(sent_at) or time.time() > deadline:
+            return done
+        time.sleep(0.2)
+
+def run_mode(mode, args, stub_port):
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    fetch_json(f"{stub_url}/_reset", method="POST")
+    port = free_port()
+    env, workdir = isolated_env({**upstream_env(stub_port), "PORT": str(port), "AI_STREAMING": "false"})
+    proc = start_process(MODES[mode], env, os.path.join(workdir, "app.out"))
+    try:
+        wait_http(f"http://127.0.0.1:{port}/health")
+        start = time.time()
+        sent_at, ack = asyncio.run(fire_events(f"http://127.0.0.1:{port}/", args.conversations, args.concurrency, mode))
+        done = wait_replies(stub_url, sent_at, args.timeout)
+        elapsed = (max(done.values()) - start) if done else float("inf")
+        e2e = [done[oid] - sent_at[oid] for oid in done]
+        return {
+            "mode": mode,
+            "completed": len(done),
+            "conversations": args.conversations,
+            "throughput_per_s": round(len(done) / elapsed, 2) if done else 0.0,
+            "ack": summarize(ack),
+            "first_reply": summarize(e2e),
+        }
+    finally:
+        stop_process(proc)
+
+def main():
+    parser = argparse.ArgumentParser(description="线程入口 vs 异步入口吞吐对比")
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=0.8)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--modes", default="threaded,async")
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    stub = start_process([os.path.join(BENCH_DIR, "stub_upstreams.py"), "--port", str(stub_port),
+                          "--llm-latency", str(args.llm_latency)], dict(os.environ))
+    try:
+        wait_http(f"http://127.0.0.1:{stub_port}/_stats")
+        results = [run_mode(mode, args, stub_port) for mode in args.modes.split(",")]
+    finally:
+        stop_process(stub)
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
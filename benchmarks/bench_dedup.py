@@ -0,0 +1,79 @@
+"""
+事件去重微基准：旧版 deque(maxlen=1000) 线性查找 vs EventDeduplicator (内存 / 内存 + SQLite)。
+
+    python benchmarks/bench_dedup.py --events 20000 --dup-ratio 0.2
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import tempfile
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="cuncun-dedup-"), "dedup.db"))
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.gettempdir(), "cuncun-bench.log"))
+
+from database_manager import init_db           # noqa: E402
+from event_dedup import EventDeduplicator      # noqa: E402
+
+def make_stream(n, dup_ratio, seed=7):
+    """生成带重复的事件流：重复事件取自最近 500 个已出现的 id，模拟飞书短时间重试"""
+    rng = random.Random(seed)
+    stream, recent = [], []
+    for _ in range(n):
+        if recent and rng.random() < dup_ratio:
+            stream.append(rng.choice(recent[-500:]))
+        else:
+            eid = uuid.uuid4().hex
+            recent.append(eid)
+            stream.append(eid)
+    return stream
+
+def bench_deque(stream):
+    processed_ids = deque(maxlen=1000)
+    accepted = 0
+    start = time.perf_counter()
+    for eid in stream:
+        if eid in processed_ids:
+            continue
+        processed_ids.append(eid)
+        accepted += 1
+    return time.perf_counter() - start, accepted
+
+def bench_dedup(stream, persist):
+    dedup = EventDeduplicator(persist=persist)
+    accepted = 0
+    start = time.perf_counter()
+    for eid in stream:
+        if dedup.first_seen(eid):
+            accepted += 1
+    return time.perf_counter() - start, accepted
+
+def main():
+    parser = argparse.ArgumentParser(description="事件去重微基准")
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--dup-ratio", type=float, default=0.2)
+    args = parser.parse_args()
+
+    init_db()
+    stream = make_stream(args.events, args.dup_ratio)
+    results = {}
+    for name, fn in (
+        ("deque_1000", lambda: bench_deque(stream)),
+        ("dedup_memory", lambda: bench_dedup(stream, persist=False)),
+        ("dedup_sqlite", lambda: bench_dedup(stream, persist=True)),
+    ):
+        elapsed, accepted = fn()
+        results[name] = {
+            "accepted": accepted,
+            "total_ms": round(elapsed * 1000, 2),
+            "per_event_us": round(elapsed / len(stream) * 1e6, 2),
+        }
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+端到端压测：以固定速率回放签名 + 加密的飞书事件 (含一定比例的重试重复事件)，
+应用连接本地上游替身，统计入口 ack 延迟、吞吐量与端到端回复延迟。
+
+    python benchmarks/bench_load.py --entry threaded --events 300 --rate 30 --dup-ratio 0.1
+    python benchmarks/bench_load.py --entry async --rate 80 --llm-latency 1.2 --jitter 0.3 --fail-rate 0.05
+    python benchmarks/bench_load.py --entry gunicorn --rate 50 --no-encrypt
+
+每个新事件使用独立的 open_id，回复时间取替身服务收到该用户第一条 / 最后一条消息的时刻；
+重复事件与原事件 event_id 相同 (飞书超时重试的形态)，去重生效时 DeepSeek 调用数应等于不重复事件数。
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter
+
+import aiohttp
+
+from harness import (
+    BENCH_DIR, free_port, wait_http, isolated_env, start_process, stop_process,
+    make_text_event, encrypt_payload, sign_headers, fetch_json, summarize
+)
+from stub_upstreams import upstream_env
+
+ENTRIES = {
+    "threaded": ["feishu_cuncun_pro.py"],
+    "async": ["feishu_cuncun_async.py"],
+    "gunicorn": ["-m", "gunicorn", "-c", "gunicorn.conf.py", "feishu_cuncun_pro:create_app()"],
+}
+TEXTS = ["今天好累，陪我聊聊天吧", "你在干嘛呀", "晚饭吃什么好呢", "明天要考试了有点紧张", "给我讲个笑话"]
+ENCRYPT_KEY = "bench-encrypt-key"
+
+def build_stream(events, dup_ratio, run_id, seed):
+    """生成回放序列 [(event, open_id), ...]：重复事件取自最近 50 个不重复事件，event_id 不变"""
+    rng = random.Random(seed)
+    unique, stream = [], []
+    for _ in range(events):
+        if unique and rng.random() < dup_ratio:
+            stream.append(rng.choice(unique[-50:]))
+        else:
+            open_id = f"ou_{run_id}_{len(unique)}"
+            unique.append((make_text_event(open_id, rng.choice(TEXTS)), open_id))
+            stream.append(unique[-1])
+    return unique, stream
+
+def encode(event, sign, encrypt):
+    payload = encrypt_payload(ENCRYPT_KEY, event) if encrypt else event
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    headers = sign_headers(ENCRYPT_KEY, body) if sign else {"Content-Type": "application/json"}
+    return body, headers
+
+async def replay(url, stream, rate, connections, sign, encrypt):
+    """开环回放：第 i 个事件在 start + i / rate 时发出，不等待前一个 ack"""
+    # 请求体提前编码好 (每次重发都重新签名/加密，与飞书重试一致)，发送循环只做网络 I/O
+    requests = [(event["header"]["event_id"], open_id, *encode(event, sign, encrypt)) for event, open_id in stream]
+    acks, first_sent = [], {}
+    connector = aiohttp.TCPConnector(limit=connections)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+
+        async def send(i, event_id, open_id, body, headers):
+            await asyncio.sleep(max(0.0, start + i / rate - loop.time()))
+            sent = time.time()
+            first_sent.setdefault(open_id, sent)
+            try:
+                async with session.post(url, data=body, headers=headers) as r:
+                    await r.read()
+                    status = str(r.status)
+            except Exception as e:
+                status = type(e).__name__
+            acks.append((sent, time.time() - sent, status))
+
+        wall = time.time()
+        await asyncio.gather(*(send(i, *req) for i, req in enumerate(requests)))
+        wall = time.time() - wall
+    return acks, first_sent, wall
+
+def wait_replies(stub_url, first_sent, timeout):
+    """等待每个 open_id 都收到回复，返回 (stats, {open_id: [消息时间...]})"""
+    deadline = time.time() + timeout
+    while True:
+        stats = fetch_json(f"{stub_url}/_stats")
+        messages = stats["messages"]
+        replies = {oid: sorted(t for t, _ in messages[oid]) for oid in first_sent if oid in messages}
+        if len(replies) == len(first_sent) or time.time() > deadline:
+            return stats, replies
+        time.sleep(0.25)
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端压测 (本地上游替身)")
+    parser.add_argument("--entry", choices=sorted(ENTRIES), default="threaded")
+    parser.add_argument("--events", type=int, default=200, help="回放的事件总数 (含重复)")
+    parser.add_argument("--rate", type=float, default=20.0, help="每秒发送的事件数")
+    parser.add_argument("--dup-ratio", type=float, default=0.1, help="重复事件比例")
+    parser.add_argument("--connections", type=int, default=200)
+    parser.add_argument("--no-sign", action="store_true", help="不签名 (同时不加密)")
+    parser.add_argument("--no-encrypt", action="store_true", help="只签名，明文事件体")
+    parser.add_argument("--streaming", action="store_true", help="开启 AI_STREAMING")
+    parser.add_argument("--llm-latency", type=float, default=0.8)
+    parser.add_argument("--embed-latency", type=float, default=0.05)
+    parser.add_argument("--feishu-latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--fail-upstreams", default="feishu,llm,embed")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    sign = not args.no_sign
+    encrypt = sign and not args.no_encrypt
+
+    stub_port = free_port()
+    stub = start_process([
+        os.path.join(BENCH_DIR, "stub_upstreams.py"), "--port", str(stub_port),
+        "--llm-latency", str(args.llm_latency), "--embed-latency", str(args.embed_latency),
+        "--feishu-latency", str(args.feishu_latency), "--jitter", str(args.jitter),
+        "--fail-rate", str(args.fail_rate), "--fail-upstreams", args.fail_upstreams, "--seed", str(args.seed),
+    ], dict(os.environ))
+    app = None
+    try:
+        stub_url = f"http://127.0.0.1:{stub_port}"
+        wait_http(f"{stub_url}/_stats")
+        port = free_port()
+        env, workdir = isolated_env({
+            **upstream_env(stub_port),
+            "PORT": str(port),
+            "FEISHU_ENCRYPT_KEY": ENCRYPT_KEY if sign else "",
+            "AI_STREAMING": "true" if args.streaming else "false",
+        })
+        app = start_process(ENTRIES[args.entry], env, os.path.join(workdir, "app.out"))
+        wait_http(f"http://127.0.0.1:{port}/health", timeout=60)
+
+        unique, stream = build_stream(args.events, args.dup_ratio, args.entry, args.seed)
+        acks, first_sent, wall = asyncio.run(
+            replay(f"http://127.0.0.1:{port}/", stream, args.rate, args.connections, sign, encrypt))
+        stub_stats, replies = wait_replies(stub_url, first_sent, args.timeout)
+
+        start = min(first_sent.values())
+        first = [times[0] - first_sent[oid] for oid, times in replies.items()]
+        last = [times[-1] - first_sent[oid] for oid, times in replies.items()]
+        finished = max(times[-1] for times in replies.values()) if replies else start
+        try:
+            health = fetch_json(f"http://127.0.0.1:{port}/health")
+        except Exception:
+            health = {}
+
+        results = {
+            "entry": args.entry,
+            "signed": sign,
+            "encrypted": encrypt,
+            "streaming": args.streaming,
+            "sent": {
+                "total": len(stream),
+                "unique": len(unique),
+                "duplicates": len(stream) - len(unique),
+                "offered_rate": args.rate,
+                "achieved_rate": round(len(stream) / wall, 2),
+            },
+            "ack": {**summarize([latency for _, latency, _ in acks]),
+                    "status": dict(Counter(status for _, _, status in acks))},
+            "replies": {
+                "completed": len(replies),
+                "missing": len(unique) - len(replies),
+                "throughput_per_s": round(len(replies) / (finished - start), 2) if replies else 0.0,
+                "e2e_first": summarize(first),
+                "e2e_last": summarize(last),
+            },
+            "dedup": {
+                "llm_calls": stub_stats["calls"]["chat"],
+                "extra_llm_calls": max(stub_stats["calls"]["chat"] - len(unique), 0),
+                # 应用侧统计按进程计，gunicorn 多 worker 时只反映接到 /health 的那个 worker
+                "app": (health.get("queues") or {}).get("dedup"),
+            },
+            "upstream": {"calls": stub_stats["calls"], "injected_failures": stub_stats["failures"]},
+        }
+    finally:
+        stop_process(app)
+        stop_process(stub)
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+热点函数微基准：语音匹配 (match_voice_file)、历史读取 (get_recent_history)、事件解密 (AESCipher.decrypt)。
+向量全部来自本地缓存/替身向量，不访问任何外部服务；输出每次调用的 µs 分位数与 ops/s。
+
+    python benchmarks/bench_micro.py --iterations 2000 --voices 2000 --users 200
+    python benchmarks/bench_micro.py --only decrypt --log-level INFO
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_workdir = tempfile.mkdtemp(prefix="cuncun-micro-")
+os.environ.setdefault("DB_PATH", os.path.join(_workdir, "micro.db"))
+os.environ.setdefault("LOG_FILE", os.path.join(_workdir, "micro.log"))
+os.environ.setdefault("SILICONFLOW_API_KEY", "bench")       # 向量全部预先写入缓存，不会真正发出请求
+os.environ.setdefault("VOICE_INDEX_PATH", os.path.join(_workdir, "voice_index.npy"))
+os.environ.setdefault("ASSETS_PATH", os.path.join(_workdir, "assets"))
+
+import numpy as np                                                  # noqa: E402
+
+import cuncun_utils                                                 # noqa: E402
+from config import Config                                           # noqa: E402
+from voice_index import VoiceIndex                                  # noqa: E402
+from embedding_cache import embedding_cache, normalize_text         # noqa: E402
+from database_manager import init_db, save_messages, get_recent_history, history_cache  # noqa: E402
+from harness import make_text_event, encrypt_payload, percentile    # noqa: E402
+from stub_upstreams import REPLY_TEXT, stub_vector                  # noqa: E402
+
+def measure(fn, iterations, warmup=20):
+    """逐次计时，返回每次调用的 µs 分位数与吞吐"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    total = time.perf_counter() - start
+    return {
+        "calls": iterations,
+        "p50_us": round(percentile(samples, 0.50) * 1e6, 1),
+        "p95_us": round(percentile(samples, 0.95) * 1e6, 1),
+        "p99_us": round(percentile(samples, 0.99) * 1e6, 1),
+        "ops_per_s": round(iterations / total, 1),
+    }
+
+# --- 语音匹配 ---
+
+def voice_texts(voices):
+    return [f"第{i}句语音台词" for i in range(voices)]
+
+def numpy_search(voices):
+    texts = voice_texts(voices)
+    matrix = np.asarray([stub_vector(t) for t in texts], dtype=np.float32)
+    return VoiceIndex(matrix, [f"{i}.opus" for i in range(voices)]), None
+
+def chroma_search(voices):
+    import chromadb
+    from bench_startup import seed_chroma
+    assets, _ = seed_chroma(_workdir, voices)
+    return None, chromadb.PersistentClient(path=assets).get_collection(name="cuncun_voice")
+
+def bench_match_voice(args):
+    # 回复里的每个分句都预先写入向量缓存，测到的是切句 + 缓存查询 + 最近邻检索 (热路径)
+    sentences = cuncun_utils.split_sentences(REPLY_TEXT)
+    keys = [normalize_text(s) for s in sentences]
+    embedding_cache.put_many(cuncun_utils.EMBEDDING_MODEL, keys, [stub_vector(k) for k in keys])
+
+    backends = {"numpy": numpy_search}
+    try:
+        import chromadb  # noqa: F401
+        backends["chroma"] = chroma_search
+    except ImportError:
+        pass
+
+    results = {}
+    batched = Config.VOICE_MATCH_BATCHED
+    for name, loader in backends.items():
+        cuncun_utils._voice_search = cuncun_utils.LazyComponent("语音检索库", lambda: None)
+        cuncun_utils._voice_search.preset(loader(args.voices))
+        for mode in (True, False):
+            Config.VOICE_MATCH_BATCHED = mode
+            label = f"{name}_{'batched' if mode else 'serial'}"
+            results[label] = measure(lambda: cuncun_utils.match_voice_file(REPLY_TEXT), args.iterations)
+    Config.VOICE_MATCH_BATCHED = batched
+    results["sentences"] = len(sentences)
+    results["voices"] = args.voices
+    return results
+
+# --- 历史读取 ---
+
+def bench_history(args):
+    init_db()
+    rng = random.Random(7)
+    users = [f"ou_micro_{i}" for i in range(args.users)]
+    rows = []
+    for user in users:
+        for j in range(args.messages):
+            role = "user" if j % 2 == 0 else "assistant"
+            rows.append((user, role, f"{user} 的第{j}条消息，" + "聊点日常琐事。" * 5, 0, None))
+    save_messages(rows)
+
+    enabled = Config.HISTORY_CACHE_ENABLED
+    results = {}
+    # 先测直读 SQLite (缓存关闭时不会被填充)，再打开缓存；随机访问下前几次是冷读
+    for label, cached in (("sqlite", False), ("history_cache", True)):
+        Config.HISTORY_CACHE_ENABLED = cached
+        results[label] = measure(lambda: get_recent_history(rng.choice(users), 10), args.iterations)
+    Config.HISTORY_CACHE_ENABLED = enabled
+    results["history_cache"]["stats"] = history_cache.stats()
+    results["users"] = args.users
+    return results
+
+# --- 事件解密 ---
+
+def bench_decrypt(args):
+    key = "bench-encrypt-key"
+    cipher = cuncun_utils.AESCipher(key)
+    results = {}
+    for label, chars in (("1kb", 300), ("16kb", 5400)):
+        text = ("今天好累" * chars)[:chars]
+        encrypted = encrypt_payload(key, make_text_event("ou_micro", text))["encrypt"]
+        results[label] = {"bytes": len(encrypted), **measure(lambda: cipher.decrypt(encrypted), args.iterations)}
+    return results
+
+BENCHES = {"match_voice": bench_match_voice, "history": bench_history, "decrypt": bench_decrypt}
+
+def main():
+    parser = argparse.ArgumentParser(description="热点函数微基准")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--voices", type=int, default=2000, help="语音库条数")
+    parser.add_argument("--users", type=int, default=200, help="历史读取的用户数")
+    parser.add_argument("--messages", type=int, default=40, help="每个用户的历史条数")
+    parser.add_argument("--only", choices=sorted(BENCHES), action="append", help="只跑指定项，可重复")
+    parser.add_argument("--log-level", default="ERROR", help="业务日志级别；INFO 时计入逐句日志的开销")
+    args = parser.parse_args()
+
+    cuncun_utils.logger.setLevel(getattr(logging, args.log_level.upper()))
+    results = {name: BENCHES[name](args) for name in (args.only or BENCHES)}
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+冷启动耗时：模块导入时间，以及服务从拉起到 /health 可用、到全部组件加载完成的时间。
+会在临时目录生成一份小型 Chroma 语音库与记忆库，使 Chroma 的导入与打开成本计入测量。
+
+    python benchmarks/bench_startup.py --runs 5 --voices 500
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import urllib.error
+import urllib.request
+
+from harness import (
+    REPO_DIR, BENCH_DIR, free_port, wait_http, isolated_env, start_process, stop_process, fetch_json
+)
+from stub_upstreams import upstream_env, stub_vector
+
+def seed_chroma(workdir, voices):
+    """生成与线上结构一致的语音库 (cuncun_voice) 与记忆库 (cuncun_bio)"""
+    import chromadb
+    assets, memory = os.path.join(workdir, "assets"), os.path.join(workdir, "memory")
+    texts = [f"第{i}句语音台词" for i in range(voices)]
+    voice = chromadb.PersistentClient(path=assets).get_or_create_collection("cuncun_voice")
+    for i in range(0, voices, 500):
+        chunk = texts[i:i + 500]
+        voice.add(ids=[f"v{i + j}" for j in range(len(chunk))],
+                  embeddings=[stub_vector(t) for t in chunk],
+                  metadatas=[{"filename": f"{i + j}.opus"} for j in range(len(chunk))])
+    bio = chromadb.PersistentClient(path=memory).get_or_create_collection("cuncun_bio")
+    bio.add(ids=["b0"], documents=["存存是一个顶尖化妆师"], embeddings=[stub_vector("存存是一个顶尖化妆师")])
+    return assets, memory
+
+def time_import(module, env, runs):
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"],
+            cwd=REPO_DIR, env=env, capture_output=True, text=True, check=True,
+        )
+        samples.append(float(out.stdout.strip().splitlines()[-1]))
+    return samples
+
+def _all_loaded(components):
+    # 旧版健康检查返回布尔值，视为启动时已全部加载
+    return all(v.get("loaded", True) if isinstance(v, dict) else True for v in components.values())
+
+def time_server(env, script, timeout=120):
+    port = free_port()
+    env = {**env, "PORT": str(port)}
+    started = time.perf_counter()
+    proc = start_process([script], env)
+    try:
+        url = f"http://127.0.0.1:{port}/health"
+        wait_http(url, timeout=timeout)
+        ready = time.perf_counter() - started
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                components = fetch_json(url)["components"]
+            except urllib.error.HTTPError as e:
+                components = json.loads(e.read())["components"]
+            if _all_loaded(components):
+                break
+            time.sleep(0.05)
+        return ready, time.perf_counter() - started
+    finally:
+        stop_process(proc)
+
+def summary(samples):
+    return {"median_s": round(statistics.median(samples), 3), "min_s": round(min(samples), 3)}
+
+def main():
+    parser = argparse.ArgumentParser(description="冷启动耗时")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--voices", type=int, default=500)
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    stub = start_process([os.path.join(BENCH_DIR, "stub_upstreams.py"), "--port", str(stub_port)], dict(os.environ))
+    try:
+        wait_http(f"http://127.0.0.1:{stub_port}/_stats")
+        env, workdir = isolated_env(upstream_env(stub_port))
+        env["ASSETS_PATH"], env["MEMORY_PATH"] = seed_chroma(workdir, args.voices)
+
+        results = {
+            "import_cuncun_utils": summary(time_import("cuncun_utils", env, args.runs)),
+            "import_feishu_cuncun_pro": summary(time_import("feishu_cuncun_pro", env, args.runs)),
+        }
+        ready, loaded = zip(*(time_server(env, "feishu_cuncun_pro.py") for _ in range(args.runs)))
+        results["health_ready"] = summary(ready)
+        results["components_loaded"] = summary(loaded)
+    finally:
+        stop_process(stub)
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
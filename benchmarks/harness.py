@@ -0,0 +1,111 @@
+"""压测公共工具：拉起进程、构造 (签名/加密的) 飞书事件、统计分位数"""
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import hashlib
+import socket
+import tempfile
+import subprocess
+import urllib.request
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_http(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=2):
+                return True
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError(f"服务未在 {timeout}s 内就绪: {url}")
+
+def isolated_env(extra=None):
+    """被测应用的隔离环境：临时数据库/日志，关闭签名与语音库"""
+    workdir = tempfile.mkdtemp(prefix="cuncun-bench-")
+    env = dict(os.environ)
+    env.update({
+        "DB_PATH": os.path.join(workdir, "bench.db"),
+        "LOG_FILE": os.path.join(workdir, "logs", "bench.log"),
+        "BACKUP_DIR": os.path.join(workdir, "backups"),
+        "ASSETS_PATH": os.path.join(workdir, "no_assets"),
+        "MEMORY_PATH": os.path.join(workdir, "no_memory"),
+        "FEISHU_ENCRYPT_KEY": "",
+        "ADMIN_OPEN_ID": "",
+        "PYTHONUNBUFFERED": "1",
+    })
+    env.update(extra or {})
+    return env, workdir
+
+def start_process(args, env, log_path=None):
+    out = open(log_path, "wb") if log_path else subprocess.DEVNULL
+    return subprocess.Popen([sys.executable] + args, cwd=REPO_DIR, env=env, stdout=out, stderr=subprocess.STDOUT)
+
+def stop_process(proc, timeout=10):
+    if proc and proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+def make_text_event(open_id, text, event_id=None):
+    return {
+        "schema": "2.0",
+        "header": {"event_id": event_id or uuid.uuid4().hex, "event_type": "im.message.receive_v1"},
+        "event": {
+            "sender": {"sender_id": {"open_id": open_id}},
+            "message": {"message_type": "text", "content": json.dumps({"text": text}, ensure_ascii=False)},
+        },
+    }
+
+def encrypt_payload(encrypt_key, payload):
+    """按飞书的方式加密事件：AES-256-CBC，密钥为 sha256(encrypt_key)，密文为 base64(iv + data)"""
+    from Crypto.Cipher import AES
+    key = hashlib.sha256(encrypt_key.encode("utf-8")).digest()
+    raw = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    pad = 16 - len(raw) % 16
+    raw += bytes([pad]) * pad
+    iv = os.urandom(16)
+    return {"encrypt": base64.b64encode(iv + AES.new(key, AES.MODE_CBC, iv).encrypt(raw)).decode("ascii")}
+
+def sign_headers(encrypt_key, body):
+    """飞书回调的签名头：sha256(timestamp + nonce + encrypt_key + body)"""
+    timestamp, nonce = str(int(time.time())), uuid.uuid4().hex
+    signature = hashlib.sha256((timestamp + nonce + encrypt_key).encode("utf-8") + body).hexdigest()
+    return {
+        "Content-Type": "application/json",
+        "X-Lark-Request-Timestamp": timestamp,
+        "X-Lark-Request-Nonce": nonce,
+        "X-Lark-Signature": signature,
+    }
+
+def fetch_json(url, method="GET"):
+    req = urllib.request.Request(url, method=method, data=b"" if method == "POST" else None)
+    with urllib.request.urlopen(req, timeout=10) as r:
+        return json.loads(r.read() or b"{}")
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[idx]
+
+def summarize(values):
+    """毫秒级分位数摘要"""
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+    }
@@ -0,0 +1,214 @@
+"""
+本地上游替身服务：模拟飞书开放平台、DeepSeek chat completions 与硅基流动 embeddings，
+用于在不消耗真实额度的情况下压测入口。
+
+    python benchmarks/stub_upstreams.py --port 9100 --llm-latency 0.8
+    python benchmarks/stub_upstreams.py --port 9100 --jitter 0.3 --fail-rate 0.05 --fail-upstreams llm,embed
+
+应用侧通过环境变量指向替身：
+    FEISHU_BASE_URL=http://127.0.0.1:9100/feishu/open-apis
+    DEEPSEEK_BASE_URL=http://127.0.0.1:9100/deepseek
+    SILICONFLOW_BASE_URL=http://127.0.0.1:9100/siliconflow/v1
+"""
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+
+from aiohttp import web
+
+REPLY_TEXT = (
+    "[别过脸] 哼，谁要你管我啊。我只是顺便路过而已！\n"
+    "你这个笨蛋，又熬夜了吧？早饭我放在桌上了，爱吃不吃。\n"
+    "[咬了咬嘴唇] 下次再这样，我可真的不理你了。"
+)
+
+def stub_vector(text, dim=32):
+    """按文本哈希生成确定性的向量，同一句话永远得到同一结果"""
+    digest = hashlib.sha256(text.encode("utf-8")).digest()
+    return [((digest[i % len(digest)] / 255.0) - 0.5) for i in range(dim)]
+
+UPSTREAMS = ("feishu", "llm", "embed")
+
+class StubUpstreams:
+    """
+    jitter: 延迟在 [1 - jitter, 1 + jitter] 倍之间均匀波动
+    fail_rate: fail_upstreams 中的接口按该概率直接返回 fail_status (不计入成功调用，token 接口不注入)
+    """
+
+    def __init__(self, llm_latency=0.5, embed_latency=0.05, feishu_latency=0.02,
+                 jitter=0.0, fail_rate=0.0, fail_status=503, fail_upstreams=UPSTREAMS, seed=None):
+        self.llm_latency = llm_latency
+        self.embed_latency = embed_latency
+        self.feishu_latency = feishu_latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.fail_upstreams = set(fail_upstreams)
+        self.rng = random.Random(seed)
+        self.reset()
+
+    def reset(self):
+        self.messages = {}      # receive_id -> [(timestamp, msg_type), ...]
+        self.calls = {"token": 0, "messages": 0, "files": 0, "chat": 0, "embeddings": 0, "rejected": 0}
+        self.failures = {name: 0 for name in UPSTREAMS}
+        self.token_generation = 0
+
+    def _delay(self, base):
+        if self.jitter:
+            base *= self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(base, 0)
+
+    def _inject_failure(self, upstream):
+        """按 fail_rate 返回一个失败响应，否则返回 None"""
+        if upstream in self.fail_upstreams and self.fail_rate and self.rng.random() < self.fail_rate:
+            self.failures[upstream] += 1
+            return web.json_response({"error": {"message": "injected failure"}}, status=self.fail_status)
+        return None
+
+    # --- 飞书 ---
+
+    async def token(self, request):
+        self.calls["token"] += 1
+        await asyncio.sleep(self.feishu_latency)
+        return web.json_response({"code": 0, "tenant_access_token": self.current_token(), "expire": 7200})
+
+    def current_token(self):
+        return f"stub-token-{self.token_generation}"
+
+    def _reject_token(self, request):
+        """与飞书一致：携带已作废 token 的请求返回 HTTP 400 + 99991663"""
+        if request.headers.get("Authorization") == f"Bearer {self.current_token()}":
+            return None
+        self.calls["rejected"] += 1
+        return web.json_response({"code": 99991663, "msg": "Invalid access token for authorization."}, status=400)
+
+    async def send_message(self, request):
+        body = await request.json()
+        await asyncio.sleep(self._delay(self.feishu_latency))
+        rejected = self._reject_token(request) or self._inject_failure("feishu")
+        if rejected:
+            return rejected
+        self.calls["messages"] += 1
+        self.messages.setdefault(body["receive_id"], []).append((time.time(), body["msg_type"]))
+        return web.json_response({"code": 0, "data": {"message_id": f"om_{self.calls['messages']}"}})
+
+    async def upload_file(self, request):
+        await request.read()
+        await asyncio.sleep(self._delay(self.feishu_latency))
+        rejected = self._reject_token(request) or self._inject_failure("feishu")
+        if rejected:
+            return rejected
+        self.calls["files"] += 1
+        return web.json_response({"code": 0, "data": {"file_key": f"file_stub_{self.calls['files']}"}})
+
+    # --- DeepSeek ---
+
+    async def chat(self, request):
+        body = await request.json()
+        failed = self._inject_failure("llm")
+        if failed:
+            return failed
+        self.calls["chat"] += 1
+        latency = self._delay(self.llm_latency)
+        if not body.get("stream"):
+            await asyncio.sleep(latency)
+            return web.json_response({
+                "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": REPLY_TEXT}}],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 60, "total_tokens": 160},
+            })
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        pieces = [REPLY_TEXT[i:i + 8] for i in range(0, len(REPLY_TEXT), 8)]
+        step = latency / max(len(pieces), 1)
+        for piece in pieces:
+            await asyncio.sleep(step)
+            chunk = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body["model"],
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            await resp.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunk = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body["model"], "choices": [],
+                     "usage": {"prompt_tokens": 100, "completion_tokens": 60, "total_tokens": 160}}
+            await resp.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    # --- 硅基流动 ---
+
+    async def embeddings(self, request):
+        body = await request.json()
+        await asyncio.sleep(self._delay(self.embed_latency))
+        failed = self._inject_failure("embed")
+        if failed:
+            return failed
+        self.calls["embeddings"] += 1
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        return web.json_response({
+            "model": body["model"],
+            "data": [{"index": i, "embedding": stub_vector(t)} for i, t in enumerate(inputs)],
+        })
+
+    # --- 压测控制 ---
+
+    async def stats(self, request):
+        return web.json_response({"calls": self.calls, "failures": self.failures, "messages": self.messages})
+
+    async def do_reset(self, request):
+        self.reset()
+        return web.json_response({})
+
+    async def revoke_token(self, request):
+        """作废当前 token (模拟应用重置密钥)，之后签发新 token"""
+        self.token_generation += 1
+        return web.json_response({"token": self.current_token()})
+
+    def build_app(self):
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_post("/feishu/open-apis/auth/v3/tenant_access_token/internal", self.token)
+        app.router.add_post("/feishu/open-apis/im/v1/messages", self.send_message)
+        app.router.add_post("/feishu/open-apis/im/v1/files", self.upload_file)
+        app.router.add_post("/deepseek/chat/completions", self.chat)
+        app.router.add_post("/siliconflow/v1/embeddings", self.embeddings)
+        app.router.add_get("/_stats", self.stats)
+        app.router.add_post("/_reset", self.do_reset)
+        app.router.add_post("/_revoke_token", self.revoke_token)
+        return app
+
+def upstream_env(port, host="127.0.0.1"):
+    """让被测应用指向替身服务的环境变量"""
+    base = f"http://{host}:{port}"
+    return {
+        "FEISHU_BASE_URL": f"{base}/feishu/open-apis",
+        "DEEPSEEK_BASE_URL": f"{base}/deepseek",
+        "SILICONFLOW_BASE_URL": f"{base}/siliconflow/v1",
+        "FEISHU_APP_ID": "stub-app",
+        "FEISHU_APP_SECRET": "stub-secret",
+        "DEEPSEEK_API_KEY": "stub-key",
+        "SILICONFLOW_API_KEY": "stub-key",
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地上游替身服务")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="DeepSeek 完整回复耗时 (秒)")
+    parser.add_argument("--embed-latency", type=float, default=0.05)
+    parser.add_argument("--feishu-latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.0, help="延迟波动比例，如 0.3 表示 ±30%%")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="故障注入概率")
+    parser.add_argument("--fail-status", type=int, default=503)
+    parser.add_argument("--fail-upstreams", default=",".join(UPSTREAMS), help="注入故障的上游，逗号分隔：feishu,llm,embed")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    stub = StubUpstreams(args.llm_latency, args.embed_latency, args.feishu_latency,
+                         jitter=args.jitter, fail_rate=args.fail_rate, fail_status=args.fail_status,
+                         fail_upstreams=[u for u in args.fail_upstreams.split(",") if u], seed=args.seed)
+    web.run_app(stub.build_app(), host="127.0.0.1", port=args.port, print=None)
@@ -5,6 +5,25 @@ from dotenv import load_dotenv
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 load_dotenv(os.path.join(BASE_DIR, '.env'))
 
+# 对话库默认放在 data/ 下。旧版 README 让用户在 .env 里写 DB_PATH=./AI_banlu_cuncun_memory.db，
+# 但旧版写入方一直忽略该值、实际写的是 data/ 下的库；已有部署升级后不能因此悄悄换成一个空库。
+DEFAULT_DB_PATH = os.path.join(BASE_DIR, "data", "AI_banlu_cuncun_memory.db")
+
+def _resolve_db_path():
+    configured = os.getenv("DB_PATH")
+    if not configured:
+        return DEFAULT_DB_PATH
+    # 相对路径按项目目录解析，与启动时所在的目录无关
+    path = os.path.normpath(configured if os.path.isabs(configured) else os.path.join(BASE_DIR, configured))
+    if path == DEFAULT_DB_PATH or not os.path.exists(DEFAULT_DB_PATH) or os.path.exists(path):
+        return path
+    if os.path.basename(path) == os.path.basename(DEFAULT_DB_PATH):
+        print(f"⚠️ 忽略旧版 .env 中的 DB_PATH={configured}，继续使用已有的对话库 {DEFAULT_DB_PATH}；"
+              f"请删除该配置或把库迁移到新路径后再修改")
+        return DEFAULT_DB_PATH
+    print(f"⚠️ DB_PATH={configured} 指向的库不存在，将新建空库；原对话库仍在 {DEFAULT_DB_PATH}，如需沿用请先迁移")
+    return path
+
 class Config:
     # --- 1. 🔴 飞书平台配置 (必需) ---
     # 用于身份验证和 API 调用
@@ -22,11 +41,16 @@ class Config:
     # 硅基流动 (用于 Embedding 向量化)
     SILICONFLOW_API_KEY = os.getenv("SILICONFLOW_API_KEY")
 
+    # 上游接口地址 (压测时可指向本地替身服务)
+    FEISHU_BASE_URL = os.getenv("FEISHU_BASE_URL", "https://open.feishu.cn/open-apis")
+    DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+    SILICONFLOW_BASE_URL = os.getenv("SILICONFLOW_BASE_URL", "https://api.siliconflow.cn/v1")
+
     # --- 3. 🛣️ 路径配置 (分布式架构) ---
     BASE_DIR = BASE_DIR
     
-    # 核心记忆数据库 (SQLite)
-    DB_PATH = os.getenv("DB_PATH", os.path.join(BASE_DIR, "AI_banlu_cuncun_memory.db"))
+    # 核心记忆数据库 (SQLite)：读写、备份共用这一个解析后的绝对路径
+    DB_PATH = _resolve_db_path()
     
     # 提示词与静态资产
     PROMPT_PATH = os.getenv("PROMPT_PATH", os.path.join(BASE_DIR, "prompt_template.txt"))
@@ -37,12 +61,119 @@ class Config:
     # --- 4. 🛡️ 运维配置 (Phase 1 新增) ---
     # 结构化日志路径
     LOG_FILE = os.getenv("LOG_FILE", os.path.join(BASE_DIR, "logs", "feishu-cuncun.log"))
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    # 异步日志：业务线程只入队，后台线程格式化并写出；队列满时丢弃并计数，不阻塞请求
+    LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() == "true"
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+    # 日志轮转：LOG_ROTATE_WHEN 非空时按时间 (如 midnight)，否则单文件超过 LOG_MAX_MB 时轮转；旧文件 gzip 压缩
+    LOG_MAX_MB = int(os.getenv("LOG_MAX_MB", 50))
+    LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")
+    LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 10))
+    LOG_COMPRESS = os.getenv("LOG_COMPRESS", "true").lower() == "true"
+    # DEBUG 日志 (如逐句语音匹配) 的采样比例与每秒上限，仅在 LOG_LEVEL=DEBUG 时生效
+    LOG_DEBUG_SAMPLE = float(os.getenv("LOG_DEBUG_SAMPLE", 0.1))
+    LOG_DEBUG_PER_SECOND = int(os.getenv("LOG_DEBUG_PER_SECOND", 20))
     
     # 数据库自动备份目录
     BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(BASE_DIR, "backups"))
+    # 备份方式：incremental (按块去重 + gzip) 或 full (整库 gzip)；保留天数；在线备份每步复制的页数与步间让出时间
+    BACKUP_MODE = os.getenv("BACKUP_MODE", "incremental")
+    BACKUP_RETENTION_DAYS = int(os.getenv("BACKUP_RETENTION_DAYS", 7))
+    BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", 256))
+    BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", 0.005))
     
     # 管理员 Open ID (用于接收系统崩溃告警)
     ADMIN_OPEN_ID = os.getenv("ADMIN_OPEN_ID")
     
     # 服务端口
-    SERVER_PORT = int(os.getenv("PORT", 8081))
\ No newline at end of file
+    SERVER_PORT = int(os.getenv("PORT", 8081))
+
+    # --- 5. ⚡ 性能配置 ---
+    # 语音 file_key 内存 LRU 容量 (条)，持久层位于 SQLite 的 voice_file_keys 表
+    FILE_KEY_CACHE_SIZE = int(os.getenv("FILE_KEY_CACHE_SIZE", 512))
+
+    # 语音匹配：批量模式下所有分句一次向量化、一次检索，并在全部分句中取最优
+    VOICE_MATCH_BATCHED = os.getenv("VOICE_MATCH_BATCHED", "true").lower() == "true"
+    # 语音匹配距离阈值，低于该值才视为命中
+    VOICE_MATCH_THRESHOLD = float(os.getenv("VOICE_MATCH_THRESHOLD", 0.48))
+    # 单次 Embedding 请求的最大文本条数
+    EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 32))
+
+    # Embedding 缓存：内存 LRU 条数，以及是否持久化到 SQLite (embedding_cache 表)
+    EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", 4096))
+    EMBED_CACHE_PERSIST = os.getenv("EMBED_CACHE_PERSIST", "true").lower() == "true"
+
+    # 语音检索后端：chroma (默认) 或 numpy (本地内存映射索引，由 voice_index.py --rebuild 生成)
+    VOICE_INDEX_BACKEND = os.getenv("VOICE_INDEX_BACKEND", "chroma").lower()
+    VOICE_INDEX_PATH = os.getenv("VOICE_INDEX_PATH", os.path.join(BASE_DIR, "音频数据", "cuncun_voice_index.npy"))
+
+    # 对话写后日志：消息先入内存队列，由单线程每 JOURNAL_FLUSH_MS 毫秒或攒满 JOURNAL_MAX_BATCH 条时批量提交
+    DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "true").lower() == "true"
+    JOURNAL_FLUSH_MS = int(os.getenv("JOURNAL_FLUSH_MS", 50))
+    JOURNAL_MAX_BATCH = int(os.getenv("JOURNAL_MAX_BATCH", 100))
+
+    # 会话窗口缓存：活跃用户最近 HISTORY_CACHE_TURNS 条对话常驻内存，闲置 HISTORY_CACHE_TTL 秒后淘汰
+    HISTORY_CACHE_ENABLED = os.getenv("HISTORY_CACHE_ENABLED", "true").lower() == "true"
+    HISTORY_CACHE_TURNS = int(os.getenv("HISTORY_CACHE_TURNS", 20))
+    HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", 1800))
+    HISTORY_CACHE_MAX_USERS = int(os.getenv("HISTORY_CACHE_MAX_USERS", 5000))
+    HISTORY_CACHE_MAX_MB = int(os.getenv("HISTORY_CACHE_MAX_MB", 64))
+
+    # 流式回复：边生成边推送，首段在第一个句末 (至少 STREAM_FIRST_MIN_CHARS 字) 即发给用户
+    AI_STREAMING = os.getenv("AI_STREAMING", "true").lower() == "true"
+    STREAM_FIRST_MIN_CHARS = int(os.getenv("STREAM_FIRST_MIN_CHARS", 12))
+    STREAM_SEGMENT_MIN_CHARS = int(os.getenv("STREAM_SEGMENT_MIN_CHARS", 80))
+
+    # 回复后处理流水线：语音阶段与文本发送并行，超过 VOICE_STAGE_DEADLINE 秒则放弃本轮语音
+    PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", 6))
+    VOICE_STAGE_DEADLINE = float(os.getenv("VOICE_STAGE_DEADLINE", 8))
+
+    # 共享 HTTP 连接池：按各线程池并发总和估算连接数，429/5xx 自动指数退避重试
+    HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 16))
+    HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", 4))
+    HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", 2))
+    HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", 0.3))
+    # 上游 Retry-After 的最长等待秒数；上传等重发不安全的 POST 只在连接失败时重试
+    HTTP_RETRY_AFTER_MAX = float(os.getenv("HTTP_RETRY_AFTER_MAX", 5))
+
+    # 异步入口 (feishu_cuncun_async.py)：全局同时处理的对话上限，同一用户始终串行
+    ASYNC_MAX_INFLIGHT = int(os.getenv("ASYNC_MAX_INFLIGHT", 500))
+
+    # 按用户有序调度 (Flask 入口)：工作线程数、全局排队上限、是否合并同一用户连发的消息
+    WORKER_THREADS = int(os.getenv("WORKER_THREADS", 3))
+    MAX_PENDING_MESSAGES = int(os.getenv("MAX_PENDING_MESSAGES", 200))
+    COALESCE_MESSAGES = os.getenv("COALESCE_MESSAGES", "true").lower() == "true"
+    BUSY_NOTICE = os.getenv("BUSY_NOTICE", "[揉了揉太阳穴] 现在找我的人有点多，你等我一小会儿再来好不好？")
+
+    # 事件去重：已处理的 event_id 在内存与 SQLite 中保留 DEDUP_TTL 秒 (飞书重试窗口远小于此)
+    DEDUP_TTL = int(os.getenv("DEDUP_TTL", 86400))
+    DEDUP_MEMORY_SIZE = int(os.getenv("DEDUP_MEMORY_SIZE", 20000))
+    DEDUP_PERSIST = os.getenv("DEDUP_PERSIST", "true").lower() == "true"
+
+    # 飞书 tenant_access_token 剩余有效期不足该秒数时后台续期 (限制在 300 与 1800 之间，飞书只在剩余不足 30 分钟时签发新 token)
+    TOKEN_RENEW_AHEAD = int(os.getenv("TOKEN_RENEW_AHEAD", 600))
+
+    # 上下文组装：系统提示词 + 记忆摘要 + 历史 + 本轮消息的 token 上限，以及最多带入的原文历史条数
+    # (CONTEXT_MAX_MESSAGES 大于 HISTORY_CACHE_TURNS 时读历史会绕过会话窗口缓存)
+    CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 4000))
+    CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", 16))
+    # 长期记忆摘要：原文窗口之外的未摘要消息达到 SUMMARY_TRIGGER 条时后台压缩，摘要不超过 SUMMARY_MAX_CHARS 字
+    SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "true").lower() == "true"
+    SUMMARY_TRIGGER = int(os.getenv("SUMMARY_TRIGGER", 20))
+    SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", 400))
+
+    # 长期记忆检索 (cuncun_bio)：与历史读取并行，超过 MEMORY_DEADLINE 秒直接放弃，注入内容不超过 MEMORY_TOKEN_BUDGET
+    MEMORY_RETRIEVAL_ENABLED = os.getenv("MEMORY_RETRIEVAL_ENABLED", "true").lower() == "true"
+    MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", 4))
+    MEMORY_DEADLINE = float(os.getenv("MEMORY_DEADLINE", 0.8))
+    MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", 500))
+    # 对话事实回写：每轮提取用户的自我表述，每 MEMORY_INDEX_INTERVAL 秒批量向量化写入 cuncun_bio
+    MEMORY_WRITE_ENABLED = os.getenv("MEMORY_WRITE_ENABLED", "true").lower() == "true"
+    MEMORY_INDEX_INTERVAL = int(os.getenv("MEMORY_INDEX_INTERVAL", 60))
+    MEMORY_INDEX_BATCH = int(os.getenv("MEMORY_INDEX_BATCH", 64))
+
+    # 系统提示词热加载：两次检查文件 mtime 的最小间隔 (秒)，文件未变化时不读盘
+    PROMPT_RELOAD_INTERVAL = float(os.getenv("PROMPT_RELOAD_INTERVAL", 2))
+
+    # 服务启动后在后台预热 AI 客户端与向量库；关闭后完全按首次使用加载
+    WARMUP_ON_START = os.getenv("WARMUP_ON_START", "true").lower() == "true"
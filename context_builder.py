@@ -0,0 +1,160 @@
+import re
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from config import Config
+from cuncun_utils import logger, call_ai_summary, submit_traced
+from database_manager import (
+    get_recent_history, get_user_summary, save_user_summary, get_unsummarized_messages
+)
+from memory_retrieval import collect_memories
+
+# --- 按 token 预算组装上下文 ---
+# 系统提示词 + 长期记忆摘要 + 本轮用户消息先占预算，剩余额度从最新一条往前装入原文历史，
+# 装不下的较早对话由后台摘要器滚动压缩进 user_summaries，关系再长，单次请求的体积与耗时也保持平稳。
+
+# DeepSeek 官方换算：1 个中文字符约 0.6 token，1 个英文字符约 0.3 token
+_CJK = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+MESSAGE_OVERHEAD = 4   # 每条消息的角色与分隔符开销
+
+class TokenEstimator:
+    """按字符类别估算 token，并用接口返回的真实 prompt_tokens 持续校准"""
+
+    def __init__(self):
+        self.scale = 1.0
+        self._lock = threading.Lock()
+
+    def raw(self, text):
+        cjk = len(_CJK.findall(text))
+        return cjk * 0.6 + (len(text) - cjk) * 0.3
+
+    def count(self, text):
+        return math.ceil(self.raw(text) * self.scale)
+
+    def count_messages(self, messages):
+        return sum(self.count(m["content"]) + MESSAGE_OVERHEAD for m in messages)
+
+    def calibrate(self, estimated, actual):
+        """estimated 为按当前系数估算的 prompt token，actual 为接口返回值"""
+        if not estimated or not actual:
+            return
+        with self._lock:
+            ratio = actual / (estimated / self.scale)
+            # 指数滑动平均，限制在合理区间，避免个别异常响应带偏
+            self.scale = min(2.0, max(0.5, self.scale * 0.9 + ratio * 0.1))
+
+estimator = TokenEstimator()
+
+def fit_memories(snippets, budget):
+    """按相关度顺序装入记忆片段，直到用完 token 预算"""
+    kept, used = [], 0
+    for snippet in snippets:
+        cost = estimator.count(snippet) + 2
+        if used + cost > budget:
+            break
+        kept.append(snippet)
+        used += cost
+    return kept
+
+def build_context(open_id, system_prompt, user_text, current_texts=(), retrieval=None):
+    """
+    返回 (system_prompt, history, estimated_prompt_tokens)。
+    current_texts 为本轮已存库的用户消息，从历史尾部剔除，避免与 user_text 重复发送；
+    retrieval 为 memory_retrieval.submit_retrieval 返回的 future，读完历史后在其截止时间内取回结果。
+    """
+    summary, _ = get_user_summary(open_id)
+    if summary:
+        system_prompt = f"{system_prompt}\n\n【关于对方的长期记忆】\n{summary}"
+
+    rows = get_recent_history(open_id, limit=Config.CONTEXT_MAX_MESSAGES)
+    pending = list(current_texts)
+    while rows and pending and rows[-1]["role"] == "user" and rows[-1]["content"] == pending[-1]:
+        rows.pop()
+        pending.pop()
+
+    memories = fit_memories(collect_memories(retrieval), Config.MEMORY_TOKEN_BUDGET)
+    if memories:
+        system_prompt += "\n\n【可能相关的记忆】\n" + "\n".join(f"- {m}" for m in memories)
+
+    fixed = estimator.count_messages([
+        {"content": system_prompt}, {"content": user_text}
+    ])
+    budget = Config.CONTEXT_TOKEN_BUDGET - fixed
+    history, used = [], 0
+    for msg in reversed(rows):
+        cost = estimator.count(msg["content"]) + MESSAGE_OVERHEAD
+        if used + cost > budget:
+            break
+        history.append(msg)
+        used += cost
+    history.reverse()
+    # 以助手回复开头的片段缺少上文，丢掉这条，保证历史从用户发言开始
+    if history and history[0]["role"] == "assistant":
+        used -= estimator.count(history.pop(0)["content"]) + MESSAGE_OVERHEAD
+    return system_prompt, history, fixed + used
+
+def record_usage(estimated_tokens, usage):
+    """用真实用量校准估算器，返回应写入 tokens_used 的值 (本轮 prompt + completion)"""
+    if not usage:
+        return 0
+    estimator.calibrate(estimated_tokens, usage.get("prompt_tokens"))
+    return usage.get("total_tokens", 0)
+
+# --- 后台滚动摘要 ---
+# 每轮对话结束后投递一次检查：本轮实际带入上下文的原文之外，未摘要消息攒够 SUMMARY_TRIGGER 条时，
+# 与旧摘要合并成新摘要。边界取自 build_context 真正装入的条数 (预算不足时少于 CONTEXT_MAX_MESSAGES)，
+# 被预算挤掉的较早对话也会进入摘要。单线程执行、同一用户不重复排队，不占用回复链路。
+
+class HistorySummarizer:
+    def __init__(self, keep_recent=16, trigger=20, max_batch=60, max_chars=400):
+        self.keep_recent = keep_recent
+        self.trigger = trigger
+        self.max_batch = max_batch
+        self.max_chars = max_chars
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summarizer")
+        metrics.gauge("executor_queue_depth", fn=lambda: self._executor._work_queue.qsize(), executor="summarizer")
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.failures = 0
+
+    def schedule(self, open_id, keep_recent=None):
+        """keep_recent 为本轮以原文进入上下文的最新消息条数 (含本轮消息与回复)，缺省用 CONTEXT_MAX_MESSAGES"""
+        with self._lock:
+            if open_id in self._inflight:
+                return
+            self._inflight.add(open_id)
+        keep = self.keep_recent if keep_recent is None else min(keep_recent, self.keep_recent)
+        submit_traced(self._executor, self._run, open_id, keep)
+
+    def _run(self, open_id, keep_recent):
+        try:
+            summary, last_id = get_user_summary(open_id)
+            rows = get_unsummarized_messages(open_id, last_id, keep_recent, self.max_batch)
+            if len(rows) < self.trigger:
+                return
+            new_summary = call_ai_summary(summary, [(role, content) for _, role, content in rows], self.max_chars)
+            if not new_summary:
+                self.failures += 1
+                return
+            save_user_summary(open_id, new_summary, rows[-1][0])
+            self.runs += 1
+            logger.info("🧠 长期记忆已更新", extra={"open_id": open_id, "rolled": len(rows), "summary_chars": len(new_summary)})
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"记忆摘要任务失败: {e}")
+        finally:
+            with self._lock:
+                self._inflight.discard(open_id)
+
+    def stats(self):
+        return {"runs": self.runs, "failures": self.failures, "inflight": len(self._inflight),
+                "token_scale": round(estimator.scale, 3)}
+
+summarizer = HistorySummarizer(
+    keep_recent=Config.CONTEXT_MAX_MESSAGES,
+    trigger=Config.SUMMARY_TRIGGER,
+    max_chars=Config.SUMMARY_MAX_CHARS,
+)
@@ -1,35 +1,75 @@
 import os
 import json
 import time
-import requests
+import uuid
 import logging
 import hashlib
 import hmac
 import re
 import base64
-import shutil
-import chromadb
-from openai import OpenAI
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pythonjsonlogger import jsonlogger  #
+import http_client
+import metrics
+import log_pipeline
+from http_client import build_openai_http_client
 from config import Config
+from embedding_cache import embedding_cache, normalize_text
+from voice_index import VoiceIndex
+from database_manager import get_shared_state, set_shared_state
 from Crypto.Cipher import AES
 
 # --- 1. 初始化结构化日志系统 ---
 
+# 链路追踪：每条消息在入口分配一个 trace_id，经调度器与各线程池传递，同一轮处理的日志都带上它
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+
+def new_trace(trace_id=None):
+    """为当前上下文设置 trace_id (默认随机生成) 并返回"""
+    trace_id = trace_id or uuid.uuid4().hex[:16]
+    _trace_id.set(trace_id)
+    return trace_id
+
+def current_trace():
+    return _trace_id.get()
+
+def submit_traced(executor, fn, *args, **kwargs):
+    """提交到线程池并沿用当前上下文，后台阶段的日志也能按 trace_id 串起来"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+class TraceFilter(logging.Filter):
+    # 在产生日志的线程里取 trace_id，格式化放到哪个线程都不受影响
+    def filter(self, record):
+        record.trace_id = _trace_id.get()
+        return True
+
 class CustomJsonFormatter(jsonlogger.JsonFormatter):
-    def add_fields(self, log_record, created, message):
-        super().add_fields(log_record, created, message)
-        log_record['timestamp'] = datetime.now().isoformat()
-        # 修正：直接获取标准 levelname，如果不存在则默认为 INFO
-        log_record['level'] = log_record.get('levelname', 'INFO')
+    def add_fields(self, log_record, record, message_dict):
+        super().add_fields(log_record, record, message_dict)
+        # 时间与级别取自日志记录本身：格式化在后台线程进行，不能用格式化时的当前时间
+        log_record['timestamp'] = datetime.fromtimestamp(record.created).isoformat()
+        log_record['level'] = record.levelname
         log_record['service'] = 'feishu-cuncun-pro'
+        if log_record.get('trace_id') is None:
+            log_record.pop('trace_id', None)
+
+log_queue = None
 
 def setup_logging():
+    global log_queue
     os.makedirs(os.path.dirname(Config.LOG_FILE), exist_ok=True)
     
-    # 文件处理器 (持久化存储)
-    file_handler = logging.FileHandler(Config.LOG_FILE, encoding='utf-8')
+    # 文件处理器 (持久化存储，按大小或时间轮转)
+    file_handler = log_pipeline.build_file_handler(
+        Config.LOG_FILE,
+        max_bytes=Config.LOG_MAX_MB * 1024 * 1024,
+        when=Config.LOG_ROTATE_WHEN,
+        backup_count=Config.LOG_BACKUP_COUNT,
+        compress=Config.LOG_COMPRESS,
+    )
     # 屏幕处理器 (用于 pm2 logs 查看)
     stream_handler = logging.StreamHandler()
     
@@ -40,9 +80,18 @@ def setup_logging():
     
     _logger = logging.getLogger("feishu-utils")
     _logger.handlers = []  # 清空旧处理器，防止重复打印
-    _logger.addHandler(file_handler)
-    _logger.addHandler(stream_handler)
-    _logger.setLevel(logging.INFO)
+    if Config.LOG_ASYNC:
+        log_queue = log_pipeline.LogPipeline([file_handler, stream_handler], maxsize=Config.LOG_QUEUE_SIZE)
+        _logger.addHandler(log_queue.queue_handler)
+        metrics.register_collector("logging", log_queue.stats)
+    else:
+        _logger.addHandler(file_handler)
+        _logger.addHandler(stream_handler)
+    # 过滤器在打日志的线程里执行：先采样 DEBUG，再记下 trace_id
+    _logger.filters = []
+    _logger.addFilter(log_pipeline.DebugSampler(Config.LOG_DEBUG_SAMPLE, Config.LOG_DEBUG_PER_SECOND))
+    _logger.addFilter(TraceFilter())
+    _logger.setLevel(Config.LOG_LEVEL)
     return _logger
 
 logger = setup_logging()
@@ -86,58 +135,301 @@ def verify_signature(request_headers, request_body):
         return False
     # ... 后续的加密比对逻辑 ...
 
-# --- 2. 初始化客户端 ---
-try:
-    client = OpenAI(api_key=Config.DEEPSEEK_KEY, base_url="https://api.deepseek.com")
-except Exception as e:
-    logger.error(f"AI客户端初始化失败: {e}")
-    client = None
-
-# --- 3. 初始化向量库 ---
-voice_collection = None
-bio_collection = None
-try:
+# --- 2. 重量级组件按需加载 ---
+# AI 客户端、语音检索 (NumPy 索引 / Chroma) 与长期记忆库在首次使用时才初始化，线程安全且只初始化一次；
+# 导入本模块、运行脚本或健康检查都不再付出 openai / chromadb 的导入与打开成本。
+# 服务启动后由 start_warm_up 在后台提前加载，首条消息通常不必等待。
+
+class LazyComponent:
+    def __init__(self, name, loader, is_available=None):
+        self.name = name
+        self._loader = loader
+        self._is_available = is_available or (lambda value: value is not None)
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._value = None
+        self.load_ms = None
+
+    def get(self):
+        if self._loaded:
+            return self._value
+        with self._lock:
+            if not self._loaded:
+                start = time.perf_counter()
+                try:
+                    self._value = self._loader()
+                except Exception as e:
+                    logger.warning(f"{self.name}加载失败: {e}")
+                    self._value = None
+                self.load_ms = round((time.perf_counter() - start) * 1000, 1)
+                self._loaded = True
+        return self._value
+
+    def preset(self, value):
+        """尚未加载时直接放入已构建好的对象"""
+        with self._lock:
+            if not self._loaded:
+                self._value, self._loaded, self.load_ms = value, True, 0.0
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def status(self):
+        """只报告状态，不触发加载"""
+        return {
+            "loaded": self._loaded,
+            "available": self._is_available(self._value) if self._loaded else None,
+            "load_ms": self.load_ms,
+        }
+
+def _load_ai_client():
+    from openai import OpenAI
+    return OpenAI(
+        api_key=Config.DEEPSEEK_KEY,
+        base_url=Config.DEEPSEEK_BASE_URL,
+        http_client=build_openai_http_client(),
+        max_retries=Config.HTTP_MAX_RETRIES
+    )
+
+def _load_numpy_index():
+    if Config.VOICE_INDEX_BACKEND != "numpy" or not os.path.exists(Config.VOICE_INDEX_PATH):
+        return None
+    try:
+        index = VoiceIndex.load(Config.VOICE_INDEX_PATH)
+        logger.info(f"🎯 本地语音索引已加载", extra={"voice_count": len(index)})
+        return index
+    except Exception as e:
+        logger.warning(f"本地语音索引加载失败，回退 Chroma: {e}")
+        return None
+
+def _load_voice_search():
+    """返回 (voice_index, voice_collection)，本地 NumPy 索引优先，缺失或加载失败时回退到 Chroma"""
+    index = _load_numpy_index()
+    if index is not None:
+        return index, None
     if os.path.exists(Config.ASSETS_PATH):
+        import chromadb
         client_assets = chromadb.PersistentClient(path=Config.ASSETS_PATH)
-        voice_collection = client_assets.get_collection(name="cuncun_voice")
-    if os.path.exists(Config.MEMORY_PATH):
-        client_memory = chromadb.PersistentClient(path=Config.MEMORY_PATH)
-        bio_collection = client_memory.get_or_create_collection(name="cuncun_bio")
-except Exception as e:
-    logger.warning(f"向量库加载警告: {e}")
+        return None, client_assets.get_collection(name="cuncun_voice")
+    return None, None
+
+def _voice_available(search):
+    return search is not None and any(part is not None for part in search)
+
+def _load_bio_collection():
+    if not os.path.exists(Config.MEMORY_PATH):
+        return None
+    import chromadb
+    client_memory = chromadb.PersistentClient(path=Config.MEMORY_PATH)
+    return client_memory.get_or_create_collection(name="cuncun_bio")
+
+_ai_client = LazyComponent("AI 客户端", _load_ai_client)
+_voice_search = LazyComponent("语音检索库", _load_voice_search, _voice_available)
+_bio_collection = LazyComponent("长期记忆库", _load_bio_collection)
+
+def get_ai_client():
+    return _ai_client.get()
+
+def get_bio_collection():
+    return _bio_collection.get()
+
+def preload_voice_index():
+    """
+    只预加载本地 NumPy 索引 (mmap 只读)。gunicorn preload 时在 master 中调用，
+    fork 后各 worker 共享同一份页缓存；Chroma 客户端不能跨 fork，仍在 worker 内首次使用时打开。
+    """
+    index = _load_numpy_index()
+    if index is not None:
+        _voice_search.preset((index, None))
+    return index is not None
+
+def component_status():
+    return {
+        "ai": _ai_client.status(),
+        "voice_db": _voice_search.status(),
+        "memory_db": _bio_collection.status(),
+    }
+
+def warm_up():
+    """依次加载全部重量级组件"""
+    start = time.perf_counter()
+    for component in (_ai_client, _voice_search, _bio_collection):
+        component.get()
+    logger.info("🔥 组件预热完成", extra={"duration_ms": round((time.perf_counter() - start) * 1000, 1),
+                                       "components": component_status()})
+
+def start_warm_up():
+    """服务开始监听后在后台预热 (WARMUP_ON_START=false 时完全按需加载)"""
+    if Config.WARMUP_ON_START:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
 
 # --- 核心功能函数 ---
 
-_token_cache = {"token": None, "expires_at": 0}
+# --- 飞书 tenant_access_token ---
+# 单飞刷新：同一进程内同时只有一个线程请求飞书接口，其余线程等待它的结果；
+# 剩余有效期不足 TOKEN_RENEW_AHEAD 秒时先返回旧 token、由后台线程续期，只有剩余不足 300 秒才阻塞等待。
+# 新 token 写入 shared_state 供其他 worker 复用；接口返回 token 失效错误码时作废并重新获取。
 
-def get_token():
-    """获取 Token (带缓存)"""
-    current_time = time.time()
-    if _token_cache["token"] and current_time < _token_cache["expires_at"] - 300:
-        return _token_cache["token"]
-    
-    url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal"
-    try:
-        r = requests.post(url, json={
-            "app_id": Config.FEISHU_APP_ID, 
-            "app_secret": Config.FEISHU_APP_SECRET
-        }, timeout=10)
-        data = r.json()
-        token = data.get("tenant_access_token")
-        if token:
-            _token_cache["token"] = token
-            _token_cache["expires_at"] = current_time + data.get("expire", 7200)
+TOKEN_STATE_KEY = "feishu_tenant_access_token"
+TOKEN_EXPIRY_MARGIN = 300
+TOKEN_RENEW_AHEAD_MAX = 1800   # 飞书只在剩余不足 30 分钟时签发新 token，更早续期只会拿回同一个
+INVALID_TOKEN_CODES = {99991661, 99991663, 99991668, 99991677}
+
+@metrics.timed("feishu_token")
+def _fetch_tenant_token():
+    """向飞书申请 tenant_access_token，返回 (token, 剩余秒数)"""
+    r = http_client.post(f"{Config.FEISHU_BASE_URL}/auth/v3/tenant_access_token/internal", json={
+        "app_id": Config.FEISHU_APP_ID,
+        "app_secret": Config.FEISHU_APP_SECRET
+    }, timeout=10)
+    data = r.json()
+    if not data.get("tenant_access_token"):
+        raise RuntimeError(f"code={data.get('code')} msg={data.get('msg')}")
+    return data["tenant_access_token"], data.get("expire", 7200)
+
+class TenantTokenManager:
+    def __init__(self, fetcher, margin=TOKEN_EXPIRY_MARGIN, renew_ahead=600):
+        self._fetcher = fetcher
+        self.margin = margin
+        self.renew_ahead = min(max(renew_ahead, margin), TOKEN_RENEW_AHEAD_MAX)
+        if self.renew_ahead != renew_ahead:
+            logger.warning(f"TOKEN_RENEW_AHEAD={renew_ahead} 超出 {margin}~{TOKEN_RENEW_AHEAD_MAX} 秒，按 {self.renew_ahead} 秒处理")
+        self._token = None
+        self._expires_at = 0
+        self._revoked = None
+        self._lock = threading.Lock()
+        self._inflight = None       # 进行中的刷新 (threading.Event)
+        self._retry_after = 0       # 后台续期失败后的退避截止时间
+        self._renewer = None
+        self.refreshes = 0          # 实际请求飞书接口的次数
+        self.shared_hits = 0        # 从 shared_state 复用其他 worker 的 token
+        self.failures = 0
+        self.invalidations = 0
+        self.waits = 0
+
+    def _reset_after_fork(self):
+        # 锁和后台线程不跨进程，已拿到的 token 仍可继续使用
+        self._lock = threading.Lock()
+        self._inflight = None
+        self._renewer = None
+
+    def get(self, block=True):
+        """返回有效 token；需要同步刷新时 block=False 直接返回 None，获取失败也返回 None"""
+        now = time.time()
+        token, expires_at = self._token, self._expires_at
+        if token and now < expires_at - self.margin:
+            if now >= max(expires_at - self.renew_ahead, self._retry_after) and self._inflight is None:
+                threading.Thread(target=self.refresh, name="token-refresh", daemon=True).start()
             return token
-    except Exception as e:
-        logger.error(f"Token获取异常: {e}")
-    return None
+        return self.refresh() if block else None
+
+    def _valid_token(self):
+        if self._token and time.time() < self._expires_at - self.margin:
+            return self._token
+        return None
+
+    def refresh(self):
+        """单飞刷新：已有刷新在进行时等待其完成，返回刷新后的有效 token"""
+        with self._lock:
+            event = self._inflight
+            leader = event is None
+            if leader:
+                event = self._inflight = threading.Event()
+        if not leader:
+            start = time.perf_counter()
+            event.wait(timeout=15)
+            self.waits += 1
+            metrics.histogram("token_wait_seconds").observe(time.perf_counter() - start)
+            return self._valid_token()
+        try:
+            self._refresh()
+        finally:
+            with self._lock:
+                self._inflight = None
+            event.set()
+        return self._valid_token()
+
+    def _refresh(self):
+        now = time.time()
+        if self._token and now < self._expires_at - self.renew_ahead:
+            return  # 排队期间已被刷新
+        # 多 worker 部署时优先复用其他进程刚取到的 token (已作废的那个除外)
+        shared = get_shared_state(TOKEN_STATE_KEY, now=now + self.renew_ahead)
+        if shared:
+            token, expires_at = json.loads(shared)
+            if token != self._revoked:
+                self._token, self._expires_at = token, expires_at
+                self.shared_hits += 1
+                return
+        start = time.perf_counter()
+        try:
+            token, expire = self._fetcher()
+        except Exception as e:
+            self.failures += 1
+            self._retry_after = time.time() + 10
+            logger.error(f"Token获取异常: {e}")
+            return
+        finally:
+            metrics.histogram("token_refresh_seconds").observe(time.perf_counter() - start)
+        self._token, self._expires_at = token, now + expire
+        self._revoked = None
+        self.refreshes += 1
+        set_shared_state(TOKEN_STATE_KEY, json.dumps([token, self._expires_at]), self._expires_at)
+        logger.info("🔑 tenant_access_token 已刷新", extra={"expires_in": expire})
+
+    def invalidate(self, token):
+        """飞书返回 token 失效错误码时调用，下一次 get 会重新获取"""
+        with self._lock:
+            if token != self._token:
+                return  # 已被其他线程换掉
+            self._expires_at = 0
+            self._revoked = token
+        self.invalidations += 1
+        logger.warning("🔑 tenant_access_token 已失效，重新获取")
+
+    def _renew_loop(self):
+        while True:
+            wait = self._expires_at - self.renew_ahead - time.time() if self._token else 0
+            time.sleep(max(wait, 30))
+            self.refresh()
+
+    def start_renewal(self):
+        """启动后台续期线程 (每个进程一个)，空闲期间 token 也不会过期"""
+        if self._renewer is None:
+            self._renewer = threading.Thread(target=self._renew_loop, name="token-renewal", daemon=True)
+            self._renewer.start()
 
-def upload_audio_v2(file_path):
+    def stats(self):
+        wait = metrics.histogram("token_wait_seconds").snapshot()
+        return {
+            "valid": self._valid_token() is not None,
+            "expires_in": max(int(self._expires_at - time.time()), 0) if self._token else None,
+            "refreshes": self.refreshes,
+            "shared_hits": self.shared_hits,
+            "failures": self.failures,
+            "invalidations": self.invalidations,
+            "waits": self.waits,
+            "wait_seconds": wait["sum"],
+            "refresh_p95": metrics.histogram("token_refresh_seconds").quantile(0.95),
+        }
+
+token_manager = TenantTokenManager(_fetch_tenant_token, renew_ahead=Config.TOKEN_RENEW_AHEAD)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=token_manager._reset_after_fork)
+
+def get_token():
+    """获取 Token (进程内缓存 -> SQLite 共享缓存 -> 飞书接口)"""
+    return token_manager.get()
+
+@metrics.timed("feishu_upload")
+def upload_audio_v2(file_path, _retry=True):
     """协议逆向版：使用 'file' 字段名"""
     token = get_token()
     if not token or not os.path.exists(file_path): return None
     
-    url = "https://open.feishu.cn/open-apis/im/v1/files"
+    url = f"{Config.FEISHU_BASE_URL}/im/v1/files"
     headers = {"Authorization": f"Bearer {token}"}
     filename = os.path.basename(file_path)
     
@@ -148,51 +440,124 @@ def upload_audio_v2(file_path):
                 'file_name': (None, filename),
                 'file': (filename, f.read(), 'application/octet-stream')
             }
-            r = requests.post(url, headers=headers, files=files, timeout=20)
+            # 上传没有去重键，读超时/5xx 后重发会在飞书侧生成重复文件，只允许连接失败时重试
+            r = http_client.post(url, headers=headers, files=files, timeout=20, idempotent=False)
             res = r.json()
+            if res.get("code") in INVALID_TOKEN_CODES and _retry:
+                token_manager.invalidate(token)
+                return upload_audio_v2(file_path, _retry=False)
             if res.get("code") == 0:
                 logger.info(f"✅ 上传成功 Key: {res['data']['file_key']}")
                 return res['data']['file_key']
             else:
+                metrics.counter("upstream_errors_total", upstream="feishu").inc()
                 logger.error(f"❌ 上传失败: {res}")
                 return None
     except Exception as e:
+        metrics.counter("upstream_errors_total", upstream="feishu").inc()
         logger.error(f"上传异常: {e}")
         return None
 
-def send_feishu(receive_id, msg_type, content):
+@metrics.timed("feishu_send")
+def send_feishu(receive_id, msg_type, content, _retry=True):
     """通用发送函数"""
     token = get_token()
     if not token: return False
-    url = "https://open.feishu.cn/open-apis/im/v1/messages?receive_id_type=open_id"
+    url = f"{Config.FEISHU_BASE_URL}/im/v1/messages?receive_id_type=open_id"
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
     try:
-        r = requests.post(url, headers=headers, json={
+        r = http_client.post(url, headers=headers, json={
             "receive_id": receive_id,
             "msg_type": msg_type,
-            "content": json.dumps(content)
+            "content": json.dumps(content),
+            # 幂等键：连接池自动重试时飞书按 uuid 去重，不会重复发送
+            "uuid": uuid.uuid4().hex
         }, timeout=10)
-        return r.json().get("code") == 0
+        code = r.json().get("code")
+        if code in INVALID_TOKEN_CODES and _retry:
+            # token 被提前作废 (如应用重置了密钥)：请求未被受理，换新 token 后重发一次
+            token_manager.invalidate(token)
+            return send_feishu(receive_id, msg_type, content, _retry=False)
+        if code != 0:
+            metrics.counter("upstream_errors_total", upstream="feishu").inc()
+        return code == 0
     except Exception as e:
+        metrics.counter("upstream_errors_total", upstream="feishu").inc()
         logger.error(f"发送飞书消息失败: {e}")
         return False
 
+EMBEDDING_URL = f"{Config.SILICONFLOW_BASE_URL}/embeddings"
+EMBEDDING_MODEL = "BAAI/bge-large-zh-v1.5"
+
 def get_embedding(text):
     if not Config.SILICONFLOW_API_KEY: return None
+    text = normalize_text(text)
+    cached = embedding_cache.get_many(EMBEDDING_MODEL, [text])[0]
+    if cached:
+        return cached
     try:
-        url = "https://api.siliconflow.cn/v1/embeddings"
         headers = {"Authorization": f"Bearer {Config.SILICONFLOW_API_KEY}", "Content-Type": "application/json"}
-        r = requests.post(url, json={"model": "BAAI/bge-large-zh-v1.5", "input": text}, headers=headers, timeout=10)
-        return r.json()["data"][0]["embedding"] if r.status_code == 200 else None
+        with metrics.timed("siliconflow_embed"):
+            r = http_client.post(EMBEDDING_URL, json={"model": EMBEDDING_MODEL, "input": text}, headers=headers, timeout=10)
+        vec = r.json()["data"][0]["embedding"] if r.status_code == 200 else None
+        if vec:
+            embedding_cache.put_many(EMBEDDING_MODEL, [text], [vec])
+        return vec
     except Exception as e:
+        metrics.counter("upstream_errors_total", upstream="siliconflow").inc()
         logger.error(f"向量获取失败: {e}")
         return None
-        
+
+@metrics.timed("siliconflow_embed")
+def _request_embeddings(texts):
+    """单次请求批量向量化，返回与 texts 顺序一致的列表 (失败为 None)"""
+    try:
+        headers = {"Authorization": f"Bearer {Config.SILICONFLOW_API_KEY}", "Content-Type": "application/json"}
+        r = http_client.post(EMBEDDING_URL, json={"model": EMBEDDING_MODEL, "input": texts}, headers=headers, timeout=15)
+        if r.status_code != 200:
+            metrics.counter("upstream_errors_total", upstream="siliconflow").inc()
+            logger.error(f"批量向量获取失败: HTTP {r.status_code}")
+            return [None] * len(texts)
+        vectors = [None] * len(texts)
+        for item in r.json()["data"]:
+            vectors[item.get("index", 0)] = item["embedding"]
+        return vectors
+    except Exception as e:
+        metrics.counter("upstream_errors_total", upstream="siliconflow").inc()
+        logger.error(f"批量向量获取失败: {e}")
+        return [None] * len(texts)
+
+def get_embeddings(texts, cache=True):
+    """
+    批量向量化：先查缓存，只把未命中的文本按 EMBED_BATCH_SIZE 分片请求，多片时并行。
+    cache=False 用于一次性文本 (如记忆检索的用户消息)：直接请求，不读也不写缓存，
+    避免挤掉 LRU 里的口头禅/语音台词，也不让 embedding_cache 表随消息数无限增长。
+    """
+    if not Config.SILICONFLOW_API_KEY or not texts: return [None] * len(texts)
+    texts = [normalize_text(t) for t in texts]
+    vectors = embedding_cache.get_many(EMBEDDING_MODEL, texts) if cache else [None] * len(texts)
+
+    # 同一文本只请求一次
+    pending = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+    if not pending:
+        return vectors
+
+    size = Config.EMBED_BATCH_SIZE
+    chunks = [pending[i:i + size] for i in range(0, len(pending), size)]
+    if len(chunks) == 1:
+        fetched = _request_embeddings(chunks[0])
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(chunks), 4)) as pool:
+            fetched = [vec for chunk in pool.map(_request_embeddings, chunks) for vec in chunk]
+    if cache:
+        embedding_cache.put_many(EMBEDDING_MODEL, pending, fetched)
+
+    by_text = dict(zip(pending, fetched))
+    return [v if v is not None else by_text.get(t) for t, v in zip(texts, vectors)]
+
 # --- 最终优化后的语音匹配逻辑 ---
-def match_voice_file(text):
-    if not voice_collection: 
-        return None
-    
+def split_sentences(text):
+    """清洗动作描写并切分为待匹配的短句"""
     # 1. 彻底清洗文本：去掉所有形式的动作标签和旁白
     # 覆盖：[ ] , ( ) , （ ）, 【 】
     clean_text = re.sub(r"\[.*?\]|（.*?）|\(.*?\)|【.*?】", "", text).strip()
@@ -201,14 +566,58 @@ def match_voice_file(text):
     # 这样可以避免把“哈？你那些设计稿...” 这种长句直接送去匹配
     sentences = re.split(r'[。！？！?，,；; \n]|[.]{2,}', clean_text)
     # 过滤掉空格和长度小于 2 的片段（如“哈”、“嗯”），除非库里有很多这种短音
-    sentences = [s.strip() for s in sentences if len(s.strip()) > 1] 
-    
+    return [s.strip() for s in sentences if len(s.strip()) > 1] 
+
+def voice_search_ready():
+    """语音检索是否可用 (本地索引或 Chroma 任一加载成功；首次调用时加载)"""
+    return _voice_available(_voice_search.get())
+
+@metrics.timed("voice_search")
+def nearest_voices(vectors):
+    """批量最近邻检索，返回 [(distance, filename) 或 None, ...]"""
+    voice_index, voice_collection = _voice_search.get()
+    if voice_index is not None:
+        return voice_index.query(vectors)
+    res = voice_collection.query(query_embeddings=vectors, n_results=1)
+    results = []
+    for i in range(len(vectors)):
+        if res["distances"] and res["distances"][i]:
+            results.append((res["distances"][i][0], res["metadatas"][i][0]["filename"]))
+        else:
+            results.append(None)
+    return results
+
+@metrics.timed("voice_match")
+def match_voice_file(text, timings=None):
+    """
+    语音匹配入口。
+    timings: 可选 dict，会被填入各阶段耗时 (毫秒)，便于定位慢在哪一步。
+    """
+    if not voice_search_ready(): 
+        return None
+
+    t0 = time.perf_counter()
+    sentences = split_sentences(text)
     if not sentences:
         logger.warning(f"⚠️ 清洗后无有效分句: {text[:20]}...")
         return None
 
-    logger.info(f"🔍 开启分句检索，片段总数: {len(sentences)}")
+    logger.debug("🔍 开启分句检索，片段总数: %d", len(sentences))
+    stages = {"split_ms": round((time.perf_counter() - t0) * 1000, 2)}
+
+    if Config.VOICE_MATCH_BATCHED:
+        path = _match_voice_batched(sentences, stages)
+    else:
+        path = _match_voice_serial(sentences)
 
+    stages["total_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+    if timings is not None:
+        timings.update(stages)
+    logger.info("语音匹配耗时", extra={"voice_timings": stages, "batched": Config.VOICE_MATCH_BATCHED})
+    return path
+
+def _match_voice_serial(sentences):
+    """逐句匹配：按顺序返回第一个达标的片段"""
     try:
         for sentence in sentences:
             # 这里的 get_embedding 建议使用你现有的 768 维模型
@@ -216,19 +625,18 @@ def match_voice_file(text):
             if not vec: continue
             
             # 3. 搜索最匹配的 1 条结果
-            res = voice_collection.query(query_embeddings=[vec], n_results=1)
+            nearest = nearest_voices([vec])[0]
             
-            if res["distances"] and len(res["distances"][0]) > 0:
-                distance = res["distances"][0][0]
+            if nearest:
+                distance, matched_filename = nearest
                 
                 # 4. 阈值设定为 0.48
                 # 日志显示你的成功案例在 0.41 附近，0.4 能大幅提升“设计稿”这类句子的匹配可能
-                if distance < 0.48: 
-                    matched_filename = res["metadatas"][0][0]["filename"]
+                if distance < Config.VOICE_MATCH_THRESHOLD: 
                     logger.info(f"✨ 匹配命中! [{sentence}] -> {matched_filename} (距离: {distance:.4f})")
                     return os.path.join(Config.VOICE_LIB, matched_filename)
                 else:
-                    logger.info(f"⏭️ 片段 [{sentence}] 最接近距离为 {distance:.4f}，未达标")
+                    logger.debug("⏭️ 片段 [%s] 最接近距离为 %.4f，未达标", sentence, distance)
                 
         logger.warning("❌ 所有分句均匹配失败")
         
@@ -237,7 +645,53 @@ def match_voice_file(text):
         
     return None
 
-def call_ai(system_prompt, user_text, history=[]):
+def _match_voice_batched(sentences, stages):
+    """批量匹配：一次向量化 + 一次检索，在所有分句中挑选距离最小的片段"""
+    try:
+        t = time.perf_counter()
+        vectors = get_embeddings(sentences)
+        stages["embed_ms"] = round((time.perf_counter() - t) * 1000, 2)
+
+        pairs = [(s, v) for s, v in zip(sentences, vectors) if v]
+        if not pairs:
+            logger.warning("❌ 分句向量化全部失败")
+            return None
+
+        t = time.perf_counter()
+        nearest = nearest_voices([v for _, v in pairs])
+        stages["query_ms"] = round((time.perf_counter() - t) * 1000, 2)
+
+        best = None
+        for (sentence, _), hit in zip(pairs, nearest):
+            if hit:
+                logger.debug("⏭️ 片段 [%s] 最接近距离为 %.4f", sentence, hit[0])
+            if hit and (best is None or hit[0] < best[0]):
+                best = (hit[0], sentence, hit[1])
+
+        if best and best[0] < Config.VOICE_MATCH_THRESHOLD:
+            distance, sentence, matched_filename = best
+            logger.info(f"✨ 匹配命中! [{sentence}] -> {matched_filename} (距离: {distance:.4f})")
+            return os.path.join(Config.VOICE_LIB, matched_filename)
+
+        if best:
+            logger.warning(f"❌ 所有分句均匹配失败，最接近距离为 {best[0]:.4f}")
+        else:
+            logger.warning("❌ 所有分句均匹配失败")
+    except Exception as e:
+        logger.error(f"语音匹配过程发生异常: {e}", exc_info=True)
+
+    return None
+
+def copy_usage(usage, res_usage):
+    # 把接口返回的真实 token 用量写入调用方传入的 usage 字典
+    if usage is not None and res_usage is not None:
+        usage["prompt_tokens"] = res_usage.prompt_tokens
+        usage["completion_tokens"] = res_usage.completion_tokens
+        usage["total_tokens"] = res_usage.total_tokens
+
+@metrics.timed("deepseek_chat")
+def call_ai(system_prompt, user_text, history=[], usage=None):
+    client = get_ai_client()
     if not client: return "AI 未连接"
     try:
         start_time = time.time()
@@ -250,12 +704,140 @@ def call_ai(system_prompt, user_text, history=[]):
             frequency_penalty=0.5
         )
         duration = time.time() - start_time
-        logger.info(f"AI 响应成功", extra={"duration": round(duration, 2)}) #
+        copy_usage(usage, res.usage)
+        logger.info(f"AI 响应成功", extra={"duration": round(duration, 2), "usage": usage}) #
         return res.choices[0].message.content
     except Exception as e:
+        metrics.counter("upstream_errors_total", upstream="deepseek").inc()
         logger.error(f"AI 错误: {e}")
         return "我有点累了，稍等一下。"
 
+SUMMARY_PROMPT = (
+    "你负责为存存整理与对方的长期记忆。请把【已有记忆】与【新的对话】合并成一段第三人称的记忆摘要，"
+    "保留对方的身份信息、喜好、重要经历、约定与情绪变化，以及两人关系的进展；"
+    "去掉寒暄和重复内容，不要编造，不超过 {max_chars} 字，直接输出摘要正文。"
+)
+
+@metrics.timed("deepseek_summary")
+def call_ai_summary(previous_summary, turns, max_chars=400):
+    """把已有摘要与一批较早的对话 [(role, content)] 合并成新的摘要，失败返回 None"""
+    client = get_ai_client()
+    if not client: return None
+    names = {"user": "对方", "assistant": "存存"}
+    dialogue = "\n".join(f"{names.get(role, role)}：{content}" for role, content in turns)
+    try:
+        res = client.chat.completions.create(
+            model="deepseek-chat",
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT.format(max_chars=max_chars)},
+                {"role": "user", "content": f"【已有记忆】\n{previous_summary or '（暂无）'}\n\n【新的对话】\n{dialogue}"},
+            ],
+            temperature=0.3,
+            max_tokens=1024,
+        )
+        return (res.choices[0].message.content or "").strip() or None
+    except Exception as e:
+        metrics.counter("upstream_errors_total", upstream="deepseek").inc()
+        logger.error(f"记忆摘要生成失败: {e}")
+        return None
+
+# 首段在第一个句末 (或段落结束) 就推送，之后凑够 STREAM_SEGMENT_MIN_CHARS 字再按段落推送，避免消息刷屏
+_PARAGRAPH_BREAK = re.compile(r"\n+")
+_SENTENCE_END = re.compile(r"[。！？!?…~]+[”」』]?")
+
+def next_stream_segment(buffer, first):
+    """从缓冲区切出一个可推送的段落，返回 (segment, rest)；不足一段时 segment 为 None"""
+    stripped = buffer.lstrip()
+    if first:
+        matches = [m for m in (
+            _PARAGRAPH_BREAK.search(stripped),
+            _SENTENCE_END.search(stripped, Config.STREAM_FIRST_MIN_CHARS - 1),
+        ) if m]
+        if matches:
+            m = min(matches, key=lambda m: m.end())
+            return stripped[:m.end()].strip(), stripped[m.end():]
+    else:
+        m = _PARAGRAPH_BREAK.search(stripped, Config.STREAM_SEGMENT_MIN_CHARS)
+        if m:
+            return stripped[:m.start()].strip(), stripped[m.end():]
+    return None, buffer
+
+@metrics.timed("deepseek_stream")
+def call_ai_stream(system_prompt, user_text, history=[], on_segment=None, usage=None):
+    """
+    流式调用 DeepSeek：首句/首段生成完立刻回调 on_segment(text)，之后每完成一个段落回调一次。
+    返回完整回复文本；传入 usage 字典时写入流末尾返回的真实 token 用量。
+    """
+    client = get_ai_client()
+    if not client:
+        if on_segment: on_segment("AI 未连接")
+        return "AI 未连接"
+
+    start_time = time.time()
+    first_token_at = None
+    parts, buffer, emitted = [], "", 0
+    try:
+        stream = client.chat.completions.create(
+            model="deepseek-chat",
+            messages=[{"role": "system", "content": system_prompt}] + history + [{"role": "user", "content": user_text}],
+            temperature=0.9,
+            max_tokens=2048,
+            presence_penalty=0.6,
+            frequency_penalty=0.5,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        for chunk in stream:
+            if getattr(chunk, "usage", None):
+                copy_usage(usage, chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if first_token_at is None:
+                first_token_at = time.time()
+                metrics.histogram("ai_first_token_seconds").observe(first_token_at - start_time)
+            parts.append(delta)
+            buffer += delta
+            while True:
+                segment, buffer = next_stream_segment(buffer, first=emitted == 0)
+                if segment is None:
+                    break
+                emitted += 1
+                if on_segment: on_segment(segment)
+    except Exception as e:
+        metrics.counter("upstream_errors_total", upstream="deepseek").inc()
+        logger.error(f"AI 流式错误: {e}")
+        if not parts:
+            if on_segment: on_segment("我有点累了，稍等一下。")
+            return "我有点累了，稍等一下。"
+
+    if buffer.strip():
+        emitted += 1
+        if on_segment: on_segment(buffer.strip())
+
+    logger.info(f"AI 流式响应完成", extra={
+        "duration": round(time.time() - start_time, 2),
+        "ttft": round(first_token_at - start_time, 2) if first_token_at else None,
+        "segments": emitted,
+        "usage": usage
+    })
+    return "".join(parts).strip()
+
+_prefetch_pool = ThreadPoolExecutor(max_workers=2)
+# ThreadPoolExecutor 没有公开排队数，读取其内部队列长度
+metrics.gauge("executor_queue_depth", fn=lambda: _prefetch_pool._work_queue.qsize(), executor="voice_prefetch")
+
+def prefetch_voice_embeddings(text):
+    """在回复仍在生成时提前向量化已完成的句子，最终语音匹配直接命中缓存"""
+    if not voice_search_ready():
+        return None
+    sentences = split_sentences(text)
+    if not sentences:
+        return None
+    return submit_traced(_prefetch_pool, get_embeddings, sentences)
+
 # --- 运维功能 ---
 
 def check_health():
@@ -263,37 +845,21 @@ def check_health():
     health_data = {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
+        # 组件只报告是否已加载/可用，健康检查本身不会触发加载
         "components": {
-            "ai": client is not None,
-            "voice_db": voice_collection is not None,
+            **component_status(),
             "feishu_api": get_token() is not None
-        }
+        },
+        "feishu_token": token_manager.stats(),
+        "caches": {
+            "embedding": embedding_cache.stats()
+        },
+        "http": http_client.host_latency_stats(),
+        "logging": log_queue.stats() if log_queue else None
     }
     logger.info("执行健康检查", extra={"health_data": health_data})
     return health_data
 
-def backup_database_task():
-    """数据库备份"""
-    try:
-        if not os.path.exists(Config.BACKUP_DIR):
-            os.makedirs(Config.BACKUP_DIR, exist_ok=True)
-        
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_path = os.path.join(Config.BACKUP_DIR, f"backup_{timestamp}.db")
-        
-        shutil.copy2(Config.DB_PATH, backup_path)
-        logger.info(f"💾 数据库备份成功", extra={"backup_file": os.path.basename(backup_path)})
-        
-        # 清理旧备份 (保留7天)
-        retention = time.time() - (7 * 86400)
-        for f in os.listdir(Config.BACKUP_DIR):
-            fp = os.path.join(Config.BACKUP_DIR, f)
-            if os.path.getmtime(fp) < retention:
-                os.remove(fp)
-                logger.info(f"清理过期备份", extra={"removed_file": f})
-    except Exception as e:
-        logger.error(f"备份失败: {e}")
-
 class AESCipher:
     def __init__(self, key):
         self.key = hashlib.sha256(key.encode('utf-8')).digest()
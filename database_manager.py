@@ -1,75 +1,687 @@
 import sqlite3
 import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime
 
-# 获取当前文件所在的文件夹路径
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+import metrics
+from config import Config
+from memory_cache import LRUCache
 
-# 动态组合路径：无论在 Windows、Linux 还是 root 目录下运行，都能准确找到 data 文件夹
-DB_PATH = os.path.join(BASE_DIR, "data", "AI_banlu_cuncun_memory.db")
+# 日志 handler 由 cuncun_utils.setup_logging 挂到同名 logger 上 (cuncun_utils 依赖本模块，不能反向导入)
+logger = logging.getLogger("feishu-utils")
+
+# 数据库路径统一取自 Config.DB_PATH (默认 data/ 目录)，备份任务与写入方使用同一个文件；
+# 显式设置 DB_PATH 时以其为准 (压测/多实例隔离)，旧版 .env 遗留的值见 config._resolve_db_path
+DB_PATH = Config.DB_PATH
 
 # 确保文件夹存在
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
+# --- 连接管理 ---
+# 每个工作线程复用一条长连接 (线程池 worker 不再反复 open/close)，
+# WAL 模式下读写互不阻塞，synchronous=NORMAL 省去每次提交的 fsync
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=10000",
+    "PRAGMA cache_size=-8000",       # 约 8MB 页缓存
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=67108864",     # 64MB 内存映射读
+)
+
+_local = threading.local()
+_all_connections = {}  # thread -> connection
+_connections_lock = threading.Lock()
+
+def _reset_after_fork():
+    # gunicorn preload 时 master 打开的连接会被 fork 进 worker，SQLite 连接不能跨进程共用：
+    # 子进程丢弃继承来的连接 (不 close，以免影响父进程)，之后按需重新打开
+    global _local, _connections_lock
+    _local = threading.local()
+    _connections_lock = threading.Lock()
+    _all_connections.clear()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _open_connection():
+    conn = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    with _connections_lock:
+        # 顺手回收已退出线程遗留的连接，避免临时线程池造成泄漏
+        for thread in [t for t in _all_connections if not t.is_alive()]:
+            _all_connections.pop(thread).close()
+        _all_connections[threading.current_thread()] = conn
+    return conn
+
 def get_db_connection():
-    """创建一个通用的数据库连接，设置超时时间防止多线程竞争锁"""
-    return sqlite3.connect(DB_PATH, timeout=10)
+    """获取当前线程复用的数据库连接 (调用方不要 close)"""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = _open_connection()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+@contextmanager
+def transaction():
+    """在当前线程连接上开启一个事务：正常退出提交，异常回滚"""
+    conn = get_db_connection()
+    with conn:
+        yield conn.cursor()
 
 def init_db():
     """初始化数据库，支持多用户隔离"""
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    # 核心字段：user_id (open_id) 确保存存不会‘记错仇’
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chat_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            role TEXT CHECK(role IN ('user', 'assistant')), 
-            content TEXT NOT NULL,
-            tokens_used INTEGER DEFAULT 0
+
+    with transaction() as cursor:
+        # 核心字段：user_id (open_id) 确保存存不会‘记错仇’
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                role TEXT CHECK(role IN ('user', 'assistant')),
+                content TEXT NOT NULL,
+                tokens_used INTEGER DEFAULT 0
+            )
+        ''')
+        # 复合索引：按用户倒序取最近 N 条时走索引，表再大也是 O(log n)
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_chat_history_user_id ON chat_history(user_id, id)"
+        )
+        # 旧库迁移：助手回复所用的提示词版本 (模板内容哈希)，用于人设 A/B 分析
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(chat_history)")}
+        if "prompt_version" not in columns:
+            cursor.execute("ALTER TABLE chat_history ADD COLUMN prompt_version TEXT")
+        # 语音文件 file_key 缓存：按文件内容哈希索引，避免重复上传同一段 .opus
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS voice_file_keys (
+                content_hash TEXT PRIMARY KEY,
+                file_key TEXT NOT NULL,
+                filename TEXT,
+                file_size INTEGER,
+                uploaded_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Embedding 持久缓存：cache_key = sha1(模型 + 规范化文本)，向量以 float32 BLOB 存储
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                cache_key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # 事件去重表：记录已处理的飞书 event_id，跨进程、跨重启共享，按 TTL 清理
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS processed_events (
+                event_id TEXT PRIMARY KEY,
+                seen_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_processed_events_seen_at ON processed_events(seen_at)"
         )
-    ''')
-    conn.commit()
-    conn.close()
+        # 用户长期记忆摘要：较早的对话由后台滚动压缩成一段摘要，last_message_id 之前的消息均已纳入
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_summaries (
+                user_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                last_message_id INTEGER NOT NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # 待写入 cuncun_bio 向量库的对话事实：各 worker 只写这张表，由持有调度器锁的进程批量向量化后入库
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS memory_facts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                indexed INTEGER DEFAULT 0
+            )
+        ''')
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_memory_facts_pending ON memory_facts(indexed, id)"
+        )
+        # 进程间共享的小型键值状态 (如飞书 tenant_access_token)，多 worker 部署时避免各自重复获取
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shared_state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
     print(f"✅ 存存记忆库已就绪：{DB_PATH}")
 
-def save_message(user_id, role, content, tokens=0):
-    """将对话存入数据库，绑定特定用户"""
+def _insert_message(user_id, role, content, tokens=0, prompt_version=None):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO chat_history (user_id, role, content, tokens_used) VALUES (?, ?, ?, ?)",
-            (user_id, role, content, tokens)
-        )
-        conn.commit()
-        conn.close()
+        with transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO chat_history (user_id, role, content, tokens_used, prompt_version) VALUES (?, ?, ?, ?, ?)",
+                (user_id, role, content, tokens, prompt_version)
+            )
     except Exception as e:
         print(f"❌ 数据库保存失败: {e}")
 
+@metrics.timed("db_save_messages")
+def save_messages(rows):
+    """批量写入对话，rows 为 (user_id, role, content, tokens, prompt_version)，整批共用一个事务"""
+    try:
+        with transaction() as cursor:
+            cursor.executemany(
+                "INSERT INTO chat_history (user_id, role, content, tokens_used, prompt_version) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+        return True
+    except Exception as e:
+        print(f"❌ 数据库批量保存失败: {e}")
+        return False
+
+# --- 写后日志 (Write-behind Journal) ---
+# 对话写入先进入内存队列，由单个写线程按时间/条数攒批后一次事务提交，
+# 回复链路不再等待磁盘。尚未落盘的消息保存在 overlay 中，读历史时合并返回，保证读己之写。
+# 提交失败的批次不会丢弃：留在 overlay 中，由写线程指数退避 (最长 RETRY_MAX_DELAY 秒) 后原样重试。
+
+class MessageJournal:
+    RETRY_BASE_DELAY = 0.2
+    RETRY_MAX_DELAY = 30.0
+
+    def __init__(self, flush_interval_ms=50, max_batch=100):
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._overlay = {}                       # user_id -> [(role, content), ...]
+        self._overlay_lock = threading.Lock()    # 保护 overlay 字典本身 (持有时间极短)
+        self._commit_lock = threading.Lock()     # 提交与"读库 + 读 overlay"互斥
+        self._done = threading.Condition()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.commit_failures = 0
+        self._failures_in_row = 0
+        self._retry = []                         # 上次提交失败、等待重试的批次
+        self.max_depth = 0
+        self.last_commit_ms = 0.0
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # 写线程不会随 fork 进入子进程，锁也可能停留在加锁状态；
+        # 未落盘的消息归父进程负责，子进程从空队列重新开始
+        self._queue = queue.Queue()
+        self._overlay = {}
+        self._overlay_lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._done = threading.Condition()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._retry = []
+        self._failures_in_row = 0
+        self.enqueued = self.written = self.batches = self.commit_failures = self.max_depth = 0
+
+    def _ensure_writer(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if not (self._thread and self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, name="db-journal", daemon=True)
+                self._thread.start()
+
+    def append(self, user_id, role, content, tokens=0, prompt_version=None):
+        self._ensure_writer()
+        with self._done:
+            self.enqueued += 1
+        # overlay 与队列在同一把锁下写入，保证两者顺序一致
+        with self._overlay_lock:
+            self._overlay.setdefault(user_id, []).append((role, content))
+            self._queue.put((user_id, role, content, tokens, prompt_version))
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    def pending(self, user_id):
+        with self._overlay_lock:
+            return list(self._overlay.get(user_id, ()))
+
+    def _run(self):
+        while True:
+            if self._retry:
+                # 失败批次优先重试，新消息留在队列里，保持落盘顺序
+                batch, self._retry = self._retry, []
+                self._commit(batch)
+                continue
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        start = time.perf_counter()
+        with self._commit_lock:
+            ok = save_messages(batch)
+            if ok:
+                with self._overlay_lock:
+                    for user_id, role, content, *_ in batch:
+                        rows = self._overlay.get(user_id)
+                        if rows:
+                            rows.remove((role, content))
+                            if not rows:
+                                del self._overlay[user_id]
+        self.last_commit_ms = round((time.perf_counter() - start) * 1000, 2)
+        if not ok:
+            # 失败的消息仍在 overlay 中 (读历史照常可见)，退避后整批重试
+            self.commit_failures += 1
+            self._failures_in_row += 1
+            delay = min(self.RETRY_BASE_DELAY * 2 ** (self._failures_in_row - 1), self.RETRY_MAX_DELAY)
+            logger.error("❌ 对话批次写入失败，保留待重试", extra={
+                "rows": len(batch), "attempt": self._failures_in_row, "retry_in_s": delay
+            })
+            self._retry = batch
+            time.sleep(delay)
+            return
+        if self._failures_in_row:
+            logger.info("✅ 对话批次重试写入成功", extra={"rows": len(batch), "attempts": self._failures_in_row + 1})
+            self._failures_in_row = 0
+        with self._done:
+            self.written += len(batch)
+            self.batches += 1
+            self._done.notify_all()
+
+    def flush(self, timeout=10):
+        """等待调用时刻之前入队的消息全部落盘；数据库持续不可写时超时返回 False (消息仍保留待重试)"""
+        with self._done:
+            target = self.enqueued
+            return self._done.wait_for(lambda: self.written >= target, timeout=timeout)
+
+    def stats(self):
+        with self._overlay_lock:
+            pending_users = len(self._overlay)
+        return {
+            "queue_depth": self._queue.qsize(),
+            "max_depth": self.max_depth,
+            "pending_users": pending_users,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "retry_rows": len(self._retry),
+            "commit_failures": self.commit_failures,
+            "batches": self.batches,
+            "avg_batch": round(self.written / self.batches, 2) if self.batches else 0.0,
+            "last_commit_ms": self.last_commit_ms,
+        }
+
+journal = MessageJournal(
+    flush_interval_ms=Config.JOURNAL_FLUSH_MS,
+    max_batch=Config.JOURNAL_MAX_BATCH,
+)
+
+def flush_messages(timeout=10):
+    """把写后队列中的消息同步落盘 (退出、清空记忆前调用)"""
+    if Config.DB_WRITE_BEHIND:
+        return journal.flush(timeout)
+    return True
+
+atexit.register(flush_messages)
+
+def save_message(user_id, role, content, tokens=0, prompt_version=None):
+    """将对话存入数据库，绑定特定用户 (开启写后日志时异步落盘)；助手回复附带所用的提示词版本"""
+    if Config.DB_WRITE_BEHIND:
+        journal.append(user_id, role, content, tokens, prompt_version)
+    else:
+        _insert_message(user_id, role, content, tokens, prompt_version)
+    if Config.HISTORY_CACHE_ENABLED:
+        history_cache.append(user_id, role, content)
+
+@metrics.timed("db_query_recent")
+def _query_recent(user_id, limit):
+    rows = get_db_connection().execute(
+        "SELECT role, content FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+        (user_id, limit)
+    ).fetchall()
+    return list(reversed(rows))
+
+def _load_recent_history(user_id, limit):
+    """从数据库 (合并写后 overlay) 读取最近 N 条"""
+    if Config.DB_WRITE_BEHIND and journal.pending(user_id):
+        # 有未落盘消息：读库与读 overlay 须在同一提交窗口内完成，避免漏读或重复
+        with journal._commit_lock:
+            rows = _query_recent(user_id, limit) + journal.pending(user_id)
+        return rows[-limit:]
+    return _query_recent(user_id, limit)
+
+# --- 会话窗口缓存 ---
+# 每个活跃用户在内存中保留最近 window 条对话的环形缓冲，save_message 同步追加，
+# 历史读取直接命中内存；只有冷用户 (首次/过期/被淘汰) 才回源数据库。
+
+class HistoryCache:
+    def __init__(self, window=20, ttl=1800, max_users=5000, max_bytes=64 * 1024 * 1024):
+        self.window = window
+        self.ttl = ttl
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self._users = OrderedDict()   # user_id -> {"turns": deque, "bytes": int, "touched": float}，按访问时间排序
+        self._loading = {}            # user_id -> 是否在回源期间发生了写入
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypass = 0
+        self.evictions = 0
+
+    def get(self, user_id, limit):
+        if limit > self.window:
+            with self._lock:
+                self.bypass += 1
+            return _load_recent_history(user_id, limit)
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry and now - entry["touched"] < self.ttl:
+                entry["touched"] = now
+                self._users.move_to_end(user_id)
+                self.hits += 1
+                return list(entry["turns"])[-limit:]
+            if entry:
+                self._drop(user_id)
+            self.misses += 1
+            self._loading.setdefault(user_id, False)
+
+        rows = _load_recent_history(user_id, self.window)
+
+        with self._lock:
+            stale = self._loading.pop(user_id, True)
+            # 回源期间有新消息写入时，这份快照可能已过时，不放入缓存
+            if not stale and user_id not in self._users:
+                turns = deque(rows, maxlen=self.window)
+                size = sum(len(c.encode("utf-8")) for _, c in turns)
+                self._users[user_id] = {"turns": turns, "bytes": size, "touched": now}
+                self._bytes += size
+                self._evict(now)
+        return rows[-limit:]
+
+    def append(self, user_id, role, content):
+        with self._lock:
+            if user_id in self._loading:
+                self._loading[user_id] = True
+            entry = self._users.get(user_id)
+            if not entry:
+                return
+            turns = entry["turns"]
+            if len(turns) == turns.maxlen:
+                dropped = len(turns[0][1].encode("utf-8"))
+                entry["bytes"] -= dropped
+                self._bytes -= dropped
+            turns.append((role, content))
+            size = len(content.encode("utf-8"))
+            entry["bytes"] += size
+            self._bytes += size
+            self._evict(time.monotonic())
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if user_id in self._loading:
+                self._loading[user_id] = True
+            if user_id in self._users:
+                self._drop(user_id)
+
+    def _drop(self, user_id):
+        entry = self._users.pop(user_id)
+        self._bytes -= entry["bytes"]
+
+    def _evict(self, now):
+        # OrderedDict 头部是最久未访问的用户：先清过期，再按人数/内存上限淘汰
+        while self._users:
+            user_id, entry = next(iter(self._users.items()))
+            expired = now - entry["touched"] >= self.ttl
+            if not (expired or len(self._users) > self.max_users or self._bytes > self.max_bytes):
+                break
+            self._drop(user_id)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "users": len(self._users),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypass": self.bypass,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+history_cache = HistoryCache(
+    window=Config.HISTORY_CACHE_TURNS,
+    ttl=Config.HISTORY_CACHE_TTL,
+    max_users=Config.HISTORY_CACHE_MAX_USERS,
+    max_bytes=Config.HISTORY_CACHE_MAX_MB * 1024 * 1024,
+)
+
+@metrics.timed("db_get_recent_history")
 def get_recent_history(user_id, limit=10):
     """获取指定用户最近的 N 条对话"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT role, content FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT ?",
-            (user_id, limit)
-        )
-        rows = cursor.fetchall()
-        conn.close()
-        
+        if Config.HISTORY_CACHE_ENABLED:
+            rows = history_cache.get(user_id, limit)
+        else:
+            rows = _load_recent_history(user_id, limit)
+
         history = []
-        for role, content in reversed(rows):
+        for role, content in rows:
             history.append({"role": role, "content": content})
         return history
     except Exception as e:
         print(f"❌ 数据库读取失败: {e}")
         return []
 
+# 摘要每轮组装上下文都要读：与会话窗口缓存同开关、同 TTL 缓存在进程内，回复链路不再为它查库。
+# 本进程保存摘要时直接更新，清空记忆时删除；其他 worker 写入的新摘要最迟 HISTORY_CACHE_TTL 秒后可见
+_summary_cache = LRUCache(maxsize=Config.HISTORY_CACHE_MAX_USERS)
+
+@metrics.timed("db_get_user_summary")
+def _load_user_summary(user_id):
+    row = get_db_connection().execute(
+        "SELECT summary, last_message_id FROM user_summaries WHERE user_id = ?", (user_id,)
+    ).fetchone()
+    return (row[0], row[1]) if row else ("", 0)
+
+def get_user_summary(user_id):
+    """读取用户的长期记忆摘要，返回 (summary, last_message_id)；没有摘要时返回 ("", 0)"""
+    if Config.HISTORY_CACHE_ENABLED:
+        cached = _summary_cache.get(user_id)
+        if cached and time.monotonic() - cached[2] < Config.HISTORY_CACHE_TTL:
+            return cached[0], cached[1]
+    try:
+        summary, last_id = _load_user_summary(user_id)
+    except Exception as e:
+        print(f"❌ 摘要读取失败: {e}")
+        return ("", 0)
+    if Config.HISTORY_CACHE_ENABLED:
+        _summary_cache.put(user_id, (summary, last_id, time.monotonic()))
+    return summary, last_id
+
+@metrics.timed("db_save_user_summary")
+def save_user_summary(user_id, summary, last_message_id):
+    """保存摘要；只接受比现有摘要覆盖范围更新的版本 (多进程同时压缩时不会回退)"""
+    try:
+        with transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO user_summaries (user_id, summary, last_message_id) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET summary = excluded.summary, "
+                "last_message_id = excluded.last_message_id, updated_at = CURRENT_TIMESTAMP "
+                "WHERE excluded.last_message_id > user_summaries.last_message_id",
+                (user_id, summary, last_message_id)
+            )
+            saved = cursor.rowcount == 1
+    except Exception as e:
+        print(f"❌ 摘要保存失败: {e}")
+        _summary_cache.pop(user_id)
+        return False
+    if saved and Config.HISTORY_CACHE_ENABLED:
+        _summary_cache.put(user_id, (summary, last_message_id, time.monotonic()))
+    else:
+        # 库里已有覆盖范围更新的摘要 (其他 worker 写入)，下次从库里重新读
+        _summary_cache.pop(user_id)
+    return saved
+
+@metrics.timed("db_get_unsummarized_messages")
+def get_unsummarized_messages(user_id, after_id, keep_recent, limit):
+    """
+    取尚未纳入摘要、且不在最近 keep_recent 条之内的最早 limit 条消息，返回 [(id, role, content)]。
+    最近的消息仍以原文进入上下文，不参与压缩。
+    """
+    conn = get_db_connection()
+    boundary = conn.execute(
+        "SELECT id FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+        (user_id, keep_recent)
+    ).fetchone()
+    if not boundary or boundary[0] <= after_id:
+        return []
+    return conn.execute(
+        "SELECT id, role, content FROM chat_history WHERE user_id = ? AND id > ? AND id <= ? ORDER BY id LIMIT ?",
+        (user_id, after_id, boundary[0], limit)
+    ).fetchall()
+
+@metrics.timed("db_save_memory_facts")
+def save_memory_facts(rows):
+    """登记待入库的对话事实，rows 为 (user_id, content)"""
+    try:
+        with transaction() as cursor:
+            cursor.executemany("INSERT INTO memory_facts (user_id, content) VALUES (?, ?)", rows)
+        return True
+    except Exception as e:
+        print(f"❌ 记忆事实保存失败: {e}")
+        return False
+
+def get_pending_memory_facts(limit):
+    """取最早的一批未入库事实，返回 [(id, user_id, content)]"""
+    return get_db_connection().execute(
+        "SELECT id, user_id, content FROM memory_facts WHERE indexed = 0 ORDER BY id LIMIT ?", (limit,)
+    ).fetchall()
+
+def mark_memory_facts_indexed(ids):
+    with transaction() as cursor:
+        cursor.executemany("UPDATE memory_facts SET indexed = 1 WHERE id = ?", [(i,) for i in ids])
+
+@metrics.timed("db_get_voice_file_key")
+def get_voice_file_key(content_hash):
+    """按内容哈希查询已上传语音的 file_key，未命中返回 None"""
+    try:
+        row = get_db_connection().execute(
+            "SELECT file_key FROM voice_file_keys WHERE content_hash = ?",
+            (content_hash,)
+        ).fetchone()
+        return row[0] if row else None
+    except Exception as e:
+        print(f"❌ file_key 读取失败: {e}")
+        return None
+
+def save_voice_file_key(content_hash, file_key, filename=None, file_size=None):
+    """记录语音上传结果，同一内容哈希只保留最新的 file_key"""
+    try:
+        with transaction() as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO voice_file_keys (content_hash, file_key, filename, file_size) VALUES (?, ?, ?, ?)",
+                (content_hash, file_key, filename, file_size)
+            )
+    except Exception as e:
+        print(f"❌ file_key 保存失败: {e}")
+
+@metrics.timed("db_get_cached_embeddings")
+def get_cached_embeddings(cache_keys):
+    """批量读取向量缓存，返回 {cache_key: vector_blob}"""
+    if not cache_keys:
+        return {}
+    try:
+        placeholders = ",".join("?" * len(cache_keys))
+        rows = get_db_connection().execute(
+            f"SELECT cache_key, vector FROM embedding_cache WHERE cache_key IN ({placeholders})",
+            list(cache_keys)
+        ).fetchall()
+        return dict(rows)
+    except Exception as e:
+        print(f"❌ 向量缓存读取失败: {e}")
+        return {}
+
+@metrics.timed("db_save_cached_embeddings")
+def save_cached_embeddings(rows):
+    """批量写入向量缓存，rows 为 (cache_key, model, dim, vector_blob)"""
+    try:
+        with transaction() as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (cache_key, model, dim, vector) VALUES (?, ?, ?, ?)",
+                rows
+            )
+    except Exception as e:
+        print(f"❌ 向量缓存保存失败: {e}")
+
+@metrics.timed("db_claim_event")
+def claim_event(event_id, now, ttl):
+    """
+    原子地登记一个事件：首次出现 (或上次记录已过期) 返回 True，重复返回 False。
+    依赖主键冲突判定，多个 worker 进程同时登记同一事件也只有一个能成功。
+    """
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO processed_events (event_id, seen_at) VALUES (?, ?) "
+            "ON CONFLICT(event_id) DO UPDATE SET seen_at = excluded.seen_at "
+            "WHERE processed_events.seen_at < ?",
+            (event_id, now, now - ttl)
+        )
+        return cursor.rowcount == 1
+
+def purge_events(before):
+    """清理早于 before 的去重记录，返回删除条数"""
+    try:
+        with transaction() as cursor:
+            cursor.execute("DELETE FROM processed_events WHERE seen_at < ?", (before,))
+            return cursor.rowcount
+    except Exception as e:
+        logger.warning("❌ 去重记录清理失败", extra={"error": str(e)})
+        return 0
+
+@metrics.timed("db_get_shared_state")
+def get_shared_state(key, now=None):
+    """读取未过期的共享状态，不存在或已过期返回 None"""
+    try:
+        row = get_db_connection().execute(
+            "SELECT value FROM shared_state WHERE key = ? AND expires_at > ?",
+            (key, now if now is not None else time.time())
+        ).fetchone()
+        return row[0] if row else None
+    except Exception as e:
+        print(f"❌ 共享状态读取失败: {e}")
+        return None
+
+def set_shared_state(key, value, expires_at):
+    """写入共享状态 (覆盖旧值)"""
+    try:
+        with transaction() as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at)
+            )
+    except Exception as e:
+        print(f"❌ 共享状态保存失败: {e}")
+
 # --- ✨ 存宝为你新增的‘灵魂洗涤’功能 ---
 def clear_user_history(user_id):
     """
@@ -77,11 +689,20 @@ def clear_user_history(user_id):
     当你觉得回复太短、不智能、或者逻辑陷入死循环时，执行此操作。
     """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
-        conn.commit()
-        conn.close()
+        # 先让排队中的消息落盘，避免清空后又被写回
+        flush_messages()
+        with transaction() as cursor:
+            cursor.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
+            cursor.execute("DELETE FROM user_summaries WHERE user_id = ?", (user_id,))
+            cursor.execute("DELETE FROM memory_facts WHERE user_id = ?", (user_id,))
+        history_cache.invalidate(user_id)
+        _summary_cache.pop(user_id)
+        # 已入库 cuncun_bio 的对话事实也要删掉，否则检索仍会把旧事实注入提示词
+        # (cuncun_utils 依赖本模块，这里延迟导入)
+        from cuncun_utils import get_bio_collection
+        collection = get_bio_collection()
+        if collection is not None:
+            collection.delete(where={"open_id": user_id})
         print(f"🧹 用户 {user_id} 的历史记忆已清空。存存现在是一张纯净的白纸了。")
         return True
     except Exception as e:
@@ -89,4 +710,4 @@ def clear_user_history(user_id):
         return False
 
 if __name__ == "__main__":
-    init_db()
\ No newline at end of file
+    init_db()
@@ -0,0 +1,224 @@
+import os
+import gzip
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+from datetime import datetime
+
+from config import Config
+from database_manager import DB_PATH
+from cuncun_utils import logger
+
+# --- 在线备份 ---
+# 使用 sqlite3 backup API 按页分步复制：源连接先开启读事务固定 WAL 快照，
+# 写线程照常提交，备份也不会因源库被修改而反复重启；每一步之间可短暂让出 CPU。
+# 快照先做 integrity_check，通过后再入库：
+#   incremental (默认)：按 CHUNK_SIZE 切块，块以 sha256 命名、gzip 压缩存入 chunks/，
+#                       已存在的块直接复用，每晚只写入变化的部分；manifest 记录块序列与整库哈希
+#   full：整库 gzip 为单个 .db.gz 文件
+# 旧版 shutil.copy2 直接复制正在写入的库文件，可能得到撕裂的副本，且备份的是 Config.DB_PATH 而非实际写入的库。
+
+CHUNK_SIZE = 1024 * 1024   # 页大小 (4KB) 的整数倍，某一页变化只影响它所在的块
+
+def _snapshot(dest, pages, step_sleep):
+    """把在线库复制为 dest，返回 (步数, 页数)"""
+    src = sqlite3.connect(DB_PATH, timeout=10)
+    dst = sqlite3.connect(dest)
+    steps = {"n": 0, "total": 0}
+
+    def progress(status, remaining, total):
+        steps["n"] += 1
+        steps["total"] = total
+        if step_sleep and remaining:
+            time.sleep(step_sleep)
+
+    try:
+        # 读事务固定快照：之后的提交对本次备份不可见，备份过程无需重启
+        src.execute("BEGIN")
+        src.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        src.backup(dst, pages=pages, progress=progress)
+        src.rollback()
+        dst.execute("PRAGMA journal_mode=DELETE")
+        return steps["n"], steps["total"]
+    finally:
+        dst.close()
+        src.close()
+
+def verify_database(path):
+    """对备份文件做完整性检查，返回 True / False"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    finally:
+        conn.close()
+
+def _chunk_path(chunk_dir, digest):
+    return os.path.join(chunk_dir, digest[:2], f"{digest}.gz")
+
+def _store_chunks(snapshot_path, chunk_dir):
+    """切块入库，返回 (块哈希列表, 整库 sha256, 新写入字节数, 新块数)"""
+    chunks, written, new_chunks = [], 0, 0
+    whole = hashlib.sha256()
+    with open(snapshot_path, "rb") as f:
+        while True:
+            block = f.read(CHUNK_SIZE)
+            if not block:
+                break
+            whole.update(block)
+            digest = hashlib.sha256(block).hexdigest()
+            chunks.append(digest)
+            path = _chunk_path(chunk_dir, digest)
+            if os.path.exists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            data = gzip.compress(block, compresslevel=6)
+            tmp = f"{path}.tmp"
+            with open(tmp, "wb") as out:
+                out.write(data)
+            os.replace(tmp, path)
+            written += len(data)
+            new_chunks += 1
+    return chunks, whole.hexdigest(), written, new_chunks
+
+def _write_full(snapshot_path, dest):
+    whole = hashlib.sha256()
+    with open(snapshot_path, "rb") as f, gzip.open(dest, "wb", compresslevel=6) as out:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            whole.update(block)
+            out.write(block)
+    return whole.hexdigest(), os.path.getsize(dest)
+
+def create_backup(backup_dir=None, mode=None):
+    """执行一次备份，返回统计信息；快照完整性检查失败时抛出 RuntimeError"""
+    backup_dir = backup_dir or Config.BACKUP_DIR
+    mode = mode or Config.BACKUP_MODE
+    os.makedirs(backup_dir, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    snapshot_path = os.path.join(backup_dir, f".snapshot_{timestamp}.db")
+
+    start = time.perf_counter()
+    try:
+        steps, pages = _snapshot(snapshot_path, Config.BACKUP_PAGES_PER_STEP, Config.BACKUP_STEP_SLEEP)
+        snapshot_ms = round((time.perf_counter() - start) * 1000, 1)
+        if not verify_database(snapshot_path):
+            raise RuntimeError("备份快照未通过 integrity_check")
+        size = os.path.getsize(snapshot_path)
+
+        stats = {"mode": mode, "db_path": DB_PATH, "db_bytes": size, "pages": pages, "steps": steps,
+                 "snapshot_ms": snapshot_ms}
+        if mode == "full":
+            dest = os.path.join(backup_dir, f"backup_{timestamp}.db.gz")
+            sha, written = _write_full(snapshot_path, dest)
+            stats.update(file=os.path.basename(dest), sha256=sha, bytes_written=written)
+        else:
+            chunks, sha, written, new_chunks = _store_chunks(snapshot_path, os.path.join(backup_dir, "chunks"))
+            manifest = {
+                "created_at": datetime.now().isoformat(),
+                "db_bytes": size,
+                "chunk_size": CHUNK_SIZE,
+                "sha256": sha,
+                "chunks": chunks,
+            }
+            dest = os.path.join(backup_dir, f"backup_{timestamp}.json")
+            with open(dest, "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+            stats.update(file=os.path.basename(dest), sha256=sha, bytes_written=written,
+                         chunks=len(chunks), new_chunks=new_chunks)
+    finally:
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+
+    stats["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return stats
+
+def restore_backup(backup_file, dest):
+    """把备份 (manifest 或 .db.gz) 还原为 dest，并校验整库哈希与完整性"""
+    whole = hashlib.sha256()
+    tmp = f"{dest}.restoring"
+    if backup_file.endswith(".json"):
+        with open(backup_file, encoding="utf-8") as f:
+            manifest = json.load(f)
+        chunk_dir = os.path.join(os.path.dirname(os.path.abspath(backup_file)), "chunks")
+        expected = manifest["sha256"]
+        with open(tmp, "wb") as out:
+            for digest in manifest["chunks"]:
+                with gzip.open(_chunk_path(chunk_dir, digest), "rb") as f:
+                    block = f.read()
+                if hashlib.sha256(block).hexdigest() != digest:
+                    raise RuntimeError(f"备份块已损坏: {digest}")
+                whole.update(block)
+                out.write(block)
+    else:
+        expected = None
+        with gzip.open(backup_file, "rb") as f, open(tmp, "wb") as out:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+                whole.update(block)
+                out.write(block)
+    if expected and whole.hexdigest() != expected:
+        os.remove(tmp)
+        raise RuntimeError("还原结果与备份哈希不一致")
+    if not verify_database(tmp):
+        os.remove(tmp)
+        raise RuntimeError("还原结果未通过 integrity_check")
+    os.replace(tmp, dest)
+    return dest
+
+def prune_backups(backup_dir=None, retention_days=None):
+    """删除过期备份，并回收不再被任何 manifest 引用的块，返回删除的文件数"""
+    backup_dir = backup_dir or Config.BACKUP_DIR
+    retention = time.time() - (retention_days or Config.BACKUP_RETENTION_DAYS) * 86400
+    removed = 0
+    live_chunks = set()
+    for name in os.listdir(backup_dir):
+        path = os.path.join(backup_dir, name)
+        if not os.path.isfile(path) or not name.startswith("backup_"):
+            continue
+        if os.path.getmtime(path) < retention:
+            os.remove(path)
+            removed += 1
+            logger.info(f"清理过期备份", extra={"removed_file": name})
+        elif name.endswith(".json"):
+            with open(path, encoding="utf-8") as f:
+                live_chunks.update(json.load(f)["chunks"])
+
+    chunk_dir = os.path.join(backup_dir, "chunks")
+    if os.path.isdir(chunk_dir):
+        for sub in os.listdir(chunk_dir):
+            sub_dir = os.path.join(chunk_dir, sub)
+            for name in os.listdir(sub_dir):
+                if name[:-len(".gz")] not in live_chunks:
+                    os.remove(os.path.join(sub_dir, name))
+                    removed += 1
+            if not os.listdir(sub_dir):
+                os.rmdir(sub_dir)
+    return removed
+
+def backup_database_task():
+    """数据库备份 (定时任务入口)"""
+    try:
+        stats = create_backup()
+        logger.info(f"💾 数据库备份成功", extra={"backup_file": stats["file"], "backup": stats})
+        prune_backups()
+        return stats
+    except Exception as e:
+        logger.error(f"备份失败: {e}")
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="存存记忆库在线备份")
+    parser.add_argument("--backup", action="store_true", help="立即执行一次备份")
+    parser.add_argument("--mode", choices=["incremental", "full"], help="覆盖 BACKUP_MODE")
+    parser.add_argument("--restore", metavar="BACKUP_FILE", help="从 manifest (.json) 或 .db.gz 还原")
+    parser.add_argument("--to", metavar="DEST", help="还原目标路径")
+    args = parser.parse_args()
+
+    if args.restore:
+        if not args.to:
+            parser.error("--restore 需要同时指定 --to")
+        print(f"✅ 已还原到 {restore_backup(args.restore, args.to)}")
+    elif args.backup:
+        print(json.dumps(create_backup(mode=args.mode), ensure_ascii=False, indent=2))
+    else:
+        parser.print_help()
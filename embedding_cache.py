@@ -0,0 +1,87 @@
+import re
+import hashlib
+import threading
+import unicodedata
+from array import array
+
+from config import Config
+from memory_cache import LRUCache
+from database_manager import get_cached_embeddings, save_cached_embeddings
+
+# --- 两级 Embedding 缓存 ---
+# L1: 进程内 LRU；L2: SQLite embedding_cache 表 (float32 BLOB)
+# 键为 (模型, 规范化文本)，角色口头禅高度重复，命中后无需再走网络
+
+def normalize_text(text):
+    """统一全半角与空白，保证同一句话得到同一个缓存键"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+def cache_key(model, text):
+    return hashlib.sha1(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+def _pack(vector):
+    return array("f", vector).tobytes()
+
+def _unpack(blob):
+    vec = array("f")
+    vec.frombytes(blob)
+    return vec.tolist()
+
+class EmbeddingCache:
+    def __init__(self, maxsize=4096, persist=True):
+        self._lru = LRUCache(maxsize=maxsize)
+        self.persist = persist
+        self._lock = threading.Lock()
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get_many(self, model, texts):
+        """批量查询，返回与 texts 对齐的列表，未命中为 None"""
+        keys = [cache_key(model, t) for t in texts]
+        results = [self._lru.get(k) for k in keys]
+
+        missing = {k for k, v in zip(keys, results) if v is None}
+        if missing and self.persist:
+            found = get_cached_embeddings(list(missing))
+            for i, k in enumerate(keys):
+                if results[i] is None and k in found:
+                    results[i] = _unpack(found[k])
+                    self._lru.put(k, results[i])
+            with self._lock:
+                self.disk_hits += len(found)
+
+        with self._lock:
+            self.misses += sum(1 for v in results if v is None)
+        return results
+
+    def put_many(self, model, texts, vectors):
+        rows = []
+        for text, vec in zip(texts, vectors):
+            if not vec:
+                continue
+            k = cache_key(model, text)
+            self._lru.put(k, vec)
+            rows.append((k, model, len(vec), _pack(vec)))
+        if rows and self.persist:
+            save_cached_embeddings(rows)
+
+    def stats(self):
+        lru = self._lru.stats()
+        with self._lock:
+            disk_hits, misses = self.disk_hits, self.misses
+        total = lru["hits"] + disk_hits + misses
+        return {
+            "memory_size": lru["size"],
+            "memory_maxsize": lru["maxsize"],
+            "memory_hits": lru["hits"],
+            "disk_hits": disk_hits,
+            "misses": misses,
+            "evictions": lru["evictions"],
+            "hit_rate": round((lru["hits"] + disk_hits) / total, 4) if total else 0.0,
+        }
+
+embedding_cache = EmbeddingCache(
+    maxsize=Config.EMBED_CACHE_SIZE,
+    persist=Config.EMBED_CACHE_PERSIST,
+)
@@ -0,0 +1,79 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from config import Config
+from database_manager import claim_event, purge_events
+
+logger = logging.getLogger("feishu-utils")
+
+# --- 事件去重 ---
+# 内存层：哈希表 + 按到达时间排序 (OrderedDict)，查重 O(1)，过期记录从头部淘汰；
+# 持久层：SQLite processed_events 表，重启与多 worker 进程之间共享，飞书重试不会被再次处理。
+
+class EventDeduplicator:
+    def __init__(self, ttl=86400, max_memory=20000, persist=True, purge_interval=3600):
+        self.ttl = ttl
+        self.max_memory = max_memory
+        self.persist = persist
+        self.purge_interval = purge_interval
+        self._seen = OrderedDict()     # event_id -> seen_at，插入顺序即时间顺序
+        self._lock = threading.Lock()
+        self._last_purge = time.time()
+        self.duplicates = 0
+        self.accepted = 0
+
+    def _expire(self, now):
+        cutoff = now - self.ttl
+        while self._seen:
+            event_id, seen_at = next(iter(self._seen.items()))
+            if seen_at >= cutoff and len(self._seen) <= self.max_memory:
+                break
+            self._seen.popitem(last=False)
+
+    def first_seen(self, event_id):
+        """事件首次出现返回 True；重复 (本进程或其他进程已处理过) 返回 False"""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if event_id in self._seen:
+                self.duplicates += 1
+                return False
+            if not self.persist:
+                self._seen[event_id] = now
+                self.accepted += 1
+                return True
+
+        try:
+            fresh = claim_event(event_id, now, self.ttl)
+        except Exception as e:
+            # 数据库不可用时退化为仅内存去重，宁可偶发重复也不丢消息
+            logger.warning("❌ 去重登记失败，退化为仅内存去重", extra={"event_id": event_id, "error": str(e)})
+            fresh = True
+
+        with self._lock:
+            self._seen[event_id] = now
+            if fresh:
+                self.accepted += 1
+            else:
+                self.duplicates += 1
+        if fresh and self.persist and now - self._last_purge > self.purge_interval:
+            self._last_purge = now
+            purge_events(now - self.ttl)
+        return fresh
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_size": len(self._seen),
+                "accepted": self.accepted,
+                "duplicates": self.duplicates,
+                "persist": self.persist,
+            }
+
+dedup = EventDeduplicator(
+    ttl=Config.DEDUP_TTL,
+    max_memory=Config.DEDUP_MEMORY_SIZE,
+    persist=Config.DEDUP_PERSIST,
+)
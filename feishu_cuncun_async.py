@@ -0,0 +1,513 @@
+import os
+import json
+import time
+import uuid
+import signal
+import asyncio
+from urllib.parse import urlsplit
+from datetime import datetime
+
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector, FormData, ClientError, ClientConnectorError
+from openai import AsyncOpenAI
+
+import http_client
+import metrics
+from config import Config
+from database_manager import init_db, save_message, flush_messages
+from cuncun_utils import (
+    logger, verify_signature, AESCipher,
+    split_sentences, next_stream_segment, nearest_voices, voice_search_ready,
+    EMBEDDING_MODEL, EMBEDDING_URL, copy_usage, start_warm_up,
+    token_manager, INVALID_TOKEN_CODES, new_trace
+)
+from embedding_cache import embedding_cache, normalize_text
+from voice_cache import lookup_file_key, remember_file_key
+from event_dedup import dedup
+from turn_pipeline import build_prompt, record_turn, health_status, start_scheduler, handle_sighup
+from context_builder import build_context, record_usage, summarizer
+from memory_retrieval import submit_retrieval, memory_writer
+
+# --- 异步入口 ---
+# 与 feishu_cuncun_pro.py 的 / 和 /health 语义一致，但所有上游调用都是异步的：
+# 单核即可同时推进数百个对话，不再受 3 个工作线程限制。
+# 启动：python feishu_cuncun_async.py
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+class AsyncUpstreams:
+    """飞书 / DeepSeek / 硅基流动的异步客户端，共享一个 aiohttp 连接池"""
+
+    def __init__(self):
+        self.session = None
+        self.ai = None
+
+    async def start(self):
+        self.session = ClientSession(
+            connector=TCPConnector(limit=Config.ASYNC_MAX_INFLIGHT, limit_per_host=Config.ASYNC_MAX_INFLIGHT),
+            timeout=ClientTimeout(total=30, connect=10),
+        )
+        if Config.DEEPSEEK_KEY:
+            self.ai = AsyncOpenAI(
+                api_key=Config.DEEPSEEK_KEY,
+                base_url=Config.DEEPSEEK_BASE_URL,
+                http_client=http_client.build_openai_async_http_client(),
+                max_retries=Config.HTTP_MAX_RETRIES
+            )
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+        if self.ai:
+            await self.ai.close()
+
+    async def _post(self, url, idempotent=True, **kwargs):
+        """
+        带退避重试的 POST，返回 (status, json)。
+        idempotent=False (上传等重发不安全的请求) 只在连接建立失败时重试，与同步客户端一致。
+        """
+        host = urlsplit(url).hostname or "unknown"
+        for attempt in range(Config.HTTP_MAX_RETRIES + 1):
+            last = attempt == Config.HTTP_MAX_RETRIES
+            started = time.perf_counter()
+            delay = Config.HTTP_BACKOFF * (2 ** attempt)
+            try:
+                async with self.session.post(url, **kwargs) as r:
+                    http_client.record_request(host, started, str(r.status))
+                    # 先看状态码再解析：网关返回的 5xx/429 常是 HTML，不能因解析失败放弃重试
+                    if r.status not in RETRY_STATUS or last or not idempotent:
+                        try:
+                            data = await r.json(content_type=None)
+                        except ValueError:
+                            data = {}
+                        return r.status, data
+                    delay = max(delay, _retry_after(r.headers.get("Retry-After")))
+            except ClientConnectorError:
+                http_client.record_request(host, started, "error")
+                if last:
+                    raise
+            except (asyncio.TimeoutError, ClientError, OSError):
+                http_client.record_request(host, started, "error")
+                if last or not idempotent:
+                    raise
+            await asyncio.sleep(delay)
+
+    async def get_token(self):
+        # 与同步入口共用 token_manager：未过期直接返回，需要刷新时放到线程里单飞执行
+        return token_manager.get(block=False) or await asyncio.to_thread(token_manager.get)
+
+    async def send_feishu(self, receive_id, msg_type, content, _retry=True):
+        token = await self.get_token()
+        if not token: return False
+        try:
+            with metrics.timed("feishu_send"):
+                _, data = await self._post(
+                    f"{Config.FEISHU_BASE_URL}/im/v1/messages?receive_id_type=open_id",
+                    headers={"Authorization": f"Bearer {token}"},
+                    json={
+                        "receive_id": receive_id,
+                        "msg_type": msg_type,
+                        "content": json.dumps(content),
+                        "uuid": uuid.uuid4().hex
+                    }
+                )
+            if data.get("code") in INVALID_TOKEN_CODES and _retry:
+                token_manager.invalidate(token)
+                return await self.send_feishu(receive_id, msg_type, content, _retry=False)
+            if data.get("code") != 0:
+                metrics.counter("upstream_errors_total", upstream="feishu").inc()
+            return data.get("code") == 0
+        except Exception as e:
+            metrics.counter("upstream_errors_total", upstream="feishu").inc()
+            logger.error(f"发送飞书消息失败: {e}")
+            return False
+
+    async def upload_audio(self, file_path, _retry=True):
+        token = await self.get_token()
+        if not token: return None
+        filename = os.path.basename(file_path)
+        content = await asyncio.to_thread(_read_bytes, file_path)
+        form = FormData()
+        form.add_field("file_type", "opus")
+        form.add_field("file_name", filename)
+        form.add_field("file", content, filename=filename, content_type="application/octet-stream")
+        try:
+            with metrics.timed("feishu_upload"):
+                _, res = await self._post(
+                    f"{Config.FEISHU_BASE_URL}/im/v1/files",
+                    headers={"Authorization": f"Bearer {token}"},
+                    data=form,
+                    idempotent=False,
+                )
+            if res.get("code") in INVALID_TOKEN_CODES and _retry:
+                token_manager.invalidate(token)
+                return await self.upload_audio(file_path, _retry=False)
+            if res.get("code") == 0:
+                return res["data"]["file_key"]
+            logger.error(f"❌ 上传失败: {res}")
+        except Exception as e:
+            logger.error(f"上传异常: {e}")
+        metrics.counter("upstream_errors_total", upstream="feishu").inc()
+        return None
+
+    async def get_embeddings(self, texts):
+        if not Config.SILICONFLOW_API_KEY or not texts: return [None] * len(texts)
+        texts = [normalize_text(t) for t in texts]
+        vectors = await asyncio.to_thread(embedding_cache.get_many, EMBEDDING_MODEL, texts)
+        pending = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+        if not pending:
+            return vectors
+
+        size = Config.EMBED_BATCH_SIZE
+        chunks = [pending[i:i + size] for i in range(0, len(pending), size)]
+        results = await asyncio.gather(*(self._request_embeddings(c) for c in chunks))
+        fetched = [vec for chunk in results for vec in chunk]
+        await asyncio.to_thread(embedding_cache.put_many, EMBEDDING_MODEL, pending, fetched)
+
+        by_text = dict(zip(pending, fetched))
+        return [v if v is not None else by_text.get(t) for t, v in zip(texts, vectors)]
+
+    async def _request_embeddings(self, texts):
+        try:
+            with metrics.timed("siliconflow_embed"):
+                status, data = await self._post(
+                    EMBEDDING_URL,
+                    headers={"Authorization": f"Bearer {Config.SILICONFLOW_API_KEY}"},
+                    json={"model": EMBEDDING_MODEL, "input": texts}
+                )
+            if status != 200:
+                metrics.counter("upstream_errors_total", upstream="siliconflow").inc()
+                logger.error(f"批量向量获取失败: HTTP {status}")
+                return [None] * len(texts)
+            vectors = [None] * len(texts)
+            for item in data["data"]:
+                vectors[item.get("index", 0)] = item["embedding"]
+            return vectors
+        except Exception as e:
+            metrics.counter("upstream_errors_total", upstream="siliconflow").inc()
+            logger.error(f"批量向量获取失败: {e}")
+            return [None] * len(texts)
+
+    async def call_ai(self, system_prompt, user_text, history, on_segment, usage=None):
+        """流式或一次性调用 DeepSeek，每个可推送段落都会 await on_segment(text)；真实 token 用量写入 usage"""
+        with metrics.timed("deepseek_stream" if Config.AI_STREAMING else "deepseek_chat"):
+            return await self._call_ai(system_prompt, user_text, history, on_segment, usage)
+
+    async def _call_ai(self, system_prompt, user_text, history, on_segment, usage):
+        if not self.ai:
+            await on_segment("AI 未连接")
+            return "AI 未连接"
+
+        messages = [{"role": "system", "content": system_prompt}] + history + [{"role": "user", "content": user_text}]
+        params = dict(model="deepseek-chat", messages=messages, temperature=0.9, max_tokens=2048,
+                      presence_penalty=0.6, frequency_penalty=0.5)
+        start_time = time.time()
+        if not Config.AI_STREAMING:
+            try:
+                res = await self.ai.chat.completions.create(**params)
+                copy_usage(usage, res.usage)
+                reply = res.choices[0].message.content
+            except Exception as e:
+                metrics.counter("upstream_errors_total", upstream="deepseek").inc()
+                logger.error(f"AI 错误: {e}")
+                reply = "我有点累了，稍等一下。"
+            else:
+                logger.info(f"AI 响应成功", extra={"duration": round(time.time() - start_time, 2)})
+            await on_segment(reply)
+            return reply
+
+        parts, buffer, emitted = [], "", 0
+        try:
+            stream = await self.ai.chat.completions.create(
+                stream=True, stream_options={"include_usage": True}, **params)
+            async for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    copy_usage(usage, chunk.usage)
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not parts:
+                    metrics.histogram("ai_first_token_seconds").observe(time.time() - start_time)
+                parts.append(delta)
+                buffer += delta
+                while True:
+                    segment, buffer = next_stream_segment(buffer, first=emitted == 0)
+                    if segment is None:
+                        break
+                    emitted += 1
+                    await on_segment(segment)
+        except Exception as e:
+            metrics.counter("upstream_errors_total", upstream="deepseek").inc()
+            logger.error(f"AI 流式错误: {e}")
+            # 与同步入口一致：已经收到内容时保留这部分回复，只在一个字都没拿到时兜底
+            if not parts:
+                await on_segment("我有点累了，稍等一下。")
+                return "我有点累了，稍等一下。"
+
+        if buffer.strip():
+            await on_segment(buffer.strip())
+        logger.info(f"AI 流式响应完成", extra={"duration": round(time.time() - start_time, 2)})
+        return "".join(parts).strip()
+
+def _ms(since):
+    return round((time.perf_counter() - since) * 1000, 1)
+
+def _retry_after(value):
+    """解析秒数形式的 Retry-After，最多等待 HTTP_RETRY_AFTER_MAX 秒；缺失或无法解析时返回 0"""
+    try:
+        return min(max(float(value), 0.0), Config.HTTP_RETRY_AFTER_MAX)
+    except (TypeError, ValueError):
+        return 0.0
+
+async def _save_message(*args, **kwargs):
+    # 写后日志开启时只是入队，直接调用；同步落盘时事务放到线程里，避免阻塞事件循环
+    if Config.DB_WRITE_BEHIND:
+        save_message(*args, **kwargs)
+    else:
+        await asyncio.to_thread(save_message, *args, **kwargs)
+
+def _read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+class AsyncCuncunServer:
+    def __init__(self):
+        self.upstreams = AsyncUpstreams()
+        self.global_slots = asyncio.Semaphore(Config.ASYNC_MAX_INFLIGHT)
+        self.user_locks = {}     # open_id -> [Lock, 等待/持有的协程数]
+        self.tasks = set()
+
+    # --- 并发控制：同一用户串行，全局限流 ---
+
+    async def _acquire_user(self, open_id):
+        entry = self.user_locks.setdefault(open_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        await entry[0].acquire()
+        return entry
+
+    def _release_user(self, open_id, entry):
+        entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            self.user_locks.pop(open_id, None)
+
+    async def handle_message(self, open_id, user_text):
+        entry = await self._acquire_user(open_id)
+        try:
+            async with self.global_slots:
+                await self.process(open_id, user_text)
+        finally:
+            self._release_user(open_id, entry)
+
+    async def process(self, open_id, user_text):
+        started_at = time.time()
+        up = self.upstreams
+        timings = {}
+        failed = False
+        try:
+            logger.info(f"📩 收到用户消息", extra={"user_text": user_text, "open_id": open_id})
+            await _save_message(open_id, "user", user_text)
+
+            t = time.perf_counter()
+            # 首次使用会加载记忆库/语音库 (也可能正被预热线程持锁加载)，都放到线程里，不阻塞事件循环
+            retrieval = await asyncio.to_thread(submit_retrieval, open_id, user_text)
+            prompt, prompt_version = build_prompt(user_text)
+            (prompt, history, est_tokens), voice_ready = await asyncio.gather(
+                asyncio.to_thread(build_context, open_id, prompt, user_text, [user_text], retrieval),
+                asyncio.to_thread(voice_search_ready),
+            )
+            timings["context_ms"] = _ms(t)
+
+            notice = None
+            if len(user_text) > 50:
+                notice = "喔唷，likikyou 今天写了这么多心里话呀，我正在认真读呢，稍微等我一下喔... ☕️"
+
+            first_sent = []
+            prefetches = []
+
+            async def deliver(segment):
+                if not first_sent:
+                    if notice:
+                        await up.send_feishu(open_id, "text", {"text": notice})
+                    await up.send_feishu(open_id, "text", {"text": segment})
+                    first_sent.append(time.time())
+                    timings["ttfv_ms"] = round((first_sent[0] - started_at) * 1000, 1)
+                    logger.info("⚡ 首段已送达", extra={"ttfv": round(first_sent[0] - started_at, 2)})
+                else:
+                    await up.send_feishu(open_id, "text", {"text": segment})
+                if voice_ready and Config.AI_STREAMING:
+                    sentences = split_sentences(segment)
+                    if sentences:
+                        prefetches.append(asyncio.ensure_future(up.get_embeddings(sentences)))
+
+            usage = {}
+            t = time.perf_counter()
+            reply = await up.call_ai(prompt, user_text, history, deliver, usage)
+            timings["ai_ms"] = _ms(t)
+            tokens = record_usage(est_tokens, usage)
+            await _save_message(open_id, "assistant", reply, tokens=tokens, prompt_version=prompt_version)
+            logger.info(f"💬 存存回复成功", extra={"reply_preview": reply[:30], "prompt_version": prompt_version})
+
+            t = time.perf_counter()
+            try:
+                f_key = await asyncio.wait_for(self.voice_stage(reply, prefetches), Config.VOICE_STAGE_DEADLINE)
+            except asyncio.TimeoutError:
+                f_key = None
+                timings["voice_skipped"] = True
+                logger.warning("⏱️ 语音阶段超出预算，本轮跳过语音", extra={"deadline": Config.VOICE_STAGE_DEADLINE})
+            timings["voice_ms"] = _ms(t)
+            if f_key:
+                await up.send_feishu(open_id, "audio", {"file_key": f_key})
+
+            if Config.SUMMARY_ENABLED:
+                summarizer.schedule(open_id, len(history) + 2)
+            if Config.MEMORY_WRITE_ENABLED:
+                memory_writer.record(open_id, user_text)
+
+        except Exception as e:
+            failed = True
+            error_info = f"Core Logic Error: {str(e)}"
+            logger.error(error_info, exc_info=True)
+            await self.send_error_alert(error_info)
+        finally:
+            timings["total_ms"] = round((time.time() - started_at) * 1000, 1)
+            logger.info("📊 本轮耗时分解", extra={"open_id": open_id, "latency": timings})
+            record_turn(timings, failed)
+
+    async def voice_stage(self, reply, prefetches):
+        if not await asyncio.to_thread(voice_search_ready):
+            return None
+        if prefetches:
+            await asyncio.gather(*prefetches, return_exceptions=True)
+        sentences = split_sentences(reply)
+        if not sentences:
+            return None
+        vectors = await self.upstreams.get_embeddings(sentences)
+        pairs = [(s, v) for s, v in zip(sentences, vectors) if v]
+        if not pairs:
+            return None
+        nearest = await asyncio.to_thread(nearest_voices, [v for _, v in pairs])
+        hits = [(hit[0], s, hit[1]) for (s, _), hit in zip(pairs, nearest) if hit]
+        if not hits:
+            return None
+        distance, sentence, filename = min(hits)
+        if distance >= Config.VOICE_MATCH_THRESHOLD:
+            logger.warning(f"❌ 所有分句均匹配失败，最接近距离为 {distance:.4f}")
+            return None
+        logger.info(f"✨ 匹配命中! [{sentence}] -> {filename} (距离: {distance:.4f})")
+
+        path = os.path.join(Config.VOICE_LIB, filename)
+        if not os.path.exists(path):
+            return None
+        content_hash, file_key = await asyncio.to_thread(lookup_file_key, path)
+        if file_key:
+            return file_key
+        file_key = await self.upstreams.upload_audio(path)
+        if file_key:
+            await asyncio.to_thread(remember_file_key, content_hash, path, file_key)
+        return file_key
+
+    async def send_error_alert(self, error_msg):
+        admin_id = getattr(Config, 'ADMIN_OPEN_ID', None)
+        if admin_id:
+            alert_text = f"⚠️ 【存存系统告警】\n时间：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n内容：{error_msg}"
+            await self.upstreams.send_feishu(admin_id, "text", {"text": alert_text})
+
+    # --- HTTP 路由 ---
+
+    async def entry_point(self, request):
+        # 每个事件一个 trace_id；create_task / to_thread 会复制当前上下文，后续日志自动带上
+        new_trace()
+        body = await request.read()
+        if not verify_signature(request.headers, body):
+            logger.warning("🚫 收到非法请求，签名校验失败")
+            return web.json_response({"code": 403, "msg": "invalid signature"}, status=403)
+
+        try:
+            data = json.loads(body) if body else None
+        except ValueError:
+            return web.json_response({"code": 400, "msg": "invalid json"}, status=400)
+
+        if data and "encrypt" in data:
+            try:
+                data = AESCipher(Config.FEISHU_ENCRYPT_KEY).decrypt(data["encrypt"])
+            except Exception as e:
+                logger.error(f"❌ 消息解密失败: {e}")
+                return web.json_response({"code": 500, "msg": "decryption failed"}, status=500)
+
+        if data and ("challenge" in data or data.get("type") == "url_verification"):
+            return web.json_response({"challenge": data.get("challenge")})
+
+        eid = (data or {}).get("header", {}).get("event_id")
+        if not eid or not await asyncio.to_thread(dedup.first_seen, eid):
+            return web.json_response({})
+        logger.info("📥 收到事件", extra={"event_id": eid})
+
+        event = data.get("event", {})
+        if event.get("message", {}).get("message_type") == "text":
+            try:
+                user_text = json.loads(event["message"]["content"])["text"].strip()
+                open_id = event["sender"]["sender_id"]["open_id"]
+            except (KeyError, ValueError, TypeError) as e:
+                logger.warning(f"事件解析失败: {e}")
+                return web.json_response({})
+            task = asyncio.create_task(self.handle_message(open_id, user_text))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        return web.json_response({})
+
+    def dispatch_stats(self):
+        """与同步入口 UserDispatcher.stats 对应的排队状态：进行中的对话数与等待同一用户锁的用户数"""
+        inflight = Config.ASYNC_MAX_INFLIGHT - self.global_slots._value
+        return {
+            "queue_depth": max(len(self.tasks) - inflight, 0),
+            "max_inflight": Config.ASYNC_MAX_INFLIGHT,
+            "inflight": inflight,
+            "active_users": len(self.user_locks),
+            "queued_users": sum(1 for _, waiters in self.user_locks.values() if waiters > 1),
+        }
+
+    async def health(self, request):
+        status = await asyncio.to_thread(health_status, self.dispatch_stats())
+        code = 200 if status["status"] == "healthy" else 503
+        return web.json_response(status, status=code)
+
+    async def metrics_endpoint(self, request):
+        return web.Response(body=metrics.render_prometheus().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    # --- 生命周期 ---
+
+    async def on_startup(self, app):
+        await self.upstreams.start()
+        start_warm_up()
+        token_manager.start_renewal()
+
+    async def on_cleanup(self, app):
+        if self.tasks:
+            # 给进行中的对话一个收尾窗口
+            await asyncio.wait(self.tasks, timeout=Config.VOICE_STAGE_DEADLINE)
+        await self.upstreams.close()
+        flush_messages()
+
+def create_async_app():
+    server = AsyncCuncunServer()
+    app = web.Application()
+    app.router.add_post("/", server.entry_point)
+    app.router.add_get("/health", server.health)
+    app.router.add_get("/metrics", server.metrics_endpoint)
+    app.on_startup.append(server.on_startup)
+    app.on_cleanup.append(server.on_cleanup)
+    app["server"] = server
+    metrics.register_collector("dispatch", server.dispatch_stats)
+    return app
+
+if __name__ == "__main__":
+    init_db()
+    start_scheduler()
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, handle_sighup)
+
+    port = getattr(Config, 'SERVER_PORT', 8081)
+    logger.info(f"🚀 存存异步入口启动成功: {port}")
+    web.run_app(create_async_app(), host='0.0.0.0', port=port, print=None)
@@ -1,23 +1,31 @@
 import json
-import threading
-import schedule
+import sys
+import signal
 import time
-from flask import Flask, request, jsonify
-from concurrent.futures import ThreadPoolExecutor
-from collections import deque
-from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, request, jsonify
+from concurrent.futures import ThreadPoolExecutor, wait, TimeoutError as FutureTimeout
+from datetime import datetime
 
 from config import Config
-from database_manager import init_db, save_message, get_recent_history
+from database_manager import init_db, save_message, flush_messages
 from cuncun_utils import (
-    logger, upload_audio_v2, send_feishu, 
-    match_voice_file, call_ai, 
-    check_health, backup_database_task
+    logger, send_feishu, 
+    match_voice_file, call_ai, call_ai_stream,
+    prefetch_voice_embeddings, preload_voice_index, start_warm_up, token_manager,
+    new_trace, submit_traced
 )
+import metrics
+from voice_cache import get_audio_file_key
+from user_dispatcher import UserDispatcher
+from event_dedup import dedup
+from context_builder import build_context, record_usage, summarizer
+from memory_retrieval import submit_retrieval, memory_writer
+from turn_pipeline import build_prompt, record_turn, health_status, start_scheduler, handle_sighup
 
 app = Flask(__name__)
-executor = ThreadPoolExecutor(max_workers=3)
-processed_ids = deque(maxlen=1000)
+# 回复后处理的并行阶段 (语音匹配 / 上传) 专用线程池
+pipeline_executor = ThreadPoolExecutor(max_workers=Config.PIPELINE_WORKERS)
+metrics.gauge("executor_queue_depth", fn=lambda: pipeline_executor._work_queue.qsize(), executor="pipeline")
 
 # --- Phase 1.3: 错误告警机制 ---
 def send_error_alert(error_msg):
@@ -29,69 +37,160 @@ def send_error_alert(error_msg):
         send_feishu(admin_id, "text", {"text": alert_text})
         logger.info("已发送错误告警至管理员")
 
-# Prompt 提示词构建逻辑
-def build_prompt(user_text):
-    """构建带实时时间戳的提示词"""
-    # 强制北京时间 (UTC+8)
-    now = (datetime.now(timezone.utc) + timedelta(hours=8)).strftime("%Y-%m-%d %H:%M:%S")
-    
-    try:
-        with open(Config.PROMPT_PATH, "r", encoding="utf-8") as f:
-            base = f.read().strip()
-    except Exception as e:
-        logger.warning(f"读取提示词失败: {e}")
-        base = "我是存存，也可以叫我存宝。一个顶尖化妆师。"
-        
-    return f"{base}\n当前时间: {now}"
+def _ms(since):
+    return round((time.perf_counter() - since) * 1000, 1)
+
+def voice_stage(reply, prefetches):
+    """
+    语音阶段：匹配语音并取得 file_key，只依赖回复文本，可与文本保存/发送并行。
+    返回 (file_key, timings)；耗时记在本阶段自己的字典里，超时被放弃时也不会改动请求线程的 timings。
+    """
+    t = time.perf_counter()
+    timings = {"voice_match": {}}
+    # 等待进行中的预向量化完成，避免语音匹配重复请求同一批句子
+    wait(prefetches)
+    v_path = match_voice_file(reply, timings=timings["voice_match"])
+    # 同一段语音只上传一次，后续直接复用缓存的 file_key
+    f_key = get_audio_file_key(v_path) if v_path else None
+    timings["voice_ms"] = _ms(t)
+    return f_key, timings
+
+def parse_text_event(data):
+    """提取文本消息的 (open_id, user_text)，非文本消息返回 None"""
+    event = data.get("event", {})
+    if event.get("message", {}).get("message_type") != "text": return None
+    user_text = json.loads(event["message"]["content"])["text"].strip()
+    open_id = event["sender"]["sender_id"]["open_id"]
+    return open_id, user_text
 
 def core_logic(data):
-    """核心处理逻辑，集成异常告警"""
-    open_id = "未知"
+    """处理单条飞书事件 (不经调度器的直接调用入口)"""
+    parsed = parse_text_event(data)
+    if parsed:
+        handle_turn(parsed[0], [parsed[1]])
+
+def handle_turn(open_id, texts):
+    """核心处理逻辑，集成异常告警；texts 为同一用户排队期间连发、被合并处理的消息"""
+    started_at = time.time()
+    t0 = time.perf_counter()
+    timings = {}
+    failed = False
     try:
-        event = data.get("event", {})
-        if event.get("message", {}).get("message_type") != "text": return
-        
-        user_text = json.loads(event["message"]["content"])["text"].strip()
-        open_id = event["sender"]["sender_id"]["open_id"]
+        user_text = "\n".join(texts)
+        if len(texts) > 1:
+            timings["coalesced"] = len(texts)
         
         # 使用结构化日志记录输入
         logger.info(f"📩 收到用户消息", extra={"user_text": user_text, "open_id": open_id})
-        save_message(open_id, "user", user_text)
+        for text in texts:
+            save_message(open_id, "user", text)
         
-        prompt = build_prompt(user_text)
-        history = get_recent_history(open_id, limit=6)
+        t = time.perf_counter()
+        # 记忆检索先行发出，与下面的历史读取同时进行
+        retrieval = submit_retrieval(open_id, user_text)
+        prompt, prompt_version = build_prompt(user_text)
+        # 按 token 预算装入历史 (附带长期记忆摘要与检索到的记忆)，本轮消息不会在历史里重复出现
+        prompt, history, est_tokens = build_context(open_id, prompt, user_text, texts, retrieval)
+        timings["context_ms"] = _ms(t)
         
         # 记录调取历史的行为，取代 print
-        logger.info(f"正在调取历史记忆", extra={"history_count": len(history)})
+        logger.info(f"正在调取历史记忆", extra={"history_count": len(history), "est_tokens": est_tokens})
         
-        reply = call_ai(prompt, user_text, history)
-        
-        # 长文本预热回复
+        notice = None
         if len(user_text) > 50:
+            # 长文本预热回复
             notice = "喔唷，likikyou 今天写了这么多心里话呀，我正在认真读呢，稍微等我一下喔... ☕️"
-            send_feishu(open_id, "text", {"text": notice})
-        
-        save_message(open_id, "assistant", reply)
-        logger.info(f"💬 存存回复成功", extra={"reply_preview": reply[:30]})
-        
-        # 发送文本
-        send_feishu(open_id, "text", {"text": reply})
-        
-        # 语音匹配与发送
-        v_path = match_voice_file(reply)
-        if v_path:
-            f_key = upload_audio_v2(v_path)
-            if f_key:
-                send_feishu(open_id, "audio", {"file_key": f_key})
+
+        prefetches = []
+        usage = {}
+        t = time.perf_counter()
+        if Config.AI_STREAMING:
+            first_sent = []
+
+            def deliver(segment):
+                # 首段到达即推送；同时提前为已完成的句子做向量化，语音匹配不必等全文
+                if not first_sent:
+                    if notice:
+                        send_feishu(open_id, "text", {"text": notice})
+                    send_feishu(open_id, "text", {"text": segment})
+                    first_sent.append(time.time())
+                    timings["ttfv_ms"] = round((first_sent[0] - started_at) * 1000, 1)
+                    logger.info("⚡ 首段已送达", extra={"ttfv": round(first_sent[0] - started_at, 2)})
+                else:
+                    send_feishu(open_id, "text", {"text": segment})
+                future = prefetch_voice_embeddings(segment)
+                if future:
+                    prefetches.append(future)
+
+            reply = call_ai_stream(prompt, user_text, history, on_segment=deliver, usage=usage)
+        else:
+            reply = call_ai(prompt, user_text, history, usage=usage)
+        timings["ai_ms"] = _ms(t)
+        tokens = record_usage(est_tokens, usage)
+
+        # 回复就绪后语音阶段立即开跑，与文本保存/发送并行
+        voice_started = time.perf_counter()
+        voice_future = submit_traced(pipeline_executor, voice_stage, reply, prefetches)
+
+        t = time.perf_counter()
+        save_message(open_id, "assistant", reply, tokens=tokens, prompt_version=prompt_version)
+        logger.info(f"💬 存存回复成功", extra={"reply_preview": reply[:30], "prompt_version": prompt_version})
+        if not Config.AI_STREAMING:
+            if notice:
+                send_feishu(open_id, "text", {"text": notice})
+            # 发送文本
+            send_feishu(open_id, "text", {"text": reply})
+            timings["ttfv_ms"] = round((time.time() - started_at) * 1000, 1)
+            logger.info("⚡ 回复已送达", extra={"ttfv": round(time.time() - started_at, 2)})
+        timings["text_ms"] = _ms(t)
+
+        # 语音阶段有独立预算：超时直接放弃语音，不拖慢本轮对话
+        remaining = Config.VOICE_STAGE_DEADLINE - (time.perf_counter() - voice_started)
+        try:
+            f_key, voice_timings = voice_future.result(timeout=max(remaining, 0))
+            timings.update(voice_timings)
+        except FutureTimeout:
+            f_key = None
+            timings["voice_skipped"] = True
+            logger.warning("⏱️ 语音阶段超出预算，本轮跳过语音", extra={"deadline": Config.VOICE_STAGE_DEADLINE})
+
+        if f_key:
+            t = time.perf_counter()
+            send_feishu(open_id, "audio", {"file_key": f_key})
+            timings["audio_send_ms"] = _ms(t)
+
+        if Config.SUMMARY_ENABLED:
+            # 本轮实际带入的原文 + 本轮消息 + 回复之外的对话才需要压缩
+            summarizer.schedule(open_id, len(history) + len(texts) + 1)
+        if Config.MEMORY_WRITE_ENABLED:
+            memory_writer.record(open_id, user_text)
 
     except Exception as e:
+        failed = True
         error_info = f"Core Logic Error: {str(e)}"
         logger.error(error_info, exc_info=True)
         # 触发告警，确保 likikyou 能收到推送
         send_error_alert(error_info)
+    finally:
+        if timings:
+            timings["total_ms"] = _ms(t0)
+            logger.info("📊 本轮耗时分解", extra={"open_id": open_id, "latency": dict(timings)})
+        record_turn(timings, failed)
+
+dispatcher = UserDispatcher(
+    handle_turn,
+    workers=Config.WORKER_THREADS,
+    max_pending=Config.MAX_PENDING_MESSAGES,
+    coalesce=Config.COALESCE_MESSAGES,
+)
+
+# /metrics 导出的调度器状态，其余组件由 turn_pipeline 注册
+metrics.register_collector("dispatch", dispatcher.stats)
 
 @app.route("/", methods=["POST"])
 def entry_point():
+    # 每个事件一个 trace_id，随消息进入调度队列，本轮处理的所有日志都带上它
+    new_trace()
     # 1. 🛡️ 安全第一：先校验签名（Security）
     from cuncun_utils import verify_signature, AESCipher 
     if not verify_signature(request.headers, request.data):
@@ -118,15 +217,25 @@ def entry_point():
     if data and ("challenge" in data or data.get("type") == "url_verification"):
         return jsonify({"challenge": data.get("challenge")})
     
-    # 消息排重 (使用解密后的 header)
+    # 消息排重 (使用解密后的 header)：内存 O(1) 查重 + SQLite 持久登记，重启/多进程后依然有效
     eid = data.get("header", {}).get("event_id")
-    if not eid or eid in processed_ids: 
+    if not eid or not dedup.first_seen(eid): 
         return jsonify({})
-    processed_ids.append(eid)
+    logger.info("📥 收到事件", extra={"event_id": eid})
     
     
-    # 4. 🚀 异步执行核心对话逻辑
-    executor.submit(core_logic, data)
+    # 4. 🚀 按用户排队异步执行核心对话逻辑 (同一用户串行，不同用户并行)
+    try:
+        parsed = parse_text_event(data)
+    except (KeyError, ValueError, TypeError) as e:
+        logger.warning(f"事件解析失败: {e}")
+        parsed = None
+    if parsed:
+        open_id, user_text = parsed
+        if not dispatcher.submit(open_id, user_text):
+            # 过载保护：队列已满时直接告知用户，而不是让消息无限排队
+            logger.warning("🚦 消息队列已满，拒绝新消息", extra={"open_id": open_id, "dispatch": dispatcher.stats()})
+            pipeline_executor.submit(send_feishu, open_id, "text", {"text": Config.BUSY_NOTICE})
     
     # 注意：这里返回必须带 {}，代表成功接收
     return jsonify({})
@@ -135,28 +244,45 @@ def entry_point():
 @app.route("/health", methods=["GET"])
 def health_check_endpoint():
     """健康检查接口"""
-    status = check_health()
+    status = health_status(dispatcher.stats())
     code = 200 if status["status"] == "healthy" else 503
     return jsonify(status), code
 
-# --- Phase 1.2: 定时任务执行器 ---
-def run_scheduler():
-    # 1. 每天凌晨 2 点备份
-    schedule.every().day.at("02:00").do(backup_database_task)
-    
-    # 2. 每小时执行一次内部健康自检并记录日志
-    schedule.every().hour.do(check_health)
-    
-    logger.info("⏰ 定时任务调度器已启动")
-    while True:
-        schedule.run_pending()
-        time.sleep(60)
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Prometheus 抓取接口 (text exposition format)"""
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
 
-if __name__ == "__main__":
+def create_app():
+    """
+    应用工厂：初始化数据库并返回 Flask 应用。
+    gunicorn preload_app 时在 master 中执行一次，NumPy 语音索引在 fork 前加载，
+    各 worker 以写时复制方式共享；fork 之后的初始化见 init_worker。
+    """
     init_db()
+    preload_voice_index()
+    return app
+
+def init_worker():
+    """worker 进程 (或单进程服务) 的初始化：后台预热其余组件、续期飞书 token，并参与调度器选主"""
+    start_warm_up()
+    token_manager.start_renewal()
+    start_scheduler()
+
+def handle_sigterm(signum, frame):
+    """收到 SIGTERM 时先把写后队列中的对话落盘再退出"""
+    logger.info("🛑 收到退出信号，正在落盘未写入的对话")
+    flush_messages()
+    sys.exit(0)
+
+if __name__ == "__main__":
+    create_app()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, handle_sighup)
     
     # 启动后台调度线程
-    threading.Thread(target=run_scheduler, daemon=True).start()
+    init_worker()
     
     port = getattr(Config, 'SERVER_PORT', getattr(Config, 'PORT', 8081))
     logger.info(f"🚀 存存 V2.2 启动成功: {port} (带告警与定时运维)")
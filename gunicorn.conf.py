@@ -0,0 +1,33 @@
+"""
+gunicorn 多进程部署配置：
+
+    gunicorn -c gunicorn.conf.py "feishu_cuncun_pro:create_app()"
+
+- preload_app：master 先导入应用、建表并加载 NumPy 语音索引，worker 通过写时复制共享
+- Chroma 客户端不能跨 fork，由每个 worker 在 fork 之后按需打开 (post_fork 中启动后台预热)
+- 定时任务通过文件锁选出唯一执行进程；token、事件去重通过 SQLite 在进程间共享
+- 进程内的对话历史缓存看不到其他 worker 的写入，多进程模式下默认关闭
+"""
+import os
+from dotenv import load_dotenv
+
+# 先加载 .env，保证用户显式配置优先于下面的多进程默认值
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+os.environ.setdefault("HISTORY_CACHE_ENABLED", "false")
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8081')}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+preload_app = True
+timeout = 60
+graceful_timeout = 30
+
+def post_fork(server, worker):
+    from feishu_cuncun_pro import init_worker
+    init_worker()
+
+def worker_exit(server, worker):
+    # worker 退出前把写后队列中的对话落盘
+    from database_manager import flush_messages
+    flush_messages()
@@ -0,0 +1,135 @@
+import os
+import time
+import threading
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+from config import Config
+
+# --- 共享 HTTP 连接池 ---
+# 飞书 / DeepSeek / 硅基流动的所有调用共用 keep-alive Session，
+# 省去每次请求的 TCP + TLS 握手；429/5xx 自动退避重试，并按 host 记录延迟直方图。
+# 重发不安全的 POST (如上传文件，没有 uuid 去重) 走单独的 Session，只在连接建立失败时重试：
+# 读超时或 5xx 时服务端可能已经处理过，重发会产生重复文件。
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+_sessions = {}   # idempotent -> Session
+_session_lock = threading.Lock()
+
+def _reset_after_fork():
+    # keep-alive 连接是套接字，不能在 fork 出的进程间共用，子进程按需重建 Session
+    global _sessions, _session_lock
+    _sessions = {}
+    _session_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+class _CappedRetry(Retry):
+    """服从 Retry-After，但最多等待 HTTP_RETRY_AFTER_MAX 秒，避免上游一句 Retry-After: 120 卡住工作线程"""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, Config.HTTP_RETRY_AFTER_MAX)
+
+def _build_retry(idempotent=True):
+    # 不在 allowed_methods 里的方法只重试连接错误 (请求尚未发出)，读错误与 429/5xx 直接返回
+    return _CappedRetry(
+        total=Config.HTTP_MAX_RETRIES,
+        connect=Config.HTTP_MAX_RETRIES,
+        backoff_factor=Config.HTTP_BACKOFF,
+        status_forcelist=RETRY_STATUS,
+        allowed_methods=frozenset({"GET", "POST"} if idempotent else {"GET"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+def get_session(idempotent=True):
+    """进程级共享 Session (线程安全的懒加载)；idempotent=False 时返回只重试连接错误的 Session"""
+    session = _sessions.get(idempotent)
+    if session is None:
+        with _session_lock:
+            session = _sessions.get(idempotent)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=Config.HTTP_POOL_HOSTS,
+                    pool_maxsize=Config.HTTP_POOL_SIZE,
+                    max_retries=_build_retry(idempotent),
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _sessions[idempotent] = session
+    return session
+
+def record_request(host, started, status):
+    """记录一次上游请求的耗时与状态 (同步/异步客户端共用)"""
+    metrics.histogram("http_request_seconds", host=host).observe(time.perf_counter() - started)
+    metrics.counter("http_requests_total", host=host, status=status).inc()
+
+def request(method, url, idempotent=True, **kwargs):
+    """经共享连接池发起请求，并记录该 host 的耗时与状态码；重发不安全的请求传 idempotent=False"""
+    host = urlsplit(url).hostname or "unknown"
+    started = time.perf_counter()
+    try:
+        r = get_session(idempotent).request(method, url, **kwargs)
+    except Exception:
+        record_request(host, started, "error")
+        raise
+    record_request(host, started, str(r.status_code))
+    return r
+
+def post(url, idempotent=True, **kwargs):
+    return request("POST", url, idempotent=idempotent, **kwargs)
+
+def host_latency_stats():
+    """各 host 的请求次数与延迟分位数 (秒)"""
+    stats = {}
+    for labels, snap in metrics.collect("http_request_seconds"):
+        stats[labels["host"]] = {k: snap[k] for k in ("count", "sum", "p50", "p95", "p99")}
+    return stats
+
+# --- OpenAI 客户端共用同一套连接池配置 ---
+
+def _httpx_on_request(request):
+    request.extensions["started"] = time.perf_counter()
+
+def _httpx_on_response(response):
+    started = response.request.extensions.get("started")
+    if started is not None:
+        record_request(response.request.url.host, started, str(response.status_code))
+
+def build_openai_http_client():
+    return httpx.Client(
+        limits=httpx.Limits(
+            max_connections=Config.HTTP_POOL_SIZE,
+            max_keepalive_connections=Config.HTTP_POOL_SIZE,
+        ),
+        timeout=httpx.Timeout(60.0, connect=10.0),
+        event_hooks={"request": [_httpx_on_request], "response": [_httpx_on_response]},
+    )
+
+async def _httpx_on_request_async(request):
+    _httpx_on_request(request)
+
+async def _httpx_on_response_async(response):
+    _httpx_on_response(response)
+
+def build_openai_async_http_client():
+    """异步入口 (AsyncOpenAI) 使用的连接池，限额与同步版一致"""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=Config.ASYNC_MAX_INFLIGHT,
+            max_keepalive_connections=Config.HTTP_POOL_SIZE,
+        ),
+        timeout=httpx.Timeout(60.0, connect=10.0),
+        event_hooks={"request": [_httpx_on_request_async], "response": [_httpx_on_response_async]},
+    )
@@ -0,0 +1,245 @@
+import os
+import copy
+import gzip
+import time
+import queue
+import atexit
+import random
+import shutil
+import logging
+import threading
+import contextlib
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只支持单进程写日志
+    fcntl = None
+
+# --- 异步日志管道 ---
+# 业务线程只把日志记录放进有界队列，JSON 格式化与写文件/屏幕都由一个后台线程完成；
+# 队列满时直接丢弃并计数，绝不让请求线程等待磁盘。
+# 日志文件按大小或按时间轮转，旧文件 gzip 压缩；多个 worker 写同一文件时，
+# 轮转在文件锁内进行，其余进程发现文件已被换掉后重新打开，不会重复轮转。
+
+class DebugSampler(logging.Filter):
+    """DEBUG 记录按比例采样，并限制每秒最多输出 per_second 条；INFO 及以上全部放行"""
+
+    def __init__(self, ratio=1.0, per_second=0):
+        super().__init__()
+        self.ratio = ratio
+        self.per_second = per_second
+        self._window = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._suppressed = metrics.counter("log_sampled_out_total")
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        if self.ratio < 1.0 and random.random() >= self.ratio:
+            self._suppressed.inc()
+            return False
+        if self.per_second:
+            now = int(time.monotonic())
+            with self._lock:
+                if now != self._window:
+                    self._window, self._count = now, 0
+                self._count += 1
+                allowed = self._count <= self.per_second
+            if not allowed:
+                self._suppressed.inc()
+                return False
+        return True
+
+# LogRecord 自带的属性；其余都是 extra= 传入的字段
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+_IMMUTABLE = (str, int, float, bool, type(None))
+
+def _snapshot(value):
+    """extra 字段可能是调用方随后还会修改的 dict/list，入队前复制一份；无法复制的退化为 repr"""
+    if isinstance(value, _IMMUTABLE):
+        return value
+    try:
+        return copy.deepcopy(value)
+    except Exception:
+        return repr(value)
+
+class DroppingQueueHandler(QueueHandler):
+    """入队不阻塞：队列满时丢弃该条日志并计入 log_dropped_total"""
+
+    def __init__(self, maxsize, on_enqueue=None):
+        super().__init__(queue.Queue(maxsize))
+        self.on_enqueue = on_enqueue
+        self.direct = None          # 管道停止后 (进程退出阶段) 改为同步写这些 handler
+        self._dropped = metrics.counter("log_dropped_total")
+
+    def prepare(self, record):
+        # 在调用线程里只做 % 参数替换、异常文本和 extra 字段的快照 (这些对象之后都可能被调用方修改)，
+        # JSON 格式化留给后台线程
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        for key, value in list(vars(record).items()):
+            if key not in _RECORD_ATTRS:
+                setattr(record, key, _snapshot(value))
+        return record
+
+    def enqueue(self, record):
+        if self.direct is not None:
+            for handler in self.direct:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            return
+        if self.on_enqueue:
+            self.on_enqueue()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._dropped.inc()
+
+    @property
+    def dropped(self):
+        return self._dropped.value
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # 默认实现 put_nowait，队列满时退出会报错；这里等后台线程腾出位置
+        self.queue.put(self._sentinel, timeout=5)
+
+class LogPipeline:
+    """持有有界队列与后台写日志线程；线程在第一条日志入队时才启动，fork 后在子进程里重新建立"""
+
+    def __init__(self, handlers, maxsize=10000):
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.queue_handler = DroppingQueueHandler(maxsize, on_enqueue=self._ensure_listener)
+        self._listener = None
+        self._lock = threading.Lock()
+        atexit.register(self.stop)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _ensure_listener(self):
+        if self._listener is None:
+            with self._lock:
+                if self._listener is None:
+                    listener = _Listener(self.queue_handler.queue, *self.handlers, respect_handler_level=True)
+                    listener.start()
+                    listener._thread.name = "log-writer"
+                    self._listener = listener
+
+    def _reset_after_fork(self):
+        # 父进程的写日志线程不会带到子进程；队列里尚未写出的记录由父进程负责，子进程换一个空队列
+        self.queue_handler.queue = queue.Queue(self.maxsize)
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def stop(self):
+        """写完队列中剩余的日志后停止后台线程 (退出时自动调用)，之后的日志同步写出"""
+        with self._lock:
+            listener, self._listener = self._listener, None
+            self.queue_handler.direct = self.handlers
+        if listener is not None:
+            try:
+                listener.stop()
+            except queue.Full:
+                pass
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_handler.queue.qsize(),
+            "max_size": self.maxsize,
+            "dropped": self.queue_handler.dropped,
+            "running": self._listener is not None,
+        }
+
+# --- 文件轮转 ---
+
+def _gzip_namer(name):
+    return name + ".gz"
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+@contextlib.contextmanager
+def _rotation_lock(path):
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class _SharedRotationMixin:
+    """轮转前加锁复查：文件已被别的进程轮转过就只重新打开，不再重复轮转"""
+
+    def _remember(self):
+        st = os.fstat(self.stream.fileno())
+        self._ident = (st.st_dev, st.st_ino)
+
+    def _rotated_elsewhere(self):
+        try:
+            st = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return True
+        return (st.st_dev, st.st_ino) != self._ident
+
+    def _reopen(self):
+        if self.stream:
+            self.stream.close()
+        self.stream = self._open()
+        self._remember()
+
+    def _after_reopen(self):
+        pass
+
+    def shouldRollover(self, record):
+        if self.stream is not None and self._rotated_elsewhere():
+            self._reopen()
+            self._after_reopen()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        with _rotation_lock(self.baseFilename):
+            if self.stream is not None and self._rotated_elsewhere():
+                self._reopen()
+                self._after_reopen()
+                return
+            super().doRollover()
+            self._remember()
+
+class SizeRotatingFileHandler(_SharedRotationMixin, RotatingFileHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._remember()
+
+class TimeRotatingFileHandler(_SharedRotationMixin, TimedRotatingFileHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._remember()
+
+    def _after_reopen(self):
+        self.rolloverAt = self.computeRollover(int(time.time()))
+
+def build_file_handler(path, max_bytes=0, when="", backup_count=10, compress=True):
+    """when 非空时按时间轮转 (如 midnight)，否则 max_bytes > 0 时按大小轮转，都为空则不轮转"""
+    if when:
+        handler = TimeRotatingFileHandler(path, when=when, backupCount=backup_count, encoding="utf-8")
+    elif max_bytes > 0:
+        handler = SizeRotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    else:
+        return logging.FileHandler(path, encoding="utf-8")
+    if compress:
+        handler.namer = _gzip_namer
+        handler.rotator = _gzip_rotator
+    return handler
@@ -0,0 +1,164 @@
+import re
+import time
+import hashlib
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import metrics
+from config import Config
+from cuncun_utils import logger, get_embeddings, get_bio_collection, submit_traced
+from database_manager import save_memory_facts, get_pending_memory_facts, mark_memory_facts_indexed
+
+# --- 长期记忆检索 (cuncun_bio) ---
+# 用户消息向量化一次，分别取"存存的人物小传"(无 kind 元数据) 与"该用户的对话事实"(open_id 过滤) 的 top-k，
+# 按距离合并。检索在独立线程中与历史读取同时进行，超过 MEMORY_DEADLINE 直接放弃，不拖慢回复。
+
+_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="memory")
+metrics.gauge("executor_queue_depth", fn=lambda: _pool._work_queue.qsize(), executor="memory_retrieval")
+
+def _query(collection, vec, k, where=None):
+    try:
+        res = collection.query(query_embeddings=[vec], n_results=k, where=where,
+                               include=["documents", "metadatas", "distances"])
+    except Exception as e:
+        # 过滤条件下没有任何匹配时部分 Chroma 版本会抛错，按无结果处理
+        logger.debug(f"记忆检索无结果: {e}")
+        return []
+    return list(zip(res["distances"][0], res["documents"][0], res["metadatas"][0]))
+
+def search_memories(open_id, user_text, k):
+    """返回与 user_text 最相关的记忆片段 (按距离升序)"""
+    collection = get_bio_collection()
+    if collection is None:
+        return []
+    # 用户消息几乎不会重复，不进 embedding 缓存
+    vec = get_embeddings([user_text], cache=False)[0]
+    if vec is None:
+        return []
+    # 小传条目没有 kind 元数据，$ne 过滤会保留它们并排除所有用户的对话事实
+    hits = _query(collection, vec, k, where={"kind": {"$ne": "fact"}})
+    hits += _query(collection, vec, k, where={"open_id": open_id})
+    hits.sort(key=lambda h: h[0])
+    docs = []
+    for _, doc, _ in hits:
+        if doc and doc not in docs:
+            docs.append(doc)
+    return docs[:k]
+
+def _timed_search(open_id, user_text, k):
+    start = time.perf_counter()
+    try:
+        return search_memories(open_id, user_text, k)
+    finally:
+        metrics.histogram("memory_retrieval_seconds").observe(time.perf_counter() - start)
+
+def submit_retrieval(open_id, user_text):
+    """后台发起检索并返回 future；未启用或记忆库不可用时返回 None"""
+    if not Config.MEMORY_RETRIEVAL_ENABLED or get_bio_collection() is None:
+        return None
+    future = submit_traced(_pool, _timed_search, open_id, user_text, Config.MEMORY_TOP_K)
+    future.deadline = time.monotonic() + Config.MEMORY_DEADLINE
+    return future
+
+def collect_memories(future):
+    """在截止时间内取回检索结果；超时或失败返回空列表"""
+    if future is None:
+        return []
+    try:
+        return future.result(timeout=max(future.deadline - time.monotonic(), 0))
+    except FutureTimeout:
+        metrics.counter("memory_retrieval_timeout_total").inc()
+        logger.warning("⏱️ 记忆检索超出预算，本轮跳过", extra={"deadline": Config.MEMORY_DEADLINE})
+    except Exception as e:
+        logger.warning(f"记忆检索失败: {e}")
+    return []
+
+# --- 对话事实回写 ---
+# 每轮对话后从用户消息中挑出自我表述 (身份、喜好、计划、经历等) 登记到 SQLite 的 memory_facts 表；
+# 由持有调度器锁的进程定期批量向量化、一次 upsert 写入 cuncun_bio，多 worker 部署时也只有一个写入方。
+
+_FACT_SPLIT = re.compile(r"[。！？!?\n]+")
+_FACT_HINTS = re.compile(
+    r"我(?:是|叫|在|的|家|们|喜欢|不喜欢|讨厌|爱|想|怕|害怕|打算|准备|要去|养了|住)"
+    r"|生日|工作|考试|毕业|搬家|纪念日"
+)
+
+def extract_facts(user_text):
+    """挑出值得长期记住的句子 (规则筛选，不额外调用大模型)"""
+    facts = []
+    for sentence in _FACT_SPLIT.split(user_text):
+        sentence = sentence.strip()
+        if 6 <= len(sentence) <= 200 and _FACT_HINTS.search(sentence) and sentence not in facts:
+            facts.append(sentence)
+    return facts
+
+class MemoryWriter:
+    def __init__(self, batch_size=64):
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-writer")
+        self._index_lock = threading.Lock()
+        self.recorded = 0
+        self.indexed = 0
+        self.failures = 0
+
+    def record(self, open_id, user_text):
+        """登记本轮的对话事实 (在后台线程写库，不占用回复链路)"""
+        facts = extract_facts(user_text)
+        if facts:
+            self.recorded += len(facts)
+            submit_traced(self._executor, save_memory_facts, [(open_id, f) for f in facts])
+
+    def index_pending(self):
+        """把未入库的事实分批向量化并写入 cuncun_bio，返回本次写入条数"""
+        collection = get_bio_collection()
+        if collection is None or not self._index_lock.acquire(blocking=False):
+            return 0
+        written = 0
+        try:
+            while True:
+                rows = get_pending_memory_facts(self.batch_size)
+                if not rows:
+                    break
+                start = time.perf_counter()
+                # 向量随事实写入 cuncun_bio，无需再进 embedding 缓存
+                vectors = get_embeddings([content for _, _, content in rows], cache=False)
+                done = [(row, vec) for row, vec in zip(rows, vectors) if vec is not None]
+                if done:
+                    now = datetime.now().isoformat()
+                    collection.upsert(
+                        ids=[f"fact-{hashlib.sha1(f'{uid}:{content}'.encode('utf-8')).hexdigest()[:16]}"
+                             for (_, uid, content), _ in done],
+                        embeddings=[vec for _, vec in done],
+                        documents=[content for (_, _, content), _ in done],
+                        metadatas=[{"open_id": uid, "kind": "fact", "created_at": now} for (_, uid, _), _ in done],
+                    )
+                    mark_memory_facts_indexed([row[0] for row, _ in done])
+                    written += len(done)
+                    logger.info("🧠 对话事实已写入记忆库", extra={
+                        "count": len(done), "duration_ms": round((time.perf_counter() - start) * 1000, 1)
+                    })
+                if len(done) < len(rows):
+                    # 向量化部分失败：剩余的留到下一轮重试
+                    self.failures += len(rows) - len(done)
+                    break
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"记忆库写入失败: {e}")
+        finally:
+            self.indexed += written
+            self._index_lock.release()
+        return written
+
+    def stats(self):
+        retrieval = metrics.histogram("memory_retrieval_seconds").snapshot()
+        return {
+            "recorded": self.recorded,
+            "indexed": self.indexed,
+            "failures": self.failures,
+            "retrieval_p50": retrieval["p50"],
+            "retrieval_p95": retrieval["p95"],
+            "timeouts": metrics.counter("memory_retrieval_timeout_total").value,
+        }
+
+memory_writer = MemoryWriter(batch_size=Config.MEMORY_INDEX_BATCH)
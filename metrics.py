@@ -0,0 +1,208 @@
+import math
+import time
+import bisect
+import functools
+import threading
+
+# --- 进程内指标 ---
+# 轻量直方图/计数器/仪表，按 (名称, 标签) 注册，供日志、健康检查与 /metrics 导出使用。
+# 多 worker 部署时指标按进程统计，每次抓取反映的是接到请求的那个 worker。
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)   # 最后一格为 +Inf
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[idx] += 1
+            self._sum += value
+            self._count += 1
+
+    def quantile(self, q):
+        """按桶上界估算分位数"""
+        with self._lock:
+            counts, total = list(self._counts), self._count
+        if not total:
+            return 0.0
+        rank, seen = q * total, 0
+        for i, c in enumerate(counts):
+            seen += c
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def snapshot(self):
+        with self._lock:
+            counts, total, s = list(self._counts), self._count, self._sum
+        cumulative, acc = {}, 0
+        for le, c in zip(self.buckets + (float("inf"),), counts):
+            acc += c
+            cumulative[le] = acc
+        return {
+            "count": total,
+            "sum": round(s, 6),
+            "buckets": cumulative,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+class Gauge:
+    """当前值；传入 fn 时每次读取都调用它 (如队列深度)"""
+
+    def __init__(self):
+        self._value = 0
+        self.fn = None
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        return self.fn() if self.fn else self._value
+
+_registry = {}
+_registry_lock = threading.Lock()
+_collectors = {}
+
+def _get(kind, name, labels):
+    key = (kind.__name__, name, tuple(sorted(labels.items())))
+    metric = _registry.get(key)
+    if metric is None:
+        with _registry_lock:
+            metric = _registry.setdefault(key, kind())
+    return metric
+
+def histogram(name, **labels):
+    return _get(Histogram, name, labels)
+
+def counter(name, **labels):
+    return _get(Counter, name, labels)
+
+def gauge(name, fn=None, **labels):
+    metric = _get(Gauge, name, labels)
+    if fn is not None:
+        metric.fn = fn
+    return metric
+
+def register_collector(name, fn):
+    """登记一个返回 stats 字典的函数，导出时其中的数值项作为 <name>_<key> 仪表"""
+    _collectors[name] = fn
+
+class timed:
+    """
+    阶段耗时统计，记录到 stage_seconds{stage=...}，异常计入 stage_errors_total。
+    既可以作 with 语句 (结束后 .ms 为耗时毫秒)，也可以作函数装饰器：
+
+        with metrics.timed("context") as span: ...
+        @metrics.timed("feishu_send")
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.ms = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._start
+        self.ms = round(elapsed * 1000, 1)
+        histogram("stage_seconds", stage=self.stage).observe(elapsed)
+        if exc_type is not None:
+            counter("stage_errors_total", stage=self.stage).inc()
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(self.stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+def collect(name):
+    """返回某个指标全部标签组合的快照：[(labels, value), ...]"""
+    results = []
+    with _registry_lock:
+        items = list(_registry.items())
+    for (kind, metric_name, labels), metric in items:
+        if metric_name != name:
+            continue
+        value = metric.snapshot() if kind == "Histogram" else metric.value
+        results.append((dict(labels), value))
+    return results
+
+# --- Prometheus 文本格式导出 ---
+
+PROM_PREFIX = "cuncun_"
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def render_prometheus():
+    """把全部指标与 collector 导出为 Prometheus text exposition format (0.0.4)"""
+    with _registry_lock:
+        items = sorted(_registry.items(), key=lambda kv: (kv[0][1], kv[0][2]))
+    lines, typed = [], set()
+    for (kind, name, labels), metric in items:
+        full = PROM_PREFIX + name
+        if full not in typed:
+            typed.add(full)
+            lines.append(f"# TYPE {full} {kind.lower()}")
+        if kind == "Histogram":
+            snap = metric.snapshot()
+            for le, count in snap["buckets"].items():
+                lines.append(f"{full}_bucket{_format_labels(labels + (('le', _format_value(float(le))),))} {count}")
+            lines.append(f"{full}_sum{_format_labels(labels)} {_format_value(snap['sum'])}")
+            lines.append(f"{full}_count{_format_labels(labels)} {snap['count']}")
+        else:
+            try:
+                value = metric.value
+            except Exception:
+                continue
+            lines.append(f"{full}{_format_labels(labels)} {_format_value(value)}")
+
+    for name, fn in sorted(_collectors.items()):
+        try:
+            stats = fn()
+        except Exception:
+            continue
+        for key, value in sorted(stats.items()):
+            if value is None or not isinstance(value, (int, float)):
+                continue
+            full = f"{PROM_PREFIX}{name}_{key}"
+            lines.append(f"# TYPE {full} gauge")
+            lines.append(f"{full} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,113 @@
+import os
+import time
+import hashlib
+import threading
+from string import Template
+from datetime import datetime, timedelta, timezone
+
+from config import Config
+from cuncun_utils import logger
+
+# --- 系统提示词管理 ---
+# 模板只在文件变化时重新读取 (按 mtime/size 判断，stat 本身也做节流)，也可以通过 SIGHUP 强制重载；
+# 每次渲染只替换占位符，不再有逐条消息的磁盘 I/O。
+# 模板内容的哈希作为 prompt_version 随助手回复一起入库，便于按版本对比人设效果。
+#
+# 支持的占位符：${beijing_time}  ${beijing_date}  ${weekday}
+# 模板中没有出现 ${beijing_time} 时，沿用旧行为在末尾追加一行"当前时间"。
+
+FALLBACK_PROMPT = "我是存存，也可以叫我存宝。一个顶尖化妆师。"
+WEEKDAYS = "一二三四五六日"
+
+def _identifiers(template):
+    # Template.get_identifiers() 要到 Python 3.11 才有，这里直接用模板的占位符正则扫描
+    names = set()
+    for match in template.pattern.finditer(template.template):
+        name = match.group("named") or match.group("braced")
+        if name:
+            names.add(name)
+    return names
+
+class PromptManager:
+    def __init__(self, path, check_interval=2.0, fallback=FALLBACK_PROMPT):
+        self.path = path
+        self.check_interval = check_interval
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self._template = None
+        self._append_time = True
+        self._fingerprint = None
+        self._next_check = 0.0
+        self._reload_requested = False
+        self.version = None
+        self.loaded_at = None
+        self.reloads = 0
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _load(self, fingerprint):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                text = f.read().strip()
+        except Exception as e:
+            # 读取失败时保留上一版模板；从未成功加载过才使用兜底人设
+            logger.warning(f"⚠️ 读取提示词失败: {e}")
+            if self._template is not None:
+                self._fingerprint = fingerprint
+                return
+            text = self.fallback
+        template = Template(text)
+        self._template = template
+        self._append_time = "beijing_time" not in _identifiers(template)
+        self._fingerprint = fingerprint
+        self.version = hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+        self.loaded_at = time.time()
+        self.reloads += 1
+        logger.info(f"📝 提示词已加载: version={self.version}")
+
+    def request_reload(self):
+        """标记下一次渲染前强制重读 (可在信号处理函数中调用)"""
+        self._reload_requested = True
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._template is not None and not self._reload_requested and now < self._next_check:
+            return
+        with self._lock:
+            if self._template is not None and not self._reload_requested and now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+            fingerprint = self._stat()
+            if self._reload_requested or self._template is None or fingerprint != self._fingerprint:
+                self._reload_requested = False
+                self._load(fingerprint)
+
+    def render(self):
+        """返回 (渲染后的系统提示词, prompt_version)"""
+        self._refresh()
+        template, append_time, version = self._template, self._append_time, self.version
+        # 强制北京时间 (UTC+8)
+        now = datetime.now(timezone.utc) + timedelta(hours=8)
+        values = {
+            "beijing_time": now.strftime("%Y-%m-%d %H:%M:%S"),
+            "beijing_date": now.strftime("%Y-%m-%d"),
+            "weekday": f"星期{WEEKDAYS[now.weekday()]}",
+        }
+        text = template.safe_substitute(values)
+        if append_time:
+            text = f"{text}\n当前时间: {values['beijing_time']}"
+        return text, version
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "reloads": self.reloads,
+            "loaded_at": datetime.fromtimestamp(self.loaded_at).isoformat() if self.loaded_at else None,
+        }
+
+prompt_manager = PromptManager(Config.PROMPT_PATH, check_interval=Config.PROMPT_RELOAD_INTERVAL)
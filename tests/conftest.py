@@ -0,0 +1,16 @@
+import os
+import sys
+import tempfile
+
+# 配置在导入时读取环境变量：先把数据库、日志、语音索引指到临时目录，测试不碰 data/ 与 logs/
+_workdir = tempfile.mkdtemp(prefix="cuncun-tests-")
+os.environ["DB_PATH"] = os.path.join(_workdir, "test.db")
+os.environ["LOG_FILE"] = os.path.join(_workdir, "test.log")
+os.environ["LOG_ASYNC"] = "false"
+os.environ["WARMUP_ON_START"] = "false"
+os.environ["SILICONFLOW_API_KEY"] = "test"
+os.environ["ASSETS_PATH"] = os.path.join(_workdir, "assets")
+os.environ["MEMORY_PATH"] = os.path.join(_workdir, "memory")
+os.environ["VOICE_INDEX_PATH"] = os.path.join(_workdir, "voice_index.npy")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
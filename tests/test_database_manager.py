@@ -0,0 +1,18 @@
+import database_manager
+from database_manager import init_db, get_user_summary, save_user_summary, clear_user_history
+
+def test_summary_served_from_memory_after_save(monkeypatch):
+    init_db()
+    assert save_user_summary("ou_summary", "喜欢喝拿铁", 10)
+
+    def fail(user_id):
+        raise AssertionError("摘要不应再查库")
+    monkeypatch.setattr(database_manager, "_load_user_summary", fail)
+    assert get_user_summary("ou_summary") == ("喜欢喝拿铁", 10)
+
+def test_clear_user_history_drops_cached_summary():
+    init_db()
+    save_user_summary("ou_reset", "旧摘要", 5)
+    assert get_user_summary("ou_reset") == ("旧摘要", 5)
+    assert clear_user_history("ou_reset")
+    assert get_user_summary("ou_reset") == ("", 0)
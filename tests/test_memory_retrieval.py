@@ -0,0 +1,23 @@
+import cuncun_utils
+import memory_retrieval
+from database_manager import init_db, get_db_connection
+
+class FakeBioCollection:
+    def query(self, query_embeddings, n_results, where=None, include=None):
+        return {"distances": [[0.1]], "documents": [["存存是一个顶尖化妆师"]], "metadatas": [[None]]}
+
+def _cached_rows():
+    return get_db_connection().execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+
+def test_search_does_not_persist_query_embeddings(monkeypatch):
+    init_db()
+    monkeypatch.setattr(cuncun_utils, "_request_embeddings", lambda texts: [[0.1, 0.2, 0.3] for _ in texts])
+    monkeypatch.setattr(memory_retrieval, "get_bio_collection", lambda: FakeBioCollection())
+    before = _cached_rows()
+    memory_before = cuncun_utils.embedding_cache.stats()["memory_size"]
+
+    for i in range(5):
+        assert memory_retrieval.search_memories("ou_test", f"第{i}条一次性的用户消息", 3)
+
+    assert _cached_rows() == before
+    assert cuncun_utils.embedding_cache.stats()["memory_size"] == memory_before
@@ -0,0 +1,14 @@
+import numpy as np
+
+from voice_index import VoiceIndex
+
+def test_empty_index_returns_no_match_per_vector():
+    index = VoiceIndex(np.zeros((0, 3), dtype=np.float32), [])
+    assert index.query([[0.1, 0.2, 0.3], [0.3, 0.2, 0.1]]) == [None, None]
+    assert index.query([]) == []
+
+def test_query_returns_nearest_filename():
+    matrix = np.asarray([[1.0, 0.0], [0.0, 1.0]], dtype=np.float32)
+    index = VoiceIndex(matrix, ["a.opus", "b.opus"])
+    hits = index.query([[0.9, 0.1], [0.1, 0.9]])
+    assert [filename for _, filename in hits] == ["a.opus", "b.opus"]
@@ -0,0 +1,102 @@
+import os
+import time
+import threading
+import schedule
+
+import metrics
+from config import Config
+from database_manager import journal, history_cache, DB_PATH
+from cuncun_utils import logger, check_health, token_manager
+from embedding_cache import embedding_cache
+from db_backup import backup_database_task
+from event_dedup import dedup
+from prompt_manager import prompt_manager
+from context_builder import summarizer
+from memory_retrieval import memory_writer
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只支持单进程运行
+    fcntl = None
+
+# --- 同步/异步入口共用的对话流程组件 ---
+# 提示词构建、单轮耗时统计、/health 内容、定时任务与 SIGHUP 处理都放在这里，
+# 两个入口各自只保留自己的 Web 框架与并发模型，异步入口不会因此构建 Flask 应用和线程池。
+
+# /metrics 导出的各组件状态 (队列深度、缓存命中率等)，与 /health 中的数值一致；调度器状态由各入口注册
+metrics.register_collector("journal", journal.stats)
+metrics.register_collector("dedup", dedup.stats)
+metrics.register_collector("embedding_cache", embedding_cache.stats)
+metrics.register_collector("history_cache", history_cache.stats)
+metrics.register_collector("feishu_token", token_manager.stats)
+metrics.register_collector("prompt", prompt_manager.stats)
+metrics.register_collector("summaries", summarizer.stats)
+metrics.register_collector("memory", memory_writer.stats)
+
+# Prompt 提示词构建逻辑
+def build_prompt(user_text):
+    """构建带实时时间戳的提示词，返回 (prompt, prompt_version)；模板由 prompt_manager 缓存并热加载"""
+    return prompt_manager.render()
+
+def record_turn(timings, failed=False):
+    """把本轮耗时分解 (xxx_ms) 计入 turn_phase_seconds 直方图，同步/异步入口共用"""
+    metrics.counter("turns_total").inc()
+    if failed:
+        metrics.counter("turn_errors_total").inc()
+    for key, value in timings.items():
+        if key.endswith("_ms") and isinstance(value, (int, float)):
+            metrics.histogram("turn_phase_seconds", phase=key[:-3]).observe(value / 1000)
+
+def health_status(dispatch_stats):
+    """/health 返回内容 (两个入口结构一致)；dispatch_stats 为各入口自己的排队状态"""
+    status = check_health()
+    status["queues"] = {"dispatch": dispatch_stats, "journal": journal.stats(), "dedup": dedup.stats()}
+    status["prompt"] = prompt_manager.stats()
+    status["summaries"] = summarizer.stats()
+    status["memory"] = memory_writer.stats()
+    return status
+
+# --- Phase 1.2: 定时任务执行器 ---
+# 多进程部署时每个 worker 都会启动调度线程，但只有抢到文件锁的那一个真正执行任务，
+# 避免备份等任务被执行 N 次；持锁进程退出后锁由内核释放，其余进程在下一轮重试时接管
+SCHEDULER_LOCK_PATH = os.path.join(os.path.dirname(DB_PATH), "scheduler.lock")
+_scheduler_lock_file = None
+
+def _acquire_scheduler_lock():
+    global _scheduler_lock_file
+    if fcntl is None:
+        return True
+    f = open(SCHEDULER_LOCK_PATH, "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _scheduler_lock_file = f
+    return True
+
+def run_scheduler():
+    while not _acquire_scheduler_lock():
+        time.sleep(60)
+
+    # 1. 每天凌晨 2 点备份
+    schedule.every().day.at("02:00").do(backup_database_task)
+
+    # 2. 每小时执行一次内部健康自检并记录日志
+    schedule.every().hour.do(check_health)
+
+    # 3. 定期把新登记的对话事实批量写入长期记忆库 (只在持锁进程中执行，避免多进程并发写 Chroma)
+    if Config.MEMORY_WRITE_ENABLED:
+        schedule.every(Config.MEMORY_INDEX_INTERVAL).seconds.do(memory_writer.index_pending)
+
+    logger.info("⏰ 定时任务调度器已启动", extra={"pid": os.getpid()})
+    while True:
+        schedule.run_pending()
+        time.sleep(60)
+
+def start_scheduler():
+    threading.Thread(target=run_scheduler, name="scheduler", daemon=True).start()
+
+def handle_sighup(signum, frame):
+    """收到 SIGHUP 时在下一条消息前重新加载提示词模板"""
+    prompt_manager.request_reload()
@@ -0,0 +1,129 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+
+import metrics
+
+# 与 cuncun_utils 同名的 logger (handler 由 setup_logging 挂载)，调度器本身不依赖业务模块
+logger = logging.getLogger("feishu-utils")
+
+# --- 按用户有序调度 ---
+# 同一 open_id 的消息严格串行、按到达顺序处理，不同用户在工作线程间并行；
+# 用户在处理期间连续发来的多条消息会合并成一次 AI 调用；
+# 全局排队数超过上限时直接拒绝 (由调用方发送"忙碌"提示)，避免高峰期队列无限增长。
+# 每条消息记下投递时的上下文 (trace_id 等)，处理时沿用；合并处理的一批沿用第一条的上下文。
+
+class UserDispatcher:
+    def __init__(self, handler, workers=3, max_pending=200, coalesce=True, name="dispatch"):
+        self.handler = handler
+        self.max_pending = max_pending
+        self.coalesce = coalesce
+        self._queues = {}          # open_id -> deque[(item, enqueued_at, context)]
+        self._ready = deque()      # 有待处理消息且未被占用的用户，轮转保证公平
+        self._active = set()
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._wait_hist = metrics.histogram("dispatch_wait_seconds")
+        self._shed = metrics.counter("dispatch_shed_total")
+        self._coalesced = metrics.counter("dispatch_coalesced_total")
+        self._errors = metrics.counter("dispatch_handler_errors_total")
+        self.workers = workers
+        self.name = name
+        self._threads = []
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # fork 出的 worker 进程里没有父进程的调度线程，清空状态后由首次投递重新拉起
+        self._queues, self._ready, self._active, self._pending = {}, deque(), set(), 0
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def _ensure_workers(self):
+        # 首次投递时才启动工作线程，导入模块不产生副作用
+        if not self._threads:
+            self._threads = [
+                threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            for t in self._threads:
+                t.start()
+
+    def submit(self, open_id, item):
+        """投递一条消息；队列已满时返回 False"""
+        with self._cond:
+            self._ensure_workers()
+            if self._pending >= self.max_pending:
+                self._shed.inc()
+                return False
+            queue = self._queues.setdefault(open_id, deque())
+            queue.append((item, time.monotonic(), contextvars.copy_context()))
+            self._pending += 1
+            if open_id not in self._active and len(queue) == 1:
+                self._ready.append(open_id)
+                self._cond.notify()
+        return True
+
+    def _take(self):
+        with self._cond:
+            while not self._ready:
+                self._cond.wait()
+            open_id = self._ready.popleft()
+            queue = self._queues[open_id]
+            if self.coalesce:
+                batch = list(queue)
+                queue.clear()
+            else:
+                batch = [queue.popleft()]
+            self._pending -= len(batch)
+            self._active.add(open_id)
+        now = time.monotonic()
+        for _, enqueued_at, _ in batch:
+            self._wait_hist.observe(now - enqueued_at)
+        if len(batch) > 1:
+            self._coalesced.inc(len(batch) - 1)
+        return open_id, [item for item, _, _ in batch], batch[0][2]
+
+    def _release(self, open_id):
+        with self._cond:
+            self._active.discard(open_id)
+            if self._queues.get(open_id):
+                self._ready.append(open_id)
+                self._cond.notify()
+            else:
+                self._queues.pop(open_id, None)
+
+    def _worker(self):
+        while True:
+            open_id, items, context = self._take()
+            try:
+                context.run(self._handle, open_id, items)
+            finally:
+                self._release(open_id)
+
+    def _handle(self, open_id, items):
+        try:
+            self.handler(open_id, items)
+        except Exception:
+            # handler 自行负责告警；漏出来的异常记录并计数，调度线程不退出
+            self._errors.inc()
+            logger.exception("❌ 调度任务异常", extra={"open_id": open_id, "dispatcher": self.name, "items": len(items)})
+
+    def stats(self):
+        with self._cond:
+            depth, active, users = self._pending, len(self._active), len(self._queues)
+        wait = self._wait_hist.snapshot()
+        return {
+            "queue_depth": depth,
+            "max_pending": self.max_pending,
+            "active_users": active,
+            "queued_users": users,
+            "shed": self._shed.value,
+            "coalesced": self._coalesced.value,
+            "handler_errors": self._errors.value,
+            "wait_p50": wait["p50"],
+            "wait_p95": wait["p95"],
+        }
@@ -0,0 +1,122 @@
+import os
+import hashlib
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from config import Config
+from memory_cache import LRUCache
+from database_manager import init_db, get_voice_file_key, save_voice_file_key
+from cuncun_utils import logger, upload_audio_v2
+
+# --- 语音 file_key 缓存 ---
+# 语音库是静态的，同一段 .opus 只需上传一次。
+# 查询顺序：内存 LRU -> SQLite (voice_file_keys) -> 真正上传飞书
+
+_key_cache = LRUCache(maxsize=Config.FILE_KEY_CACHE_SIZE)
+metrics.register_collector("voice_file_key_cache", _key_cache.stats)
+
+# 文件指纹：path -> (mtime_ns, size, content_hash)，mtime/大小不变时免去重复哈希
+_fingerprints = {}
+_fingerprint_lock = threading.Lock()
+
+def file_content_hash(file_path):
+    """计算文件内容哈希；文件 mtime 或大小变化时自动重算"""
+    st = os.stat(file_path)
+    with _fingerprint_lock:
+        cached = _fingerprints.get(file_path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    content_hash = h.hexdigest()
+
+    with _fingerprint_lock:
+        _fingerprints[file_path] = (st.st_mtime_ns, st.st_size, content_hash)
+    return content_hash
+
+def lookup_file_key(file_path):
+    """只查缓存不上传，返回 (content_hash, file_key 或 None)"""
+    content_hash = file_content_hash(file_path)
+    file_key = _key_cache.get(content_hash)
+    if file_key:
+        return content_hash, file_key
+    file_key = get_voice_file_key(content_hash)
+    if file_key:
+        _key_cache.put(content_hash, file_key)
+    return content_hash, file_key
+
+def remember_file_key(content_hash, file_path, file_key):
+    """记录新上传得到的 file_key (内存 + SQLite)"""
+    save_voice_file_key(content_hash, file_key, os.path.basename(file_path), os.path.getsize(file_path))
+    _key_cache.put(content_hash, file_key)
+
+def get_audio_file_key(file_path):
+    """获取语音的飞书 file_key，命中缓存时不再上传"""
+    if not os.path.exists(file_path):
+        return None
+    try:
+        content_hash, file_key = lookup_file_key(file_path)
+    except OSError as e:
+        logger.error(f"语音文件读取失败: {e}")
+        return None
+    if file_key:
+        return file_key
+
+    file_key = upload_audio_v2(file_path)
+    if file_key:
+        remember_file_key(content_hash, file_path, file_key)
+    return file_key
+
+def cache_stats():
+    return _key_cache.stats()
+
+def prewarm_voice_library(workers=4):
+    """部署时一次性上传整个语音库，之后线上请求全部命中缓存"""
+    init_db()
+    if not os.path.isdir(Config.VOICE_LIB):
+        logger.warning(f"语音库目录不存在: {Config.VOICE_LIB}")
+        return {"total": 0, "cached": 0, "uploaded": 0, "failed": 0}
+
+    paths = sorted(
+        os.path.join(Config.VOICE_LIB, name)
+        for name in os.listdir(Config.VOICE_LIB)
+        if name.lower().endswith(".opus")
+    )
+    result = {"total": len(paths), "cached": 0, "uploaded": 0, "failed": 0}
+    lock = threading.Lock()
+
+    def _warm(path):
+        content_hash = file_content_hash(path)
+        already = get_voice_file_key(content_hash)
+        key = already or get_audio_file_key(path)
+        with lock:
+            if not key:
+                result["failed"] += 1
+            elif already:
+                result["cached"] += 1
+            else:
+                result["uploaded"] += 1
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(_warm, paths))
+    result["duration"] = round(time.time() - start, 2)
+    logger.info("🔥 语音 file_key 预热完成", extra={"prewarm": result})
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="语音 file_key 缓存工具")
+    parser.add_argument("--prewarm", action="store_true", help="上传整个语音库并缓存 file_key")
+    parser.add_argument("--workers", type=int, default=4, help="并发上传线程数")
+    args = parser.parse_args()
+
+    if args.prewarm:
+        print(prewarm_voice_library(workers=args.workers))
+    else:
+        parser.print_help()
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+from config import Config
+
+# --- 本地语音向量索引 ---
+# cuncun_voice 集合规模小且运行期只读，导出为 .npy (float32) + JSON 附属文件后，
+# 启动时以内存映射方式加载，所有分句一次矩阵乘法完成最近邻检索，热路径不再经过 Chroma。
+
+def sidecar_path(npy_path):
+    return os.path.splitext(npy_path)[0] + ".json"
+
+class VoiceIndex:
+    def __init__(self, matrix, filenames, space="l2"):
+        self.matrix = matrix
+        self.filenames = filenames
+        self.space = space
+        # l2 距离需要库向量的平方范数，加载时一次算好
+        self._sq_norms = np.einsum("ij,ij->i", matrix, matrix) if space == "l2" else None
+
+    def __len__(self):
+        return len(self.filenames)
+
+    @classmethod
+    def load(cls, npy_path=None):
+        npy_path = npy_path or Config.VOICE_INDEX_PATH
+        with open(sidecar_path(npy_path), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        matrix = np.load(npy_path, mmap_mode="r")
+        if matrix.shape[0] != len(meta["filenames"]):
+            raise ValueError(f"索引行数 {matrix.shape[0]} 与文件名数量 {len(meta['filenames'])} 不一致")
+        return cls(matrix, meta["filenames"], meta.get("space", "l2"))
+
+    def query(self, vectors):
+        """
+        一次性检索所有查询向量的最近邻。
+        返回与 vectors 一一对应的 [(distance, filename), ...]，距离口径与 Chroma 相同 (l2 为平方欧氏距离)；
+        索引为空时每个查询都是 None (无匹配)。
+        """
+        if not len(vectors):
+            return []
+        if not len(self.filenames):
+            return [None] * len(vectors)
+        q = np.asarray(vectors, dtype=np.float32)
+        scores = q @ self.matrix.T
+
+        if self.space == "cosine":
+            norms = np.linalg.norm(q, axis=1, keepdims=True)
+            distances = 1.0 - scores / np.maximum(norms, 1e-12)
+        elif self.space == "ip":
+            distances = 1.0 - scores
+        else:
+            distances = np.einsum("ij,ij->i", q, q)[:, None] + self._sq_norms[None, :] - 2.0 * scores
+
+        best = distances.argmin(axis=1)
+        return [(float(distances[i, j]), self.filenames[j]) for i, j in enumerate(best)]
+
+def _collection_space(collection):
+    """读取集合的距离度量，兼容新旧版 Chroma 的配置位置"""
+    space = (collection.metadata or {}).get("hnsw:space")
+    if space:
+        return space
+    try:
+        config = collection.configuration or {}
+        hnsw = config.get("hnsw") or {}
+        return hnsw.get("space") or "l2"
+    except Exception:
+        return "l2"
+
+def rebuild_index(npy_path=None):
+    """从 Chroma 的 cuncun_voice 集合导出本地索引"""
+    import chromadb
+
+    npy_path = npy_path or Config.VOICE_INDEX_PATH
+    start = time.time()
+    client = chromadb.PersistentClient(path=Config.ASSETS_PATH)
+    collection = client.get_collection(name="cuncun_voice")
+    data = collection.get(include=["embeddings", "metadatas"])
+
+    space = _collection_space(collection)
+    matrix = np.asarray(data["embeddings"], dtype=np.float32)
+    filenames = [m["filename"] for m in data["metadatas"]]
+    if space == "cosine" and len(matrix):
+        # 余弦度量下预先归一化，检索时只需一次点积
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+    os.makedirs(os.path.dirname(npy_path) or ".", exist_ok=True)
+    tmp_npy = npy_path + ".tmp.npy"
+    np.save(tmp_npy, np.ascontiguousarray(matrix))
+    tmp_meta = sidecar_path(npy_path) + ".tmp"
+    with open(tmp_meta, "w", encoding="utf-8") as f:
+        json.dump({
+            "space": space,
+            "dim": int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+            "count": len(filenames),
+            "built_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "filenames": filenames,
+        }, f, ensure_ascii=False)
+    os.replace(tmp_npy, npy_path)
+    os.replace(tmp_meta, sidecar_path(npy_path))
+
+    summary = {"count": len(filenames), "space": space, "path": npy_path,
+               "bytes": os.path.getsize(npy_path), "duration": round(time.time() - start, 2)}
+    print(f"✅ 语音索引已重建: {summary}")
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地语音向量索引工具")
+    parser.add_argument("--rebuild", action="store_true", help="从 Chroma 集合导出 .npy + JSON 索引")
+    parser.add_argument("--path", default=None, help="索引输出路径 (默认 VOICE_INDEX_PATH)")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        rebuild_index(args.path)
+    else:
+        parser.print_help()
@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from config import Config
+from database_manager import init_db
+from embedding_cache import embedding_cache, normalize_text
+from cuncun_utils import EMBEDDING_MODEL, get_embeddings
+from voice_cache import file_content_hash
+
+# --- 语音库增量入库 ---
+# 扫描 VOICE_LIB 下的 .opus 与同名 .txt 台词 (没有台词文件时沿用集合里的 document，再没有才用文件名)，
+# 和 cuncun_voice 集合里记录的内容哈希比对：只有新增或台词变化的片段才调用向量接口，音频变了台词没变只更新元数据，
+# 文件已删除的片段从集合中移除。每批向量拿到后立即写入集合，中途失败时重跑即从断点继续。
+# 预构建库里的条目没有 text_sha256：台词与已有 document 一致或没有台词文件时只补写哈希，不重新向量化。
+
+COLLECTION_NAME = "cuncun_voice"
+
+def read_transcript(opus_path, document=None):
+    """返回 (台词, 是否来自 .txt)：同名 .txt 优先，其次是集合里已有的 document，最后用文件名 (去掉扩展名)"""
+    txt_path = os.path.splitext(opus_path)[0] + ".txt"
+    if os.path.exists(txt_path):
+        with open(txt_path, "r", encoding="utf-8") as f:
+            return f.read().strip(), True
+    if document and document.strip():
+        return document.strip(), False
+    return os.path.splitext(os.path.basename(opus_path))[0].strip(), False
+
+def text_hash(text):
+    # 向量由 (模型, 台词) 决定，换模型后全部片段都会被视为变化
+    return hashlib.sha256(f"{EMBEDDING_MODEL}\n{text}".encode("utf-8")).hexdigest()
+
+class RateLimiter:
+    """每秒最多 rate 次请求，超出时调用方等待；rate <= 0 表示不限"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+def open_collection():
+    import chromadb
+    client = chromadb.PersistentClient(path=Config.ASSETS_PATH)
+    return client.get_or_create_collection(name=COLLECTION_NAME)
+
+def load_collection_state(collection):
+    """返回 ({filename: (id, metadata, document)}, 重复条目的 id 列表)"""
+    data = collection.get(include=["metadatas", "documents"])
+    known, duplicates = {}, []
+    for entry_id, meta, document in zip(data["ids"], data["metadatas"], data["documents"]):
+        filename = (meta or {}).get("filename")
+        if not filename or filename in known:
+            duplicates.append(entry_id)
+            continue
+        known[filename] = (entry_id, meta, document)
+    return known, duplicates
+
+def scan_library(known):
+    """扫描语音库，返回每个片段的台词与哈希；mtime 与大小都没变时沿用集合里记录的音频哈希"""
+    clips = []
+    for name in sorted(os.listdir(Config.VOICE_LIB)):
+        if not name.lower().endswith(".opus"):
+            continue
+        path = os.path.join(Config.VOICE_LIB, name)
+        st = os.stat(path)
+        _, meta, document = known.get(name, (None, {}, None))
+        if meta.get("mtime_ns") == st.st_mtime_ns and meta.get("size") == st.st_size and meta.get("audio_sha256"):
+            audio_sha256 = meta["audio_sha256"]
+        else:
+            audio_sha256 = file_content_hash(path)
+        text, from_file = read_transcript(path, document)
+        clips.append({
+            "filename": name,
+            "text": text,
+            "from_file": from_file,
+            "text_sha256": text_hash(text),
+            "audio_sha256": audio_sha256,
+            "mtime_ns": st.st_mtime_ns,
+            "size": st.st_size,
+        })
+    return clips
+
+def plan_changes(clips, known, duplicates):
+    """与集合比对，分出需要向量化 / 只更新元数据 / 删除的片段"""
+    plan = {"embed": [], "touch": [], "remove": list(duplicates),
+            "unchanged": 0, "new": 0, "changed": 0, "stamped": 0, "empty": 0}
+    seen = set()
+    for clip in clips:
+        seen.add(clip["filename"])
+        if not clip["text"]:
+            plan["empty"] += 1
+            continue
+        entry_id, meta, document = known.get(clip["filename"], (None, {}, None))
+        clip["id"] = entry_id or clip["filename"]
+        if entry_id is None:
+            plan["new"] += 1
+            plan["embed"].append(clip)
+        elif not meta.get("text_sha256") and (not clip["from_file"] or clip["text"] == (document or "").strip()):
+            # 预构建条目：向量本就由这段台词 (或未知台词) 生成，只补写哈希等元数据
+            plan["stamped"] += 1
+            plan["touch"].append(clip)
+        elif meta.get("text_sha256") != clip["text_sha256"]:
+            plan["changed"] += 1
+            plan["embed"].append(clip)
+        elif any(meta.get(k) != clip[k] for k in ("audio_sha256", "mtime_ns", "size")):
+            plan["touch"].append(clip)
+        else:
+            plan["unchanged"] += 1
+    plan["remove"] += [entry_id for filename, (entry_id, _, _) in known.items() if filename not in seen]
+    return plan
+
+def _metadata(clip):
+    return {k: clip[k] for k in ("filename", "text_sha256", "audio_sha256", "mtime_ns", "size")}
+
+def _upsert(collection, clips, vectors):
+    collection.upsert(
+        ids=[c["id"] for c in clips],
+        embeddings=vectors,
+        metadatas=[_metadata(c) for c in clips],
+        documents=[c["text"] for c in clips],
+    )
+
+def ingest(workers=4, rate=5.0, batch_size=None, upsert_size=256, retries=3, dry_run=False, rebuild_index=False):
+    """增量入库，返回统计；有片段向量化失败时 failed > 0，重跑即可续传"""
+    init_db()
+    if not os.path.isdir(Config.VOICE_LIB):
+        raise FileNotFoundError(f"语音库目录不存在: {Config.VOICE_LIB}")
+    if not Config.SILICONFLOW_API_KEY and not dry_run:
+        raise RuntimeError("未配置 SILICONFLOW_API_KEY，无法向量化")
+
+    start = time.time()
+    collection = open_collection()
+    known, duplicates = load_collection_state(collection)
+    clips = scan_library(known)
+    plan = plan_changes(clips, known, duplicates)
+    stats = {
+        "scanned": len(clips), "new": plan["new"], "changed": plan["changed"], "unchanged": plan["unchanged"],
+        "metadata_only": len(plan["touch"]), "stamped": plan["stamped"], "removed": len(plan["remove"]), "empty": plan["empty"],
+        "embedded": 0, "cache_hits": 0, "failed": 0, "requests": 0, "scan_seconds": round(time.time() - start, 2),
+    }
+    print(f"🔍 语音库扫描完成: {json.dumps(stats, ensure_ascii=False)}")
+    if dry_run:
+        return stats
+
+    if plan["remove"]:
+        collection.delete(ids=plan["remove"])
+    if plan["touch"]:
+        # 只改元数据；不传 documents，避免 Chroma 调用默认向量函数
+        collection.update(ids=[c["id"] for c in plan["touch"]], metadatas=[_metadata(c) for c in plan["touch"]])
+
+    # 每批不超过 EMBED_BATCH_SIZE，get_embeddings 对一批只发一次请求
+    size = min(batch_size or Config.EMBED_BATCH_SIZE, Config.EMBED_BATCH_SIZE)
+    batches = [plan["embed"][i:i + size] for i in range(0, len(plan["embed"]), size)]
+    limiter = RateLimiter(rate)
+    lock = threading.Lock()
+
+    def _embed(batch):
+        texts = [c["text"] for c in batch]
+        vectors = [None] * len(batch)
+        for attempt in range(retries + 1):
+            cached = embedding_cache.get_many(EMBEDDING_MODEL, [normalize_text(t) for t in texts])
+            if attempt == 0:
+                with lock:
+                    stats["cache_hits"] += sum(1 for v in cached if v)
+            if all(cached):
+                vectors = cached
+                break
+            limiter.wait()
+            with lock:
+                stats["requests"] += 1
+            # 成功的向量已写入缓存，重试时只会请求仍缺失的台词
+            vectors = get_embeddings(texts)
+            if all(vectors):
+                break
+            if attempt < retries:
+                time.sleep(min(2 ** attempt, 30))
+        return batch, vectors
+
+    embed_start = time.time()
+    pending_clips, pending_vectors = [], []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_embed, batch) for batch in batches]
+        for done, future in enumerate(as_completed(futures), 1):
+            batch, vectors = future.result()
+            for clip, vec in zip(batch, vectors):
+                if vec:
+                    pending_clips.append(clip)
+                    pending_vectors.append(vec)
+                else:
+                    stats["failed"] += 1
+            if len(pending_clips) >= upsert_size or done == len(futures):
+                if pending_clips:
+                    _upsert(collection, pending_clips, pending_vectors)
+                    stats["embedded"] += len(pending_clips)
+                    pending_clips, pending_vectors = [], []
+                elapsed = time.time() - embed_start
+                print(f"⏳ 已入库 {stats['embedded']}/{len(plan['embed'])}，"
+                      f"{stats['embedded'] / max(elapsed, 1e-6):.1f} 条/秒，失败 {stats['failed']}")
+
+    embed_seconds = time.time() - embed_start
+    stats["embed_seconds"] = round(embed_seconds, 2)
+    stats["clips_per_second"] = round(stats["embedded"] / embed_seconds, 1) if stats["embedded"] else 0.0
+    stats["duration"] = round(time.time() - start, 2)
+    stats["collection_count"] = collection.count()
+
+    if rebuild_index and (stats["embedded"] or stats["removed"] or stats["metadata_only"]):
+        from voice_index import rebuild_index as rebuild
+        rebuild()
+    if stats["failed"]:
+        print(f"⚠️ {stats['failed']} 条片段向量化失败，重新运行即可只补齐这些片段")
+    print(f"✅ 语音库入库完成: {json.dumps(stats, ensure_ascii=False)}")
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="语音库增量入库 (cuncun_voice 集合)")
+    parser.add_argument("--workers", type=int, default=4, help="并发请求向量接口的线程数")
+    parser.add_argument("--rate", type=float, default=5.0, help="每秒最多请求次数，0 表示不限")
+    parser.add_argument("--batch-size", type=int, default=None, help="每次请求的台词条数 (不超过 EMBED_BATCH_SIZE)")
+    parser.add_argument("--upsert-size", type=int, default=256, help="攒够多少条写一次集合")
+    parser.add_argument("--retries", type=int, default=3, help="每批失败后的重试次数")
+    parser.add_argument("--dry-run", action="store_true", help="只比对并输出变化，不调用接口、不写集合")
+    parser.add_argument("--rebuild-index", action="store_true", help="有变化时顺带重建本地 NumPy 索引")
+    args = parser.parse_args()
+
+    result = ingest(workers=args.workers, rate=args.rate, batch_size=args.batch_size, upsert_size=args.upsert_size,
+                    retries=args.retries, dry_run=args.dry_run, rebuild_index=args.rebuild_index)
+    raise SystemExit(1 if result.get("failed") else 0)